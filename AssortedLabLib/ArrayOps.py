@@ -0,0 +1,428 @@
+import __future__
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+try:
+  import numexpr
+except ImportError:
+  numexpr = None
+
+#
+# Array kernels shared by the modules
+#
+# Everything here works on NumPy arrays only, without VTK, MRML or Slicer, so the kernels
+# can be used inside Slicer, in worker processes and from the pure NumPy command line path.
+# Volume arrays are either flat in VTK order (x fastest) or shaped (z, y, x).
+#
+
+#
+# Output scalar types
+#
+
+# Output types the combine modules offer. 'input' keeps the scalar type of the first input volume
+OUTPUT_TYPES = ('input', 'uint8', 'uint16', 'float32')
+
+
+def outputScalarType(outputType, inputType):
+  """ Returns the numpy dtype for one of OUTPUT_TYPES, given the dtype of the first input volume
+  """
+  if outputType in (None, 'input'):
+    return np.dtype(inputType)
+  if outputType not in OUTPUT_TYPES:
+    raise ValueError('Unknown output type: %s' % outputType)
+  return np.dtype(outputType)
+
+
+def saturatingCast(array, dtype, out=None, inPlace=False, chunkSize=None, nanValue=0):
+  """ Casts an array to dtype. Integer outputs are rounded to the nearest integer and clipped to the
+  range of dtype, so values beyond it saturate instead of wrapping around, and NaN (e.g. 0/0 in a
+  combine rule) becomes nanValue. Floating point outputs keep NaN. The result is written
+  into out if given, otherwise into a new array (or array itself when it already has the type).
+  With inPlace, array may be used as scratch space, otherwise the work is done chunkSize values at
+  a time so the temporaries stay small
+  """
+  dtype = np.dtype(dtype)
+  if out is None:
+    if array.dtype == dtype:
+      return array
+    out = np.empty(array.shape, dtype)
+
+  # Floating point outputs, and integer inputs that always fit, need no rounding or clipping
+  if dtype.kind not in 'iu' or (array.dtype.kind in 'biu' and np.can_cast(array.dtype, dtype)):
+    np.copyto(out, array, casting='unsafe')
+    return out
+
+  # Contiguous arrays are cast chunkSize values at a time, others in one pass
+  limits = np.iinfo(dtype)
+  if inPlace or not (array.flags.c_contiguous and out.flags.c_contiguous):
+    chunks = [(array, out)]
+  else:
+    if chunkSize is None:
+      chunkSize = DEFAULT_CHUNK_SIZE
+    values = array.reshape(-1)
+    outputValues = out.reshape(-1)
+    chunks = [(values[start:start+chunkSize], outputValues[start:start+chunkSize]) for start in range(0, values.size, chunkSize)]
+
+  for values, outputValues in chunks:
+    if inPlace and values.dtype.kind == 'f':
+      scratch = np.clip(values, limits.min, limits.max, out=values)
+    else:
+      scratch = np.clip(values, limits.min, limits.max)
+    if scratch.dtype.kind == 'f':
+      np.copyto(scratch, nanValue, where=np.isnan(scratch))
+      np.around(scratch, out=scratch)
+    np.copyto(outputValues, scratch, casting='unsafe')
+  return out
+
+#
+# Combining two volumes (SetVolumeScalars)
+#
+
+# Named combine rules. Expressions use 'a' and 'b' for input volumes 1 and 2 and only use functions that
+# both numexpr and numpy provide (see COMBINE_FUNCTIONS)
+COMBINE_RULES = {
+  'ratio': 'where(b != 0, 27*a/b, 0)',
+  'mean': '(a + b)/2',
+  'weighted': 'wa*a + wb*b',
+  'log-ratio': 'where((a > 0) & (b > 0), log(a/b), 0)',
+  'clipped': 'where(b != 0, where(27*a/b < 255, 27*a/b, 255), 0)',
+  }
+
+# Default values for the parameters used by the named rules
+COMBINE_RULE_PARAMETERS = {
+  'weighted': {'wa': 0.5, 'wb': 0.5},
+  }
+
+# Functions allowed in combine expressions, with their numpy equivalents
+COMBINE_FUNCTIONS = {
+  'where': np.where,
+  'log': np.log,
+  'log10': np.log10,
+  'exp': np.exp,
+  'sqrt': np.sqrt,
+  'abs': np.abs,
+  }
+
+# Number of z slices combined at a time by combineArrays
+DEFAULT_SLAB_SIZE = 16
+
+# Compiled combine expressions
+_compiledCombineRules = {}
+
+
+def compileCombineRule(rule, ruleParameters=None):
+  """ Compiles a named rule from COMBINE_RULES, or a user expression in 'a' and 'b', into a kernel that
+  combines one slab of each input. Kernels are compiled once per expression and reused. With numexpr
+  installed the whole expression is evaluated as one fused kernel without intermediate arrays, otherwise
+  numpy evaluates it slab by slab. Division is always true division and division by zero is ignored, so
+  rules guard it with where()
+  """
+  expression = COMBINE_RULES.get(rule, rule)
+  parameters = dict(COMBINE_RULE_PARAMETERS.get(rule, {}))
+  parameters.update(ruleParameters or {})
+
+  if expression not in _compiledCombineRules:
+    try:
+      code = compile(expression, '<combine rule>', 'eval', __future__.division.compiler_flag, True)
+    except SyntaxError as error:
+      raise ValueError('Invalid combine expression "%s": %s' % (expression, error))
+    _compiledCombineRules[expression] = code
+  code = _compiledCombineRules[expression]
+
+  # Only the inputs, rule parameters and COMBINE_FUNCTIONS may be used in an expression
+  unknownNames = set(code.co_names) - set(['a', 'b']) - set(parameters) - set(COMBINE_FUNCTIONS)
+  if unknownNames:
+    raise ValueError('Unknown names in combine expression "%s": %s' % (expression, ', '.join(sorted(unknownNames))))
+
+  if numexpr is not None:
+    def kernel(slab1, slab2):
+      localDict = dict(parameters, a=slab1, b=slab2)
+      return numexpr.evaluate(expression, local_dict=localDict, truediv=True)
+  else:
+    def kernel(slab1, slab2):
+      # Work in floating point so integer inputs cannot wrap around
+      namespace = dict(COMBINE_FUNCTIONS, a=slab1.astype(np.float64), b=slab2.astype(np.float64), **parameters)
+      with np.errstate(divide='ignore', invalid='ignore'):
+        return np.asarray(eval(code, {'__builtins__': {}}, namespace), dtype=np.float64)
+  return kernel
+
+
+def combineArrays(array1, array2, output=None, slabSize=None, rule='ratio', ruleParameters=None):
+  """ Combines two (z, y, x) arrays with a combine rule, streaming slabSize z slices at a time so only
+  one slab of floating point temporaries exists at once. The result is written into output if given,
+  otherwise into a new array with the type of array1. Values are rounded and saturated when the output
+  holds integers (see saturatingCast)
+  """
+  if array1.shape != array2.shape:
+    raise ValueError('All input volumes must be the same size')
+  z = array1.shape[0]
+  if output is None:
+    output = np.empty(array1.shape, array1.dtype)
+  outputSlabs = output.reshape(array1.shape)
+
+  kernel = compileCombineRule(rule, ruleParameters)
+  if slabSize is None:
+    slabSize = DEFAULT_SLAB_SIZE
+  for zStart in range(0, z, slabSize):
+    slab = slice(zStart, min(zStart+slabSize, z))
+    saturatingCast(kernel(array1[slab], array2[slab]), outputSlabs.dtype, out=outputSlabs[slab], inPlace=True)
+  return output
+
+#
+# Reducing many volumes voxel by voxel (MultiVolCombine)
+#
+
+# Reductions supported by reducePixelArrays
+REDUCTION_TYPES = ('mean', 'max', 'min', 'median', 'weighted')
+
+# Number of voxels reduced per chunk (about 1 MB per uint8 input)
+DEFAULT_CHUNK_SIZE = 2**20
+
+def defaultNumberOfThreads():
+  """ Number of threads used by reducePixelArrays when none is given, one per core """
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
+
+
+def _reduceChunk(arrays, reductions, outputs, weights, chunk):
+  """ Reduces one chunk of all input arrays into the outputs. Chunks do not overlap, so chunks can be
+  reduced concurrently. Scratch buffers are one chunk in size and private to the call """
+  chunkLength = chunk.stop - chunk.start
+  weightedScratch = None
+  medianStack = None
+  if 'weighted' in reductions:
+    weightedScratch = np.empty(chunkLength, outputs[tuple(reductions).index('weighted')].dtype)
+  if 'median' in reductions:
+    medianStack = np.empty((len(arrays), chunkLength), arrays[0].dtype)
+
+  for index, array in enumerate(arrays):
+    inputChunk = array[chunk]
+
+    for reduction, output in zip(reductions, outputs):
+      outputChunk = output[chunk]
+      if reduction == 'mean':
+        if index == 0:
+          outputChunk[...] = inputChunk
+        else:
+          np.add(outputChunk, inputChunk, out=outputChunk)
+      elif reduction == 'max':
+        if index == 0:
+          outputChunk[...] = inputChunk
+        else:
+          np.maximum(outputChunk, inputChunk, out=outputChunk)
+      elif reduction == 'min':
+        if index == 0:
+          outputChunk[...] = inputChunk
+        else:
+          np.minimum(outputChunk, inputChunk, out=outputChunk)
+      elif reduction == 'weighted':
+        weightedScratch[...] = inputChunk
+        weightedScratch *= weights[index]
+        if index == 0:
+          outputChunk[...] = weightedScratch
+        else:
+          np.add(outputChunk, weightedScratch, out=outputChunk)
+
+    if medianStack is not None:
+      medianStack[index] = inputChunk
+
+  # Outputs are matched to reductions by position, so a repeated reduction fills every one of its outputs
+  for reduction, output in zip(reductions, outputs):
+    outputChunk = output[chunk]
+    if reduction == 'median':
+      np.median(medianStack, axis=0, out=outputChunk)
+    elif reduction == 'mean':
+      # Turn the running sum into the average
+      np.true_divide(outputChunk, len(arrays), out=outputChunk)
+
+
+def reducePixelArrays(arrays, reductions=('mean', 'max'), weights=None, chunkSize=None, numberOfThreads=None):
+  """ Reduces a list of equally sized flat arrays voxel by voxel in a single pass over chunks of
+  the volume. Every reduction keeps one in-place accumulator the size of one volume, so peak
+  memory does not grow with the number of inputs. The median is the only reduction that needs
+  all inputs at once, and it only stacks one chunk of them at a time.
+
+  Chunks are reduced on a pool of numberOfThreads threads (one per core by default). NumPy ufuncs
+  release the GIL while they run, so the chunks are reduced in parallel. Each thread only touches
+  one chunk of the inputs and outputs at a time, which keeps its working set in cache """
+
+  if len(arrays) == 0:
+    raise ValueError('At least one input array is required')
+  for array in arrays[1:]:
+    if array.shape != arrays[0].shape:
+      raise ValueError('All input volumes must be the same size')
+  for reduction in reductions:
+    if reduction not in REDUCTION_TYPES:
+      raise ValueError('Unknown reduction: %s' % reduction)
+  if 'weighted' in reductions:
+    if weights is None or len(weights) != len(arrays):
+      raise ValueError('The weighted reduction needs one weight per input volume')
+
+  if chunkSize is None:
+    chunkSize = DEFAULT_CHUNK_SIZE
+  numberOfVoxels = arrays[0].size
+  chunks = [slice(chunkStart, min(chunkStart+chunkSize, numberOfVoxels)) for chunkStart in range(0, numberOfVoxels, chunkSize)]
+
+  # Sums are kept in floating point so they cannot wrap around (array/4 in uint8 also lost precision)
+  floatType = np.result_type(arrays[0].dtype, np.float32)
+
+  # Preallocate one output per reduction
+  outputs = []
+  for reduction in reductions:
+    if reduction in ('max', 'min'):
+      outputs.append(np.empty(arrays[0].shape, arrays[0].dtype))
+    else:
+      outputs.append(np.empty(arrays[0].shape, floatType))
+
+  numberOfThreads = min(numberOfThreads or defaultNumberOfThreads(), len(chunks))
+  if numberOfThreads <= 1:
+    for chunk in chunks:
+      _reduceChunk(arrays, reductions, outputs, weights, chunk)
+  else:
+    pool = ThreadPool(numberOfThreads)
+    try:
+      pool.map(lambda chunk: _reduceChunk(arrays, reductions, outputs, weights, chunk), chunks, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+
+  return outputs
+
+#
+# Label masks and masked statistics (ComputeRegionCNR, ComputeCGCNR)
+#
+
+def labelValueIndices(labelArray):
+  """ Returns a dictionary mapping every nonzero value of a flat label array to the sorted flat
+  indices of its voxels. Only the nonzero voxels are sorted, so the cost beyond one pass over the
+  label is proportional to the labelled region
+  """
+  indices = np.flatnonzero(labelArray)
+  values = labelArray[indices]
+  order = np.argsort(values, kind='mergesort') # stable, keeps the indices of each value sorted
+  values = values[order]
+  indices = indices[order]
+  labelValues, starts = np.unique(values, return_index=True)
+  ends = list(starts[1:]) + [len(values)]
+  return dict((labelValue.item(), indices[start:end]) for labelValue, start, end in zip(labelValues, starts, ends))
+
+
+def maxLabelIndices(labelIndex):
+  """ Returns the flat indices of the largest label value of a label index (see labelValueIndices)
+  """
+  if not labelIndex:
+    return np.array([], dtype=np.intp)
+  return labelIndex[max(labelIndex)]
+
+
+def labelIndices(labelArray):
+  """ Returns the flat indices of the voxels carrying the label value (the largest value in the label map)
+  """
+  return maxLabelIndices(labelValueIndices(labelArray))
+
+
+def mirrorLabelIndices(labelIndices, dimensions, axis=0, shift=None):
+  """ Mirrors flat label indices of a volume with VTK dimensions (x,y,z) along one IJK axis,
+  mapping index i to shift-i (shift defaults to dimension-1, i.e. a flip about the volume center).
+  Voxels that fall outside the volume are dropped
+  """
+  shape = tuple(reversed(dimensions)) # numpy order (k,j,i)
+  if shift is None:
+    shift = dimensions[axis]-1
+  ijk = list(reversed(np.unravel_index(labelIndices, shape)))
+  ijk[axis] = shift - ijk[axis]
+  inside = (ijk[axis] >= 0) & (ijk[axis] < dimensions[axis])
+  kji = tuple(index[inside] for index in reversed(ijk))
+  return np.sort(np.ravel_multi_index(kji, shape))
+
+
+def boundingBox(indices, dimensions):
+  """ Returns the (k, j, i) slices of the tight bounding box of flat voxel indices in a volume with
+  VTK dimensions (x,y,z), or None if there are no indices
+  """
+  if len(indices) == 0:
+    return None
+  k, j, i = np.unravel_index(indices, (dimensions[2], dimensions[1], dimensions[0]))
+  return tuple(slice(int(axis.min()), int(axis.max())+1) for axis in (k, j, i))
+
+
+class CroppedMask(object):
+  """ Label mask stored as its bounding box in a volume with VTK dimensions (x,y,z) and a boolean
+  mask inside the box. Values reads the voxels through a zero-copy strided view of the box
+  """
+
+  def __init__(self, indices, dimensions):
+    self.shape = (dimensions[2], dimensions[1], dimensions[0])
+    self.box = boundingBox(indices, dimensions) or (slice(0, 0),)*3
+    self.mask = np.zeros(tuple(axis.stop-axis.start for axis in self.box), dtype=bool)
+    if len(indices):
+      k, j, i = np.unravel_index(indices, self.shape)
+      self.mask[k-self.box[0].start, j-self.box[1].start, i-self.box[2].start] = True
+    self.count = len(indices)
+
+  def __len__(self):
+    return self.count
+
+  def View(self, array):
+    """ Returns the bounding box of a flat volume array as a strided view (no copy)
+    """
+    return array.reshape(self.shape)[self.box]
+
+  def Values(self, array):
+    """ Returns the values of a flat volume array inside the mask
+    """
+    return self.View(array)[self.mask]
+
+
+def symmetricLabelIndices(labelIndices, dimensions, ijkToRAS):
+  """ Mirrors flat label indices of a volume with VTK dimensions (x,y,z) across the RAS x=0 (L/R)
+  plane, the mapping the [-1 1 1 1] symmetry transform applies to a label node. ijkToRAS is the 4x4
+  IJK to RAS matrix of the volume (rows). Returns None if no IJK axis of the volume is aligned with L/R
+  """
+  matrix = np.asarray(ijkToRAS, dtype=np.float64).reshape(4, 4)
+
+  # Find the IJK axis that moves along L/R only
+  lrAxis = int(np.argmax(np.abs(matrix[0, :3])))
+  step = matrix[0, lrAxis]
+  tolerance = 1e-6*abs(step)
+  otherAxes = [column for column in range(3) if column != lrAxis]
+  if np.any(np.abs(matrix[0, otherAxes]) > tolerance) or np.any(np.abs(matrix[1:3, lrAxis]) > tolerance):
+    return None
+
+  # x(i) = step*i + offset, so the mirror image -x(i) lands on index -2*offset/step - i
+  shift = int(round(-2*matrix[0, 3]/step))
+  return mirrorLabelIndices(labelIndices, dimensions, lrAxis, shift)
+
+
+def lesionAndSymmetricMasks(labelArray, dimensions, ijkToRAS):
+  """ Returns the CroppedMasks of the lesion (the largest value of a flat label array) and of the
+  symmetric region, the lesion mirrored across the RAS x=0 plane (see symmetricLabelIndices). Raises
+  ValueError if the volume is oblique to L/R
+  """
+  lesionIndices = labelIndices(labelArray)
+  symmetricIndices = symmetricLabelIndices(lesionIndices, dimensions, ijkToRAS)
+  if symmetricIndices is None:
+    raise ValueError('No voxel axis of the lesion label is aligned with L/R, the lesion cannot be mirrored')
+  return CroppedMask(lesionIndices, dimensions), CroppedMask(symmetricIndices, dimensions)
+
+
+def maskedStatistics(grayscaleArray, labelMask):
+  """ Returns count, mean, std, min and max of the grayscale voxels in the mask, with the same keys
+  and conventions (sample standard deviation) as the LabelStatistics module. The mask is either
+  flat voxel indices or a CroppedMask, which only reads the bounding box of the region
+  """
+  if isinstance(labelMask, CroppedMask):
+    values = labelMask.Values(grayscaleArray).astype(np.float64)
+  else:
+    values = grayscaleArray[labelMask].astype(np.float64)
+  stats = {"Count": values.size, "Min": 0.0, "Max": 0.0, "Mean": 0.0, "StdDev": 0.0}
+  if values.size > 0:
+    stats["Min"] = values.min()
+    stats["Max"] = values.max()
+    stats["Mean"] = values.mean()
+  if values.size > 1:
+    stats["StdDev"] = values.std(ddof=1)
+  return stats
@@ -0,0 +1,336 @@
+"""Headless command line for the AssortedLabModules.
+
+Runs the modules on files instead of through the module panels, so patients can be scripted
+and spread over compute nodes. Inside Slicer the module Logic classes do the work:
+
+  Slicer --no-main-window --python-script AssortedLabLib/CommandLine.py <command> [options]
+
+setvolumescalars, multivolcombine, regioncnr and cgcnr also run without Slicer or VTK on
+NumPy arrays read and written with nibabel (--numpy, the default outside Slicer):
+
+  python -m AssortedLabLib.CommandLine <command> [options]
+
+Commands:
+
+  setvolumescalars   input1 input2 output [--rule RULE] [--parameter NAME=VALUE ...] [--slab-size N] [--output-type TYPE]
+  multivolcombine    input [input ...] --mean-output PATH --max-output PATH [--chunk-size N] [--threads N] [--output-type TYPE]
+  visualizetimesteps patient --output-directory DIR [--timestep-directory PATTERN] [--no-cache]
+  regioncnr          lesionlabel volume [volume ...] --results PATH [--patient ID]
+  regioncnr          --batch patient [patient ...] --lesion-label-pattern PATTERN --results PATH
+  cgcnr              urethralabel cglabel volume [volume ...] --results PATH [--patient ID]
+
+Exits with status 1 if the command failed.
+"""
+
+import os
+import sys
+import argparse
+import logging
+import numpy as np
+
+try:
+  import AssortedLabLib
+except ImportError: # run as a script from a source checkout
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AssortedLabLib.Instrumentation import StageTimer, configure
+from AssortedLabLib.Results import ResultsStore, cnrRows
+from AssortedLabLib.TimestepFiles import TIMESTEP_DIRECTORY
+from AssortedLabLib.ArrayOps import (COMBINE_RULES, DEFAULT_SLAB_SIZE, DEFAULT_CHUNK_SIZE, OUTPUT_TYPES, combineArrays,
+                                     reducePixelArrays, outputScalarType, saturatingCast, labelIndices,
+                                     lesionAndSymmetricMasks, maskedStatistics)
+
+try:
+  import nibabel
+except ImportError: # only needed by the pure NumPy path
+  nibabel = None
+
+def slicerAvailable():
+  try:
+    import slicer
+  except ImportError:
+    return False
+  return getattr(slicer, 'app', None) is not None
+
+
+def volumeName(filePath):
+  """ Returns the file name without its extensions, the name Slicer gives the loaded node """
+  return os.path.basename(filePath).split('.')[0]
+
+#
+# Slicer backend (module Logic classes on MRML nodes)
+#
+
+def loadVolume(filePath, labelmap=False):
+  import slicer
+  if labelmap:
+    loaded, volumeNode = slicer.util.loadLabelVolume(filePath, {}, returnNode=True)
+  else:
+    loaded, volumeNode = slicer.util.loadVolume(filePath, {}, returnNode=True)
+  if not loaded:
+    raise IOError('Could not load volume %s' % filePath)
+  return volumeNode
+
+
+def saveVolume(volumeNode, filePath):
+  import slicer
+  if not slicer.util.saveNode(volumeNode, filePath):
+    raise IOError('Could not save %s to %s' % (volumeNode.GetName(), filePath))
+
+
+def slicerSetVolumeScalars(args):
+  from SetVolumeScalars import SetVolumeScalarsLogic
+  outputVolume = SetVolumeScalarsLogic().run(loadVolume(args.input1), loadVolume(args.input2),
+                                             args.slab_size, args.rule, args.parameters, args.output_type)
+  if not outputVolume:
+    return False
+  saveVolume(outputVolume, args.output)
+  return True
+
+
+def slicerMultiVolCombine(args):
+  from MultiVolCombine import MultiVolCombineLogic
+  logic = MultiVolCombineLogic()
+  logic.defaultNumberOfThreads = args.threads
+  meanVolume, maxVolume = logic.run(*[loadVolume(filePath) for filePath in args.inputs], outputType=args.output_type)
+  saveVolume(meanVolume, args.mean_output)
+  saveVolume(maxVolume, args.max_output)
+  return True
+
+
+def slicerVisualizeTimesteps(args):
+  from VisualizeTimesteps import VisualizeTimestepsLogic
+  logic = VisualizeTimestepsLogic()
+  timestepDirectory = args.timestep_directory or TIMESTEP_DIRECTORY
+  timesteps = logic.run(args.patient, timestepDirectory=timestepDirectory, useCache=not args.no_cache)
+  if not timesteps:
+    return False
+  if not os.path.isdir(args.output_directory):
+    os.makedirs(args.output_directory)
+  for timestep in timesteps:
+    saveVolume(timestep, os.path.join(args.output_directory, timestep.GetName()+args.extension))
+  return True
+
+
+def slicerRegionCNR(args):
+  from ComputeRegionCNR import ComputeRegionCNRLogic
+  logic = ComputeRegionCNRLogic()
+  if args.batch:
+    failedPatients = logic.runBatch(args.batch, args.lesion_label_pattern, args.results,
+                                    args.timestep_directory or TIMESTEP_DIRECTORY, args.processes)
+    return not failedPatients
+  logic.run(loadVolume(args.label, labelmap=True), *[loadVolume(filePath) for filePath in args.volumes],
+            patient=args.patient, resultsPath=args.results)
+  return True
+
+
+def slicerCGCNR(args):
+  from ComputeCGCNR import ComputeCGCNRLogic
+  ComputeCGCNRLogic().run(loadVolume(args.urethra_label, labelmap=True), loadVolume(args.cg_label, labelmap=True),
+                          *[loadVolume(filePath) for filePath in args.volumes],
+                          patient=args.patient, resultsPath=args.results)
+  return True
+
+#
+# Pure NumPy backend (arrays read and written with nibabel, no VTK or MRML)
+#
+
+def readVolume(filePath):
+  """ Returns the voxels of a volume file as a (z, y, x) array, in the voxel order of VTK image
+  data, and the nibabel image. Uncompressed files are memory-mapped
+  """
+  image = nibabel.load(filePath)
+  array = np.asanyarray(image.dataobj)
+  if array.ndim != 3:
+    raise ValueError('%s is not a 3D volume' % filePath)
+  return array.T, image
+
+
+def writeVolume(filePath, array, referenceImage):
+  """ Writes a (z, y, x) array with the geometry of referenceImage """
+  header = referenceImage.header.copy()
+  header.set_data_dtype(array.dtype)
+  nibabel.save(nibabel.Nifti1Image(array.T, referenceImage.affine, header), filePath)
+
+
+def flatArray(array):
+  """ Returns a (z, y, x) array flat in VTK order (a view when the array is contiguous) """
+  return np.ascontiguousarray(array).ravel()
+
+
+def numpySetVolumeScalars(args):
+  array1, image1 = readVolume(args.input1)
+  array2, image2 = readVolume(args.input2)
+  output = np.empty(array1.shape, outputScalarType(args.output_type, array1.dtype))
+  with StageTimer('CommandLine.setvolumescalars', summary='Overall Algorithm Time', voxels=array1.size):
+    combineArrays(array1, array2, output, args.slab_size, args.rule, args.parameters)
+  writeVolume(args.output, output, image1)
+  return True
+
+
+def numpyMultiVolCombine(args):
+  volumes = [readVolume(filePath) for filePath in args.inputs]
+  shape = volumes[0][0].shape
+  arrays = [flatArray(array) for array, image in volumes]
+  outputDtype = outputScalarType(args.output_type, arrays[0].dtype)
+  with StageTimer('CommandLine.multivolcombine', summary='Overall Algorithm Time', voxels=sum(array.size for array in arrays)):
+    meanArray, maxArray = reducePixelArrays(arrays, ('mean', 'max'), chunkSize=args.chunk_size,
+                                            numberOfThreads=args.threads)
+  writeVolume(args.mean_output, saturatingCast(meanArray, outputDtype).reshape(shape), volumes[0][1])
+  writeVolume(args.max_output, saturatingCast(maxArray, outputDtype).reshape(shape), volumes[0][1])
+  return True
+
+
+def sameVoxelGrid(array, image, referenceArray, referenceImage):
+  """ Returns True if two nibabel volumes share dimensions and affine (spacing, origin and directions)
+  """
+  return array.shape == referenceArray.shape and np.allclose(image.affine, referenceImage.affine, atol=1e-4)
+
+
+def numpyRegionCNR(args):
+  labelArray, labelImage = readVolume(args.label)
+  dimensions = labelArray.shape[::-1]
+  # nibabel affines map voxel (i, j, k) to RAS like the IJK to RAS matrix of a volume node
+  lesionMask, symmetricMask = lesionAndSymmetricMasks(flatArray(labelArray), dimensions, labelImage.affine)
+  rows = []
+  with StageTimer('CommandLine.regioncnr', summary='Overall Algorithm Time'):
+    for filePath in args.volumes:
+      grayscaleArray, image = readVolume(filePath)
+      if not sameVoxelGrid(grayscaleArray, image, labelArray, labelImage):
+        raise ValueError('%s does not match the lesion label geometry' % filePath)
+      grayscaleArray = flatArray(grayscaleArray)
+      rows.extend(cnrRows(args.patient, volumeName(filePath), 'lesion', maskedStatistics(grayscaleArray, lesionMask),
+                          'symmetric', maskedStatistics(grayscaleArray, symmetricMask)))
+  with ResultsStore(args.results) as resultsStore:
+    resultsStore.Append(rows)
+  return True
+
+
+def numpyCGCNR(args):
+  urethraArray, urethraImage = readVolume(args.urethra_label)
+  cgArray, cgImage = readVolume(args.cg_label)
+  if not sameVoxelGrid(cgArray, cgImage, urethraArray, urethraImage):
+    raise ValueError('The urethra and CG labels do not share one voxel grid')
+  urethraIndices = labelIndices(flatArray(urethraArray))
+  cgIndices = labelIndices(flatArray(cgArray))
+  rows = []
+  with StageTimer('CommandLine.cgcnr', summary='Overall Algorithm Time'):
+    for filePath in args.volumes:
+      grayscaleArray, image = readVolume(filePath)
+      if not sameVoxelGrid(grayscaleArray, image, urethraArray, urethraImage):
+        raise ValueError('%s does not match the label geometry' % filePath)
+      grayscaleArray = flatArray(grayscaleArray)
+      rows.extend(cnrRows(args.patient, volumeName(filePath), 'urethra', maskedStatistics(grayscaleArray, urethraIndices),
+                          'cg', maskedStatistics(grayscaleArray, cgIndices)))
+  with ResultsStore(args.results) as resultsStore:
+    resultsStore.Append(rows)
+  return True
+
+
+COMMANDS = {
+  'setvolumescalars': (slicerSetVolumeScalars, numpySetVolumeScalars),
+  'multivolcombine': (slicerMultiVolCombine, numpyMultiVolCombine),
+  'visualizetimesteps': (slicerVisualizeTimesteps, None),
+  'regioncnr': (slicerRegionCNR, numpyRegionCNR),
+  'cgcnr': (slicerCGCNR, numpyCGCNR),
+  }
+
+#
+# Argument parsing
+#
+
+def ruleParameter(text):
+  name, separator, value = text.partition('=')
+  if not separator:
+    raise argparse.ArgumentTypeError('Rule parameters are given as NAME=VALUE, not %s' % text)
+  return name, float(value)
+
+
+def parseArguments(argv):
+  parser = argparse.ArgumentParser(description='Run the AssortedLabModules on volume files without the module panels')
+  parser.add_argument('--numpy', action='store_true',
+                      help='Use the pure NumPy implementation (default when Slicer is not running)')
+  parser.add_argument('--timing-log', help='Append stage timing records to this JSON lines file')
+  commands = parser.add_subparsers(dest='command')
+
+  command = commands.add_parser('setvolumescalars', help='Combine two volumes voxel by voxel')
+  command.add_argument('input1')
+  command.add_argument('input2')
+  command.add_argument('output')
+  command.add_argument('--rule', default='ratio',
+                       help='One of %s, or an expression in a and b' % ', '.join(sorted(COMBINE_RULES)))
+  command.add_argument('--parameter', dest='parameters', type=ruleParameter, action='append', default=[],
+                       metavar='NAME=VALUE', help='Value of a parameter used by the rule')
+  command.add_argument('--slab-size', type=int, default=DEFAULT_SLAB_SIZE)
+  command.add_argument('--output-type', choices=OUTPUT_TYPES, default='input',
+                       help='Scalar type of the output, integer types saturate (default: type of input1)')
+
+  command = commands.add_parser('multivolcombine', help='Mean and maximum projection of any number of volumes')
+  command.add_argument('inputs', nargs='+')
+  command.add_argument('--mean-output', required=True)
+  command.add_argument('--max-output', required=True)
+  command.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+  command.add_argument('--threads', type=int, default=None, help='Threads the chunks are reduced on (default: one per core)')
+  command.add_argument('--output-type', choices=OUTPUT_TYPES, default='input',
+                       help='Scalar type of the outputs, integer types saturate (default: type of the first input)')
+
+  command = commands.add_parser('visualizetimesteps', help='Load, center and transform the timesteps of a patient and save them')
+  command.add_argument('patient')
+  command.add_argument('--output-directory', required=True)
+  command.add_argument('--timestep-directory', help='Timestep directory pattern with %%s for the patient number')
+  command.add_argument('--extension', default='.nii.gz')
+  command.add_argument('--no-cache', action='store_true', help='Do not use the local timestep cache')
+
+  command = commands.add_parser('regioncnr', help='CNR of a lesion against its mirrored region')
+  command.add_argument('label', nargs='?')
+  command.add_argument('volumes', nargs='*')
+  command.add_argument('--results', required=True, help='CSV results table')
+  command.add_argument('--patient', default='')
+  command.add_argument('--batch', nargs='+', metavar='PATIENT', help='Process a cohort from the file server')
+  command.add_argument('--lesion-label-pattern', help='Lesion label path with %%s for the patient number (--batch)')
+  command.add_argument('--timestep-directory', help='Timestep directory pattern with %%s for the patient number (--batch)')
+  command.add_argument('--processes', type=int)
+
+  command = commands.add_parser('cgcnr', help='CNR of the urethra against the central gland')
+  command.add_argument('urethra_label')
+  command.add_argument('cg_label')
+  command.add_argument('volumes', nargs='+')
+  command.add_argument('--results', required=True, help='CSV results table')
+  command.add_argument('--patient', default='')
+
+  args = parser.parse_args(argv)
+  if args.command == 'setvolumescalars':
+    args.parameters = dict(args.parameters)
+  if args.command == 'regioncnr':
+    if args.batch and not args.lesion_label_pattern:
+      parser.error('--batch needs --lesion-label-pattern')
+    if not args.batch and not (args.label and args.volumes):
+      parser.error('regioncnr needs a lesion label and at least one volume, or --batch')
+  return args
+
+
+def main(argv):
+  args = parseArguments(argv)
+  if args.timing_log:
+    configure(logPath=args.timing_log)
+
+  slicerCommand, numpyCommand = COMMANDS[args.command]
+  useNumpy = args.numpy or not slicerAvailable()
+  if useNumpy:
+    if numpyCommand is None or (args.command == 'regioncnr' and args.batch):
+      sys.stderr.write('%s needs Slicer, run it with Slicer --no-main-window --python-script\n' % args.command)
+      return 1
+    if nibabel is None:
+      sys.stderr.write('The NumPy path reads volumes with nibabel, install it or run inside Slicer\n')
+      return 1
+
+  try:
+    succeeded = (numpyCommand if useNumpy else slicerCommand)(args)
+  except (IOError, OSError, ValueError) as error:
+    logging.error('%s failed: %s' % (args.command, error))
+    return 1
+  return 0 if succeeded else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,82 @@
+import vtk
+from .Scene import SceneBatch
+
+#
+# Batched geometry updates of volume nodes
+#
+# Changing the origin and then applying a transform matrix node by node sets the IJK to RAS
+# matrix twice per node, and every change fires its own modified events, observer updates
+# and slice view renders. Here the new IJK to RAS matrix is computed once per group of
+# nodes that share a geometry, and all nodes are updated in one pass with the scene in
+# batch processing state, so views and observers refresh once.
+#
+
+
+def getIJKToRAS(volumeNode):
+  matrix = vtk.vtkMatrix4x4()
+  volumeNode.GetIJKToRASMatrix(matrix)
+  return matrix
+
+
+def geometryKey(volumeNode):
+  """ Returns a hashable description of the dimensions and IJK to RAS matrix of a volume node.
+  Nodes with equal keys get the same geometry update
+  """
+  imageData = volumeNode.GetImageData()
+  dimensions = tuple(imageData.GetDimensions()) if imageData else None
+  matrix = getIJKToRAS(volumeNode)
+  return dimensions, tuple(round(matrix.GetElement(row, column), 6) for row in range(4) for column in range(4))
+
+
+def diagonalMatrix(*diagonal):
+  """ Returns the 4x4 matrix with the given diagonal entries, e.g. diagonalMatrix(-1, 1, 1) for a L/R flip
+  """
+  matrix = vtk.vtkMatrix4x4()
+  for index, value in enumerate(diagonal):
+    matrix.SetElement(index, index, value)
+  return matrix
+
+
+def centeredOrigin(volumeNode):
+  """ Returns the origin that centers a volume from its image size and spacing (the IJK to RAS origin
+  the timestep volumes are given in VisualizeTimesteps)
+  """
+  extent = [x-1 for x in volumeNode.GetImageData().GetDimensions()] # subtract 1 from dimensions to get extent
+  spacing = [x for x in volumeNode.GetSpacing()]
+  origin = [a*b/2 for a,b in zip(extent,spacing)]
+  origin[2] = -origin[2] # need to make this value negative to center the volume
+  return origin
+
+
+def updatedIJKToRAS(volumeNode, origin=None, transformMatrix=None):
+  """ Returns the IJK to RAS matrix of the node after setting its origin (a list, or a function of the
+  node such as centeredOrigin) and then applying transformMatrix, as ApplyTransformMatrix would
+  """
+  matrix = getIJKToRAS(volumeNode)
+  if origin is not None:
+    if callable(origin):
+      origin = origin(volumeNode)
+    for row in range(3):
+      matrix.SetElement(row, 3, origin[row])
+  if transformMatrix is not None:
+    transformed = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(transformMatrix, matrix, transformed)
+    matrix = transformed
+  return matrix
+
+
+def applyGeometry(volumeNodes, origin=None, transformMatrix=None):
+  """ Sets the origin of all volume nodes and then applies transformMatrix to them. The new IJK to RAS
+  matrix is computed once per shared geometry and set on all nodes in one scene batch
+  """
+  volumeNodes = list(volumeNodes)
+  keys = [geometryKey(volumeNode) for volumeNode in volumeNodes]
+  matrices = {}
+  for volumeNode, key in zip(volumeNodes, keys):
+    if key not in matrices:
+      matrices[key] = updatedIJKToRAS(volumeNode, origin, transformMatrix)
+
+  scene = volumeNodes[0].GetScene() if volumeNodes else None
+  with SceneBatch(scene, enabled=len(volumeNodes) > 1):
+    for volumeNode, key in zip(volumeNodes, keys):
+      volumeNode.SetIJKToRASMatrix(matrices[key])
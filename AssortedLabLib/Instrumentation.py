@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import time
+import socket
+import cProfile
+import functools
+import threading
+import collections
+try:
+  import resource
+except ImportError: # not available on Windows
+  resource = None
+
+#
+# Stage timing shared by all Logic classes
+#
+# Every timed stage produces one record with wall time, CPU time, resident memory growth
+# and the number of voxels it processed. Records are kept in memory (see getRecords) and,
+# when a log path is configured, appended to a JSON lines file so production runs can
+# be collected and aggregated. With a profile directory configured, every outermost
+# stage is also captured with cProfile.
+#
+# Stages run on the thread that starts them. Work a stage hands to worker threads is
+# wrapped with workerTimed, which adds its time to the workerSeconds of the stage instead
+# of starting stages (and profilers) on the workers.
+#
+# Memory growth is the change of the current resident set size over the stage (rssDeltaMB,
+# from /proc, None where it is not available). The process high-water mark (peakRSSMB) is
+# recorded as an absolute value, a stage that stays below an earlier peak does not move it.
+#
+# The log path and profile directory default to the ASSORTEDLAB_TIMING_LOG and
+# ASSORTEDLAB_PROFILE_DIR environment variables.
+#
+
+_settings = {
+  'logPath': os.environ.get('ASSORTEDLAB_TIMING_LOG'),
+  'profileDirectory': os.environ.get('ASSORTEDLAB_PROFILE_DIR'),
+  }
+_records = collections.deque(maxlen=10000)
+_recordsLock = threading.Lock()
+_activeStages = threading.local()
+_unchanged = object()
+
+
+def configure(logPath=_unchanged, profileDirectory=_unchanged):
+  """ Sets where stage records are written (JSON lines) and where cProfile captures are saved.
+  Settings that are not passed are kept, pass None to turn one off
+  """
+  if logPath is not _unchanged:
+    _settings['logPath'] = logPath
+  if profileDirectory is not _unchanged:
+    _settings['profileDirectory'] = profileDirectory
+
+
+def getRecords(stage=None):
+  """ Returns the stage records of this session, optionally only those of one stage """
+  with _recordsLock:
+    return [record for record in _records if stage is None or record['stage'] == stage]
+
+
+def clearRecords():
+  with _recordsLock:
+    _records.clear()
+
+
+def recordVoxels(numberOfVoxels):
+  """ Adds to the number of voxels processed by the innermost running stage of this thread """
+  stack = getattr(_activeStages, 'stack', None)
+  if stack:
+    stack[-1].voxels += int(numberOfVoxels)
+
+
+def currentStage():
+  """ Returns the innermost running StageTimer of this thread, or None """
+  stack = getattr(_activeStages, 'stack', None)
+  return stack[-1] if stack else None
+
+
+def workerTimed(function, stage=None):
+  """ Wraps a function that a stage runs on worker threads. The wall time of every call is added to
+  the workerSeconds of stage (the running stage of the calling thread by default) """
+  if stage is None:
+    stage = currentStage()
+  @functools.wraps(function)
+  def wrapper(*args, **kwargs):
+    start = time.time()
+    try:
+      return function(*args, **kwargs)
+    finally:
+      if stage is not None:
+        stage.AddWorkerSeconds(time.time() - start)
+  return wrapper
+
+
+def _cpuSeconds():
+  times = os.times()
+  return times[0] + times[1]
+
+
+def _currentRSSMB():
+  """ Returns the current resident set size, or None where /proc is not available """
+  try:
+    with open('/proc/self/statm') as statm:
+      return int(statm.read().split()[1]) * resource.getpagesize() / 1024.0**2
+  except (IOError, OSError, AttributeError):
+    return None
+
+
+def _peakRSSMB():
+  if resource is None:
+    return 0.0
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+  return peak / 1024.0**2 if sys.platform == 'darwin' else peak / 1024.0
+
+
+class StageTimer(object):
+  """ Context manager that times one stage of a computation.
+
+  If message is given it is printed when the stage starts and 'done (x s)' when it ends,
+  like the Slicer console output of the modules. If summary is given, '<summary>: x seconds'
+  is printed at the end instead.
+
+  A detached stage is not nested in the stages of its thread and is never profiled, so it can
+  span several event loop callbacks (e.g. a background load), started with Start and ended
+  with Stop.
+  """
+
+  def __init__(self, stage, message=None, summary=None, voxels=0, detached=False):
+    self.stage = stage
+    self.message = message
+    self.summary = summary
+    self.voxels = voxels
+    self.detached = detached
+    self.workerSeconds = 0.0
+    self.workerLock = threading.Lock()
+    self.record = None
+    self.profiler = None
+
+  def __enter__(self):
+    if self.detached:
+      self.parent = None
+    else:
+      stack = getattr(_activeStages, 'stack', None)
+      if stack is None:
+        stack = _activeStages.stack = []
+      self.parent = stack[-1].stage if stack else None
+      stack.append(self)
+
+    if self.message:
+      sys.stdout.write(self.message)
+      sys.stdout.flush()
+
+    # Only outermost stages are profiled, cProfile cannot nest
+    if _settings['profileDirectory'] and self.parent is None and not self.detached:
+      self.profiler = cProfile.Profile()
+      self.profiler.enable()
+
+    self.startRSS = _currentRSSMB()
+    self.startCPU = _cpuSeconds()
+    self.startWall = time.time()
+    return self
+
+  def __exit__(self, exceptionType, exceptionValue, traceback):
+    wallSeconds = time.time() - self.startWall
+    cpuSeconds = _cpuSeconds() - self.startCPU
+    endRSS = _currentRSSMB()
+    rssDelta = endRSS - self.startRSS if endRSS is not None and self.startRSS is not None else None
+
+    if self.profiler is not None:
+      self.profiler.disable()
+      self.dumpProfile()
+
+    if not self.detached:
+      _activeStages.stack.pop()
+
+    self.record = {
+      'stage': self.stage,
+      'parent': self.parent,
+      'timestamp': self.startWall,
+      'wallSeconds': wallSeconds,
+      'cpuSeconds': cpuSeconds,
+      'rssDeltaMB': rssDelta,
+      'peakRSSMB': _peakRSSMB(),
+      'voxels': self.voxels,
+      'workerSeconds': self.workerSeconds,
+      'voxelsPerSecond': self.voxels / wallSeconds if self.voxels and wallSeconds > 0 else None,
+      'host': socket.gethostname(),
+      'pid': os.getpid(),
+      'error': repr(exceptionValue) if exceptionType is not None else None,
+      }
+    self.emit()
+
+    if self.message:
+      print(' done (%0.2f s)' % wallSeconds)
+    if self.summary:
+      print('%s: % 0.1f seconds' % (self.summary, wallSeconds))
+    return False
+
+  def Start(self):
+    """ Starts the stage outside a with block """
+    return self.__enter__()
+
+  def Stop(self, error=None):
+    """ Ends a stage started with Start, recording error if given """
+    self.__exit__(type(error) if error is not None else None, error, None)
+
+  def AddWorkerSeconds(self, seconds):
+    """ Adds time spent on worker threads for this stage (see workerTimed) """
+    with self.workerLock:
+      self.workerSeconds += seconds
+
+  @property
+  def seconds(self):
+    return self.record['wallSeconds'] if self.record else time.time() - self.startWall
+
+  def emit(self):
+    with _recordsLock:
+      _records.append(self.record)
+    logPath = _settings['logPath']
+    if logPath:
+      try:
+        with open(logPath, 'a') as logFile:
+          logFile.write(json.dumps(self.record) + '\n')
+      except (IOError, OSError) as error:
+        sys.stderr.write('Could not write timing record to %s: %s\n' % (logPath, error))
+
+  def dumpProfile(self):
+    profileDirectory = _settings['profileDirectory']
+    try:
+      if not os.path.isdir(profileDirectory):
+        os.makedirs(profileDirectory)
+      fileName = '%s-%s-%d.prof' % (self.stage, time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+      self.profiler.dump_stats(os.path.join(profileDirectory, fileName))
+    except (IOError, OSError) as error:
+      sys.stderr.write('Could not save profile of %s: %s\n' % (self.stage, error))
+
+
+def timedStage(message=None, summary=None, stage=None):
+  """ Decorator that runs a Logic method inside a StageTimer. The stage is named
+  <class>.<method> unless a stage name is given
+  """
+  def decorator(function):
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+      stageName = stage or '%s.%s' % (self.__class__.__name__, function.__name__)
+      with StageTimer(stageName, message, summary):
+        return function(self, *args, **kwargs)
+    return wrapper
+  return decorator
@@ -0,0 +1,239 @@
+import vtk
+import slicer
+from vtk.util import numpy_support
+from .ArrayOps import labelValueIndices, boundingBox
+from .Geometry import geometryKey
+
+#
+# Label statistics with VTK pipelines that are kept between calls
+#
+# The LabelStatistics logic (copied from Slicer 3) builds a vtkImageAccumulate to find the
+# label value, a vtkImageThreshold and vtkImageToImageStencil to turn the label into a
+# stencil, and a second vtkImageAccumulate for the statistics, and throws them away after
+# one Update. Keeping the pipeline of a label node and only re-wiring its grayscale input
+# lets VTK's demand-driven execution reuse the stencil: when only the grayscale volume
+# changes, only the stencilled accumulate runs again.
+#
+# Label values are found from an index of the nonzero voxels grouped by value, built once
+# per label modification, instead of a histogram pass over the label on every call. Label
+# maps with several values get one stencil and accumulate per value.
+#
+# Lesion and urethra labels cover a tiny part of the volume, so every label value is
+# restricted to its tight bounding box. The VTK pipelines clip label and grayscale to the
+# box (vtkImageClip without copying the data) and the NumPy masks read the grayscale
+# through a strided view of the box, so the cost scales with the region, not the volume.
+#
+# LabelStatisticsCache keeps the labels resampled to each grayscale voxel grid and their
+# pipelines for the modules, and drops them when the label voxels or its parent transform
+# change or the label leaves the scene.
+#
+
+
+class LabelStatisticsPipeline(object):
+  """ Persistent statistics pipeline of one label node (already on the grayscale voxel grid)
+  """
+
+  def __init__(self, labelNode):
+    self.labelNode = labelNode
+    self.labelIndex = None
+    self.labelIndexMTime = None
+    self.labelExtents = {}
+    self.valuePipelines = {}
+
+  def LabelIndex(self):
+    """ Returns the nonzero voxels of the label grouped by value (see labelValueIndices). Rebuilt only
+    when the label image data or its scalars were modified
+    """
+    imageData = self.labelNode.GetImageData()
+    scalars = imageData.GetPointData().GetScalars()
+    mtime = (imageData.GetMTime(), scalars.GetMTime())
+    if self.labelIndex is None or mtime != self.labelIndexMTime:
+      self.labelIndex = labelValueIndices(numpy_support.vtk_to_numpy(scalars))
+      self.labelIndexMTime = mtime
+      self.labelExtents = {}
+    return self.labelIndex
+
+  def LabelValues(self):
+    """ Returns the sorted nonzero values present in the label
+    """
+    return sorted(self.LabelIndex())
+
+  def ValuePipeline(self, labelValue):
+    """ Returns the clip, threshold, stencil and accumulate filters of one label value, built on first use
+    """
+    if labelValue not in self.valuePipelines:
+      # Label and grayscale are clipped to the bounding box of the label value, without copying
+      labelClip = vtk.vtkImageClip()
+      grayscaleClip = vtk.vtkImageClip()
+
+      thresholder = vtk.vtkImageThreshold()
+      thresholder.SetInputConnection(labelClip.GetOutputPort())
+      thresholder.SetInValue(1)
+      thresholder.SetOutValue(0)
+      thresholder.ReplaceOutOn()
+      thresholder.ThresholdBetween(labelValue, labelValue)
+      thresholder.SetOutputScalarTypeToUnsignedChar()
+
+      # use vtk's statistics class with the binary labelmap as a stencil
+      stencil = vtk.vtkImageToImageStencil()
+      stencil.SetInputConnection(thresholder.GetOutputPort())
+      stencil.ThresholdBetween(1, 1)
+
+      statistics = vtk.vtkImageAccumulate()
+      statistics.SetInputConnection(grayscaleClip.GetOutputPort())
+      statistics.SetStencilConnection(stencil.GetOutputPort())
+      self.valuePipelines[labelValue] = (labelClip, grayscaleClip, thresholder, stencil, statistics)
+    return self.valuePipelines[labelValue]
+
+  def LabelExtent(self, labelValue):
+    """ Returns the VTK extent of the bounding box of a label value, computed once per label index
+    """
+    labelIndex = self.LabelIndex()
+    if labelValue not in self.labelExtents:
+      imageData = self.labelNode.GetImageData()
+      extent = imageData.GetExtent()
+      k, j, i = boundingBox(labelIndex[labelValue], imageData.GetDimensions())
+      self.labelExtents[labelValue] = (extent[0]+i.start, extent[0]+i.stop-1, extent[2]+j.start, extent[2]+j.stop-1,
+                                       extent[4]+k.start, extent[4]+k.stop-1)
+    return self.labelExtents[labelValue]
+
+  def Compute(self, grayscaleNode, labelValue=None):
+    """ Updates the pipeline of one label value (the largest one by default) for a grayscale volume
+    and returns its statistics vtkImageAccumulate (GetVoxelCount, GetMin, GetMax, GetMean,
+    GetStandardDeviation), or None if the label is empty
+    """
+    labelValues = self.LabelValues()
+    if labelValue is None:
+      labelValue = labelValues[-1] if labelValues else None
+    if labelValue not in labelValues:
+      return None
+    labelClip, grayscaleClip, thresholder, stencil, statistics = self.ValuePipeline(labelValue)
+    labelExtent = self.LabelExtent(labelValue)
+    for clip in (labelClip, grayscaleClip):
+      clip.SetOutputWholeExtent(labelExtent)
+      clip.ClipDataOff()
+    labelClip.SetInputConnection(self.labelNode.GetImageDataConnection())
+    grayscaleClip.SetInputConnection(grayscaleNode.GetImageDataConnection())
+    statistics.Update()
+    return statistics
+
+  def ComputeAll(self, grayscaleNode):
+    """ Returns a dictionary of statistics (Count, Min, Max, Mean, StdDev) for every label value present
+    """
+    labelStats = {}
+    for labelValue in self.LabelValues():
+      statistics = self.Compute(grayscaleNode, labelValue)
+      labelStats[labelValue] = {
+        "Count": statistics.GetVoxelCount(),
+        "Min": statistics.GetMin()[0],
+        "Max": statistics.GetMax()[0],
+        "Mean": statistics.GetMean()[0],
+        "StdDev": statistics.GetStandardDeviation()[0],
+        }
+    # Drop pipelines of values that are no longer in the label
+    for labelValue in set(self.valuePipelines) - set(labelStats):
+      del self.valuePipelines[labelValue]
+    return labelStats
+
+
+class LabelStatisticsCache(object):
+  """ Label nodes resampled to the voxel grids of grayscale volumes and their statistics pipelines,
+  kept across calls and runs. Entries of a label are dropped when its voxels or transform are modified or
+  it is removed
+  """
+
+  def __init__(self, scene=None):
+    self.scene = scene or slicer.mrmlScene
+
+    # Label nodes resampled to a reference geometry, keyed on (label node ID, geometryKey of the label and of
+    # the reference), so a changed label geometry gets a new entry without observing every node change
+    self.resampledLabels = {}
+    self.labelObserverTags = {}
+    self.sceneObserverTags = None
+
+    # Statistics pipelines kept per label node on a grayscale grid, keyed on its node ID
+    self.pipelines = {}
+
+  def LabelOnReferenceGrid(self, referenceNode, labelNode):
+    """ Returns the label node resampled to the voxel grid of the reference volume if needed.
+    Volumes sharing a geometry (and repeated runs) reuse the same resampled label
+    """
+    cacheKey = (labelNode.GetID(), geometryKey(labelNode), geometryKey(referenceNode))
+    if cacheKey in self.resampledLabels:
+      return self.resampledLabels[cacheKey]
+
+    volumesLogic = slicer.modules.volumes.logic()
+    labelNodeOnGrid = labelNode
+    warnings = volumesLogic.CheckForLabelVolumeValidity(referenceNode, labelNode)
+    if warnings != "":
+      if 'mismatch' in warnings:
+        labelNodeOnGrid = volumesLogic.ResampleVolumeToReferenceVolume(labelNode, referenceNode)
+
+    self.Observe(labelNode)
+    self.resampledLabels[cacheKey] = labelNodeOnGrid
+    return labelNodeOnGrid
+
+  def Pipeline(self, labelNodeOnGrid):
+    """ Returns the statistics pipeline of a label node on a grayscale grid, built on first use
+    """
+    if labelNodeOnGrid.GetID() not in self.pipelines:
+      self.pipelines[labelNodeOnGrid.GetID()] = LabelStatisticsPipeline(labelNodeOnGrid)
+    return self.pipelines[labelNodeOnGrid.GetID()]
+
+  def ComputeAll(self, grayscaleNode, labelNode):
+    """ Returns the statistics of every label value of labelNode on the grayscale volume (see
+    LabelStatisticsPipeline.ComputeAll), resampling the label to the grayscale grid if needed
+    """
+    return self.Pipeline(self.LabelOnReferenceGrid(grayscaleNode, labelNode)).ComputeAll(grayscaleNode)
+
+  def Observe(self, labelNode):
+    """ Watches a cached label node so its resampled labels are dropped when it changes or is removed
+    """
+    if self.sceneObserverTags is None:
+      self.sceneObserverTags = [self.scene.AddObserver(slicer.vtkMRMLScene.NodeRemovedEvent, self.onNodeRemoved),
+                                self.scene.AddObserver(slicer.vtkMRMLScene.EndCloseEvent, self.onSceneClosed)]
+    if labelNode.GetID() not in self.labelObserverTags:
+      self.labelObserverTags[labelNode.GetID()] = (labelNode, [
+        labelNode.AddObserver(slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onLabelModified),
+        labelNode.AddObserver(slicer.vtkMRMLTransformableNode.TransformModifiedEvent, self.onLabelModified)])
+
+  def Evict(self, labelNodeID, removeResampledNodes=True):
+    """ Drops all cached resampled versions of a label node and removes them from the scene
+    """
+    self.pipelines.pop(labelNodeID, None)
+    for cacheKey in [key for key in self.resampledLabels if key[0] == labelNodeID]:
+      labelNodeOnGrid = self.resampledLabels.pop(cacheKey)
+      self.pipelines.pop(labelNodeOnGrid.GetID(), None)
+      if removeResampledNodes and labelNodeOnGrid.GetID() != labelNodeID and labelNodeOnGrid.GetScene():
+        self.scene.RemoveNode(labelNodeOnGrid)
+    if labelNodeID in self.labelObserverTags:
+      labelNode, tags = self.labelObserverTags.pop(labelNodeID)
+      for tag in tags:
+        labelNode.RemoveObserver(tag)
+
+  def Clear(self, removeResampledNodes=True):
+    """ Empties the cache and stops observing the scene
+    """
+    for labelNodeID in set(key[0] for key in self.resampledLabels) | set(self.labelObserverTags):
+      self.Evict(labelNodeID, removeResampledNodes)
+    self.pipelines.clear()
+    if self.sceneObserverTags is not None:
+      for tag in self.sceneObserverTags:
+        self.scene.RemoveObserver(tag)
+      self.sceneObserverTags = None
+
+  def onLabelModified(self, labelNode, event):
+    self.Evict(labelNode.GetID())
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeRemoved(self, scene, event, removedNode):
+    # Forget a label whose node was removed, or whose resampled copy was removed by the user
+    for cacheKey, labelNodeOnGrid in list(self.resampledLabels.items()):
+      if cacheKey[0] == removedNode.GetID():
+        self.Evict(cacheKey[0], removeResampledNodes=True)
+      elif labelNodeOnGrid is removedNode:
+        del self.resampledLabels[cacheKey]
+    self.pipelines.pop(removedNode.GetID(), None)
+
+  def onSceneClosed(self, scene, event):
+    self.Clear(removeResampledNodes=False)
@@ -0,0 +1,106 @@
+import io
+import os
+import sys
+import csv
+
+#
+# CNR results tables
+#
+# Every region of every volume is one row. The lesion (or urethra) row carries the CNR
+# against the background region, |mean lesion - mean background| / std background.
+# Rows are appended to a CSV file through a buffer, so cohort runs write thousands of
+# rows in a few large writes.
+#
+
+RESULTS_FIELDS = ['patient','volume','region','count','mean','std','min','max','cnr']
+
+
+def contrastToNoise(regionStats, backgroundStats):
+  """ Returns |mean region - mean background| / std background, or None if the background has no spread
+  """
+  if not backgroundStats["StdDev"] > 0:
+    return None
+  return abs(regionStats["Mean"]-backgroundStats["Mean"])/backgroundStats["StdDev"]
+
+
+def cnrRows(patient, volume, region, regionStats, background, backgroundStats):
+  """ Returns the result rows of a region and its background in one volume. regionStats and
+  backgroundStats are statistics dictionaries (Count, Min, Max, Mean, StdDev)
+  """
+  cnr = contrastToNoise(regionStats, backgroundStats)
+  rows = []
+  for name, stats, rowCNR in ((region, regionStats, cnr), (background, backgroundStats, None)):
+    rows.append({'patient': patient, 'volume': volume, 'region': name,
+                 'count': stats["Count"], 'mean': stats["Mean"], 'std': stats["StdDev"],
+                 'min': stats["Min"], 'max': stats["Max"], 'cnr': '' if rowCNR is None else rowCNR})
+  return rows
+
+
+def _openCsv(path):
+  """ Opens a CSV file for appending, in binary mode on Python 2 and as text without newline
+  translation on Python 3, as the csv module expects on each
+  """
+  if sys.version_info[0] < 3:
+    return open(path, 'ab')
+  return io.open(path, 'a', newline='')
+
+
+def printCNRResults(volumeName, *stats):
+  """ Prints the statistics and CNR computed for one volume to the Slicer console
+  """
+  print('Printing results for:  %s' % volumeName)
+  for stat in stats:
+    print(stat)
+
+
+def writeResults(rows, resultsPath):
+  """ Appends result rows (see cnrRows) to a CSV results table
+  """
+  with ResultsStore(resultsPath) as resultsStore:
+    resultsStore.Append(rows)
+
+
+class ResultsStore(object):
+  """ Appends result rows to a CSV file. Rows are buffered and written bufferSize rows at a time,
+  and the header is written when the file is new or empty. Use as a context manager or call Close
+  """
+
+  def __init__(self, path, fields=RESULTS_FIELDS, bufferSize=1024, append=True):
+    self.path = path
+    self.fields = fields
+    self.bufferSize = bufferSize
+    self.rows = []
+    self.numberOfRows = 0
+    if not append and os.path.exists(path):
+      os.remove(path)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exceptionType, exceptionValue, traceback):
+    self.Close()
+    return False
+
+  def Append(self, rows):
+    """ Adds rows (dictionaries with the store fields) and writes them once the buffer is full
+    """
+    self.rows.extend(rows)
+    if len(self.rows) >= self.bufferSize:
+      self.Flush()
+
+  def Flush(self):
+    """ Writes the buffered rows to the file
+    """
+    if not self.rows:
+      return
+    writeHeader = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+    with _openCsv(self.path) as outputFile:
+      writer = csv.DictWriter(outputFile, fieldnames=self.fields, extrasaction='ignore')
+      if writeHeader:
+        writer.writeheader()
+      writer.writerows(self.rows)
+    self.numberOfRows += len(self.rows)
+    self.rows = []
+
+  def Close(self):
+    self.Flush()
@@ -0,0 +1,77 @@
+import functools
+from .Instrumentation import StageTimer
+
+#
+# Scene batch processing for bulk module runs
+#
+# Cloning, transforming and window/levelling many nodes fires MRML modified events and slice
+# view renders for every single change. Inside a SceneBatch the scene is in batch processing
+# state and (optionally) rendering is paused, so observers and views update once at the end.
+#
+
+
+def _application():
+  """ Returns the Slicer application, or None when running without one (pure Python use)
+  """
+  try:
+    import slicer
+  except ImportError:
+    return None
+  return getattr(slicer, 'app', None)
+
+
+class SceneBatch(object):
+  """ Context manager that keeps the scene in batch processing state (StartState/EndState). With
+  pauseRender, rendering is paused too (on Slicer versions that support it) and all views are
+  rendered once at the end. Nothing is done when enabled is False or there is no scene
+  """
+
+  def __init__(self, scene=None, pauseRender=False, enabled=True):
+    if scene is None and enabled:
+      application = _application()
+      scene = application.mrmlScene() if application is not None and hasattr(application, 'mrmlScene') else None
+    self.scene = scene if enabled else None
+    self.application = _application() if pauseRender and self.scene is not None else None
+    self.renderPaused = False
+
+  def __enter__(self):
+    if self.scene is not None:
+      self.scene.StartState(self.scene.BatchProcessState)
+    if self.application is not None and hasattr(self.application, 'pauseRender'):
+      self.application.pauseRender()
+      self.renderPaused = True
+    return self
+
+  def __exit__(self, exceptionType, exceptionValue, traceback):
+    if self.scene is None:
+      return False
+    with StageTimer('SceneBatch.refresh'):
+      self.scene.EndState(self.scene.BatchProcessState)
+      if self.renderPaused:
+        self.application.resumeRender()
+        self.renderPaused = False
+        self.RenderAllViews()
+    return False
+
+  def RenderAllViews(self):
+    """ Renders every slice and 3D view once
+    """
+    layoutManager = self.application.layoutManager() if hasattr(self.application, 'layoutManager') else None
+    if layoutManager is None:
+      return
+    for sliceViewName in layoutManager.sliceViewNames():
+      layoutManager.sliceWidget(sliceViewName).sliceView().forceRender()
+    for threeDViewIndex in range(layoutManager.threeDViewCount):
+      layoutManager.threeDWidget(threeDViewIndex).threeDView().forceRender()
+
+
+def batchedScene(pauseRender=True):
+  """ Decorator that runs a Logic method inside a SceneBatch on the application scene
+  """
+  def decorator(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      with SceneBatch(pauseRender=pauseRender):
+        return function(*args, **kwargs)
+    return wrapper
+  return decorator
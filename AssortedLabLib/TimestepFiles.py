@@ -0,0 +1,38 @@
+import os
+import re
+import glob
+
+#
+# ARFI timestep files on the file server
+#
+# Every patient has one directory of compressed NIfTI timesteps named like
+# avolume_ts3_737_370_366.nii.gz. The directory is a pattern with one %s for the patient
+# number, so other studies or local copies can be used instead of the file server.
+#
+
+TIMESTEP_DIRECTORY = '/luscinia/ProstateStudy/invivo/Patient%s/loupas'
+TIMESTEP_PATTERN = 'avolume_ts*.nii.gz'
+
+
+def timestepNumber(filePath):
+  """ Returns the timestep number encoded in a file name like avolume_ts3_737_370_366.nii.gz
+  """
+  match = re.search(r'_ts(\d+)', os.path.basename(filePath))
+  return int(match.group(1)) if match else 0
+
+
+def timestepName(filePath):
+  """ Returns the node name for a timestep file (file name without the .nii.gz extension)
+  """
+  fileName = os.path.basename(filePath)
+  for extension in ('.gz', '.nii'):
+    if fileName.endswith(extension):
+      fileName = fileName[:-len(extension)]
+  return fileName
+
+
+def findTimestepFiles(patientNumber, timestepDirectory=TIMESTEP_DIRECTORY):
+  """ Returns the paths of all ARFI timestep volumes for a patient, sorted by timestep number
+  """
+  filePaths = glob.glob(os.path.join(timestepDirectory % patientNumber, TIMESTEP_PATTERN))
+  return sorted(filePaths, key=timestepNumber)
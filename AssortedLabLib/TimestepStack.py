@@ -0,0 +1,90 @@
+import numpy as np
+from .ArrayOps import DEFAULT_CHUNK_SIZE, reducePixelArrays
+
+#
+# Timesteps of one ARFI acquisition as a single 4D array
+#
+# The timesteps share one voxel grid, so they are kept in one contiguous (t, z, y, x) array
+# instead of one buffer per volume node. Every timestep is a contiguous view of the stack that
+# volume nodes can use as their scalars without a copy (see VolumeOps.stackVolumes), and temporal
+# operations (projections, temporal averages, time to peak) are reductions over the time axis of
+# one array. The geometry stays on the volume nodes, which all share it.
+#
+
+
+class TimestepStack(object):
+  """ Equally sized timesteps in one contiguous (t, z, y, x[, components]) array
+  """
+
+  def __init__(self, array, names=None):
+    if array.ndim < 4:
+      raise ValueError('A timestep stack needs a (t, z, y, x) array, got shape %s' % (array.shape,))
+    self.array = np.ascontiguousarray(array)
+    if names is None:
+      names = ['ts%d' % (index+1) for index in range(len(self.array))]
+    if len(names) != len(self.array):
+      raise ValueError('A timestep stack needs one name per timestep')
+    self.names = list(names)
+
+  @classmethod
+  def FromArrays(cls, arrays, names=None):
+    """ Copies equally sized (z, y, x[, components]) arrays into a new stack, in the scalar type
+    of the first array
+    """
+    arrays = list(arrays)
+    if len(arrays) == 0:
+      raise ValueError('At least one timestep is required')
+    for array in arrays[1:]:
+      if array.shape != arrays[0].shape:
+        raise ValueError('All timesteps must be the same size')
+    stack = np.empty((len(arrays),)+arrays[0].shape, arrays[0].dtype)
+    for index, array in enumerate(arrays):
+      stack[index] = array
+    return cls(stack, names)
+
+  def __len__(self):
+    return len(self.array)
+
+  @property
+  def shape(self):
+    """ Shape of one timestep """
+    return self.array.shape[1:]
+
+  def Timestep(self, index):
+    """ Returns one timestep as a contiguous view of the stack """
+    return self.array[index]
+
+  def Indices(self, timesteps=None):
+    """ Returns the stack indices of the selected timesteps (all timesteps for None) """
+    if timesteps is None:
+      return list(range(len(self)))
+    indices = list(timesteps)
+    for index in indices:
+      if not 0 <= index < len(self):
+        raise ValueError('Timestep index %d is outside the stack of %d timesteps' % (index, len(self)))
+    return indices
+
+  def Project(self, reductions=('max',), timesteps=None, weights=None, chunkSize=None, numberOfThreads=None):
+    """ Reduces the selected timesteps over time with each of the requested reductions (see
+    ArrayOps.reducePixelArrays, e.g. 'max' for the maximum projection, 'mean' for the temporal
+    average). Returns one array of the timestep shape per reduction
+    """
+    arrays = [self.array[index].reshape(-1) for index in self.Indices(timesteps)]
+    outputs = reducePixelArrays(arrays, reductions, weights, chunkSize, numberOfThreads)
+    return [output.reshape(self.shape) for output in outputs]
+
+  def TimeToPeak(self, timesteps=None, chunkSize=None):
+    """ Returns, for every voxel, the stack index of the selected timestep with the largest value
+    (the first one on ties). The time axis is reduced chunkSize voxels at a time, so only one
+    chunk of the stack is ever transposed
+    """
+    indices = np.array(self.Indices(timesteps))
+    if chunkSize is None:
+      chunkSize = DEFAULT_CHUNK_SIZE
+    flatStack = self.array.reshape(len(self), -1)
+    numberOfVoxels = flatStack.shape[1]
+    output = np.empty(numberOfVoxels, np.min_scalar_type(len(self)-1))
+    for chunkStart in range(0, numberOfVoxels, chunkSize):
+      chunk = slice(chunkStart, min(chunkStart+chunkSize, numberOfVoxels))
+      output[chunk] = indices[flatStack[indices, chunk].argmax(axis=0)]
+    return output.reshape(self.shape)
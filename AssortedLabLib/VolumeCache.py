@@ -0,0 +1,136 @@
+import os
+import json
+import errno
+import hashlib
+import logging
+import numpy as np
+
+#
+# Local on-disk cache of uncompressed volumes
+#
+# Every entry is a raw array file (<key>.raw) with a JSON header (<key>.json) holding the
+# array layout and the IJK to RAS matrix. Cached arrays are memory-mapped copy-on-write, so
+# loading an entry reads only the pages that are touched and never decompresses or copies
+# the whole file. The cache is bounded in size and evicts the least recently used entries.
+#
+# The cache size defaults to the ASSORTEDLAB_CACHE_SIZE_MB environment variable.
+#
+
+DEFAULT_CACHE_SIZE_MB = 8 * 1024
+
+
+class VolumeCache(object):
+  """ Size-bounded LRU cache of uncompressed volume arrays keyed by their source file
+  """
+
+  def __init__(self, directory, maximumSizeMB=None):
+    self.directory = directory
+    if maximumSizeMB is None:
+      maximumSizeMB = float(os.environ.get('ASSORTEDLAB_CACHE_SIZE_MB', DEFAULT_CACHE_SIZE_MB))
+    self.maximumBytes = int(maximumSizeMB * 1024**2)
+
+  def Key(self, sourcePath):
+    """ Returns the cache key of a source file. The key changes when the file is rewritten,
+    so stale entries are never returned
+    """
+    status = os.stat(sourcePath)
+    identity = '%s|%d|%d' % (os.path.abspath(sourcePath), status.st_size, int(status.st_mtime))
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+  def Paths(self, key):
+    return os.path.join(self.directory, key+'.raw'), os.path.join(self.directory, key+'.json')
+
+  def Load(self, sourcePath):
+    """ Returns (array, header) for a cached source file, or None on a cache miss. The array is
+    a copy-on-write memory map shaped (k, j, i, components)
+    """
+    try:
+      rawPath, headerPath = self.Paths(self.Key(sourcePath))
+      with open(headerPath) as headerFile:
+        header = json.load(headerFile)
+      array = np.memmap(rawPath, dtype=np.dtype(str(header['dtype'])), mode='c', shape=tuple(header['shape']))
+      os.utime(headerPath, None) # mark as recently used
+    except (IOError, OSError, ValueError, KeyError):
+      return None
+    return array, header
+
+  def Store(self, sourcePath, array, ijkToRAS):
+    """ Adds an array read from sourcePath to the cache and evicts the least recently used entries
+    if the cache grew beyond its size. Returns False if the entry could not be written
+    """
+    if array.nbytes > self.maximumBytes:
+      return False
+    key = self.Key(sourcePath)
+    rawPath, headerPath = self.Paths(key)
+    header = {
+      'source': os.path.abspath(sourcePath),
+      'dtype': array.dtype.str,
+      'shape': list(array.shape),
+      'ijkToRAS': [float(x) for x in ijkToRAS],
+      }
+    try:
+      # Entries are stored from several worker threads at once, another one may create the directory first
+      try:
+        os.makedirs(self.directory)
+      except OSError as error:
+        if error.errno != errno.EEXIST:
+          raise
+      # Write under temporary names so a partly written entry is never loaded
+      np.ascontiguousarray(array).tofile(rawPath+'.tmp')
+      with open(headerPath+'.tmp', 'w') as headerFile:
+        json.dump(header, headerFile)
+      os.rename(rawPath+'.tmp', rawPath)
+      os.rename(headerPath+'.tmp', headerPath)
+    except (IOError, OSError) as error:
+      logging.warning('Could not cache %s: %s' % (sourcePath, error))
+      self.Remove(key)
+      return False
+    self.Evict(keep=key)
+    return True
+
+  def Entries(self):
+    """ Returns (lastUsed, bytes, key) of every cache entry, least recently used first
+    """
+    entries = []
+    if not os.path.isdir(self.directory):
+      return entries
+    for fileName in os.listdir(self.directory):
+      if not fileName.endswith('.json'):
+        continue
+      key = fileName[:-len('.json')]
+      rawPath, headerPath = self.Paths(key)
+      try:
+        entries.append((os.path.getmtime(headerPath), os.path.getsize(rawPath), key))
+      except OSError:
+        continue
+    return sorted(entries)
+
+  def Evict(self, keep=None):
+    """ Removes least recently used entries until the cache fits its maximum size
+    """
+    entries = self.Entries()
+    totalBytes = sum(size for lastUsed, size, key in entries)
+    for lastUsed, size, key in entries:
+      if totalBytes <= self.maximumBytes:
+        break
+      if key == keep:
+        continue
+      if self.Remove(key):
+        totalBytes -= size
+
+  def Remove(self, key):
+    """ Deletes one cache entry. Returns False if it is still in use (memory-mapped files cannot
+    be deleted on Windows)
+    """
+    rawPath, headerPath = self.Paths(key)
+    for path in (rawPath, headerPath, rawPath+'.tmp', headerPath+'.tmp'):
+      try:
+        os.remove(path)
+      except OSError as error:
+        if error.errno != errno.ENOENT:
+          return False
+    return True
+
+  def Clear(self):
+    for lastUsed, size, key in self.Entries():
+      self.Remove(key)
@@ -0,0 +1,254 @@
+import logging
+import numpy as np
+import vtk
+import slicer
+from vtk.util import numpy_support
+from .Instrumentation import recordVoxels
+from .ArrayOps import saturatingCast
+from .TimestepStack import TimestepStack
+from .Geometry import applyGeometry, diagonalMatrix, getIJKToRAS
+
+#
+# Volume node primitives shared by the modules
+#
+# The modules used to carry their own copies of these helpers (cloning outputs, writing a
+# NumPy result into an output volume, the L/R symmetry transform), each with its own slow
+# per-voxel or per-call pattern. Arrays handed out here are views of the VTK scalar buffers
+# shaped (z, y, x), and arrays are written back with one vectorized copy, so a speedup here
+# lands in every module at once and is benchmarked in one place.
+#
+# Outputs are not cloned from an input and then overwritten. createOutputVolume copies only the
+# geometry and display settings of the input and attaches the computed array as the scalars.
+#
+
+
+def hasImageData(volumeNode):
+  """ Returns true if the passed in volume node has valid image data
+  """
+  if not volumeNode:
+    logging.debug('hasImageData failed: no volume node')
+    return False
+  if volumeNode.GetImageData() == None:
+    logging.debug('hasImageData failed: no image data in volume node')
+    return False
+  return True
+
+
+def arrayFromVolume(volumeNode):
+  """ Returns the scalars of a volume node as a (z, y, x) array that shares the VTK buffer (no copy).
+  Multi-component scalars get a trailing components axis
+  """
+  return arrayFromImageData(volumeNode.GetImageData())
+
+
+def arrayFromImageData(imageData):
+  """ Returns the scalars of image data as a (z, y, x[, components]) array that shares the VTK buffer
+  (no copy, only valid while the image data is alive)
+  """
+  scalars = imageData.GetPointData().GetScalars()
+  x, y, z = imageData.GetDimensions()
+  array = numpy_support.vtk_to_numpy(scalars)
+  if scalars.GetNumberOfComponents() > 1:
+    return array.reshape(z, y, x, scalars.GetNumberOfComponents())
+  return array.reshape(z, y, x)
+
+
+def readVolumeFile(filePath):
+  """ Reads the header and voxels of a (compressed) NIfTI file without creating MRML nodes. Returns the
+  image data and its IJK to RAS matrix (a vtkMatrix4x4) as slicer.util.loadVolume loads the file: voxels
+  in file order, the sform preferred over the qform, and scl_slope/scl_inter applied (to float voxels).
+  Returns None if the file could not be read. Touches no MRML state, so it can run on worker threads and
+  in worker processes
+  """
+  reader = vtk.vtkNIFTIImageReader()
+  reader.SetFileName(filePath)
+  reader.Update()
+  imageData = reader.GetOutput()
+  if imageData.GetPointData().GetScalars() is None:
+    return None
+
+  # RAS = orientation * (spacing * IJK + origin), with the orientation from the sform (or qform) matrix
+  orientation = reader.GetSFormMatrix() or reader.GetQFormMatrix() or vtk.vtkMatrix4x4()
+  ijkToData = vtk.vtkMatrix4x4()
+  for axis in range(3):
+    ijkToData.SetElement(axis, axis, imageData.GetSpacing()[axis])
+    ijkToData.SetElement(axis, 3, imageData.GetOrigin()[axis])
+  ijkToRAS = vtk.vtkMatrix4x4()
+  vtk.vtkMatrix4x4.Multiply4x4(orientation, ijkToData, ijkToRAS)
+
+  # The reader reverses the slices of files with qfac -1 (and adjusts both matrices), restore the file order
+  flipSlices = reader.GetQFac() < 0
+  slope, intercept = reader.GetRescaleSlope() or 1.0, reader.GetRescaleIntercept()
+  rescale = slope != 1.0 or intercept != 0.0
+  if flipSlices or rescale:
+    array = arrayFromImageData(imageData)
+    if flipSlices:
+      array = array[::-1]
+    if rescale:
+      array = array.astype(np.float64 if array.dtype == np.float64 else np.float32)
+      array *= slope
+      array += intercept
+    imageData = imageDataFromArray(np.ascontiguousarray(array))
+  if flipSlices:
+    flip = vtk.vtkMatrix4x4()
+    flip.SetElement(2, 2, -1)
+    flip.SetElement(2, 3, imageData.GetDimensions()[2]-1)
+    flipped = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(ijkToRAS, flip, flipped)
+    ijkToRAS = flipped
+  return imageData, ijkToRAS
+
+
+def matrixElements(matrix):
+  """ Returns a vtkMatrix4x4 as a 4x4 list of rows """
+  return [[matrix.GetElement(row, column) for column in range(4)] for row in range(4)]
+
+
+def arrayFromVolumeModified(volumeNode):
+  """ Lets VTK, the volume node and the slice views know that its scalars were changed through
+  the array returned by arrayFromVolume
+  """
+  imageData = volumeNode.GetImageData()
+  imageData.GetPointData().GetScalars().Modified()
+  imageData.Modified()
+
+
+def setVolumeArray(volumeNode, array):
+  """ Writes an array into the scalars of a volume node in one vectorized copy, casting to the
+  scalar type of the volume with saturation (see saturatingCast). Returns False if the number of
+  voxels does not match
+  """
+  outputArray = arrayFromVolume(volumeNode)
+  recordVoxels(outputArray.size)
+  if outputArray.size != array.size:
+    logging.error('setVolumeArray failed: volume %s and array sizes do not match' % volumeNode.GetName())
+    return False
+  saturatingCast(array.reshape(outputArray.shape), outputArray.dtype, out=outputArray)
+  arrayFromVolumeModified(volumeNode)
+  return True
+
+
+def imageDataFromArray(array):
+  """ Returns vtkImageData whose scalars are a (z, y, x[, components]) array itself (no copy, the
+  scalars keep the array alive). Arrays that are not C-contiguous are copied once
+  """
+  if array.ndim == 3:
+    array = array[..., np.newaxis]
+  if not array.flags.c_contiguous:
+    array = np.ascontiguousarray(array)
+  imageData = vtk.vtkImageData()
+  imageData.SetDimensions(array.shape[2], array.shape[1], array.shape[0])
+  scalars = numpy_support.numpy_to_vtk(array.reshape(-1, array.shape[3]), deep=False,
+                                       array_type=numpy_support.get_vtk_array_type(array.dtype))
+  imageData.GetPointData().SetScalars(scalars)
+  return imageData
+
+
+def createVolumeFromArray(name, array, ijkToRAS, scene=None):
+  """ Creates a scalar volume node with grey display whose scalars are the (z, y, x[, components])
+  array itself (no copy, the node keeps the array alive). ijkToRAS is a vtkMatrix4x4
+  """
+  return createVolumeFromImageData(name, imageDataFromArray(array), ijkToRAS, scene)
+
+
+def createVolumeFromImageData(name, imageData, ijkToRAS, scene=None):
+  """ Creates a scalar volume node with grey display around existing image data (no copy). The
+  geometry is given by ijkToRAS (a vtkMatrix4x4), the origin and spacing of the image data are reset
+  """
+  scene = scene or slicer.mrmlScene
+  imageData.SetOrigin(0, 0, 0)
+  imageData.SetSpacing(1, 1, 1)
+  volumeNode = slicer.vtkMRMLScalarVolumeNode()
+  volumeNode.SetName(name)
+  volumeNode.SetIJKToRASMatrix(ijkToRAS)
+  volumeNode.SetAndObserveImageData(imageData)
+  scene.AddNode(volumeNode)
+  displayNode = slicer.vtkMRMLScalarVolumeDisplayNode()
+  scene.AddNode(displayNode)
+  displayNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeGrey')
+  volumeNode.SetAndObserveDisplayNodeID(displayNode.GetID())
+  return volumeNode
+
+
+def createOutputVolume(referenceNode, newNodeName, array):
+  """ Creates an output volume node of the same class, geometry and display settings as referenceNode
+  whose scalars are the computed array (no copy). Unlike cloneVolumeNode, the voxels of the reference
+  are never copied, so creating an output costs no memory traffic beyond the array itself. The array
+  must have as many voxels as the reference
+  """
+  x, y, z = referenceNode.GetImageData().GetDimensions()
+  if array.size % (x*y*z) != 0:
+    raise ValueError('Output array of %d values does not fit the %dx%dx%d grid of %s' % (array.size, x, y, z, referenceNode.GetName()))
+  array = array.reshape(z, y, x, -1)
+
+  scene = referenceNode.GetScene() or slicer.mrmlScene
+  volumeNode = referenceNode.CreateNodeInstance()
+  volumeNode.SetName(scene.GenerateUniqueName(newNodeName))
+  volumeNode.SetIJKToRASMatrix(getIJKToRAS(referenceNode))
+  volumeNode.SetAndObserveImageData(imageDataFromArray(array))
+  scene.AddNode(volumeNode)
+
+  # Same display settings (color table, window/level) as the reference
+  referenceDisplayNode = referenceNode.GetDisplayNode()
+  if referenceDisplayNode:
+    displayNode = referenceDisplayNode.CreateNodeInstance()
+    displayNode.CopyWithScene(referenceDisplayNode)
+    scene.AddNode(displayNode)
+    volumeNode.SetAndObserveDisplayNodeID(displayNode.GetID())
+  return volumeNode
+
+
+def cloneVolumeNode(inputNode, newNodeName):
+  """ Clones the input volume node to give an output node with the same parameters but a new name.
+  This deep-copies the voxels, use createOutputVolume for outputs whose voxels are computed
+  """
+  volumesLogic = slicer.modules.volumes.logic()
+  return volumesLogic.CloneVolume(slicer.mrmlScene, inputNode, newNodeName)
+
+
+def symmetricTransform(*volumeNodes):
+  """ Performs the L/R symmetry transform with [-1 1 1 1] diagonal entries on the volume nodes
+  """
+  applyGeometry(volumeNodes, transformMatrix=diagonalMatrix(-1, 1, 1))
+
+
+def thresholdLabelVolume(labelNode, labelValue):
+  """ Sets the nonzero voxels of a label map volume to labelValue in place, leaving all 0 voxels untouched
+  (Threshold Scalar Volume CLI)
+  """
+  cliParams = {'InputVolume': labelNode.GetID(), 'OutputVolume': labelNode.GetID(), 'ThresholdType': 'Above',
+               'ThresholdValue': 0.5, 'OutsideValue': labelValue}
+  slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
+
+
+def stackVolumes(volumeNodes):
+  """ Copies the scalars of equally sized volume nodes into one TimestepStack and points every node
+  at its timestep in the stack (no copy), so the nodes and the stack share one buffer and the
+  separate buffers of the nodes are released. The geometry stays on the nodes
+  """
+  stack = TimestepStack.FromArrays([arrayFromVolume(volumeNode) for volumeNode in volumeNodes],
+                                   [volumeNode.GetName() for volumeNode in volumeNodes])
+  recordVoxels(stack.array.size)
+  for index, volumeNode in enumerate(volumeNodes):
+    volumeNode.SetAndObserveImageData(imageDataFromArray(stack.Timestep(index)))
+  return stack
+
+
+def createSequenceNode(name, volumeNodes, scene=None):
+  """ Creates a sequence node with the volume nodes as its items, indexed by timestep number, for
+  browsing the timesteps with the Sequences module. The sequence holds its own copy of every
+  volume. Returns None if the Sequences extension is not installed
+  """
+  if not hasattr(slicer, 'vtkMRMLSequenceNode'):
+    logging.warning('createSequenceNode failed: the Sequences extension is not installed')
+    return None
+  scene = scene or slicer.mrmlScene
+  sequenceNode = slicer.vtkMRMLSequenceNode()
+  sequenceNode.SetName(scene.GenerateUniqueName(name))
+  sequenceNode.SetIndexName('timestep')
+  sequenceNode.SetIndexUnit('')
+  sequenceNode.SetIndexType(slicer.vtkMRMLSequenceNode.NumericIndex)
+  scene.AddNode(sequenceNode)
+  for index, volumeNode in enumerate(volumeNodes):
+    sequenceNode.SetDataNodeAtValue(volumeNode, str(index+1))
+  return sequenceNode
@@ -0,0 +1,18 @@
+""" Code shared by the AssortedLabModules scripted modules """
+
+from .Instrumentation import StageTimer, timedStage, workerTimed, recordVoxels, configure, getRecords, clearRecords
+from .VolumeCache import VolumeCache
+from .Scene import SceneBatch, batchedScene
+from .Results import ResultsStore, RESULTS_FIELDS, cnrRows, contrastToNoise, printCNRResults, writeResults
+from .ArrayOps import CroppedMask, labelValueIndices, boundingBox, maskedStatistics
+from .TimestepStack import TimestepStack
+from .TimestepFiles import TIMESTEP_DIRECTORY, findTimestepFiles
+
+# VTK and MRML are only available inside Slicer, the pure NumPy command line path runs without them
+try:
+  from .Geometry import applyGeometry, centeredOrigin, diagonalMatrix, geometryKey
+  from .LabelStatistics import LabelStatisticsPipeline, LabelStatisticsCache
+  from .VolumeOps import (hasImageData, arrayFromVolume, setVolumeArray, createVolumeFromArray, createOutputVolume,
+                          cloneVolumeNode, symmetricTransform, thresholdLabelVolume, stackVolumes, createSequenceNode)
+except ImportError:
+  pass
@@ -3,7 +3,9 @@ import unittest
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
-import time
+import numpy as np
+from AssortedLabLib import timedStage, recordVoxels, batchedScene, LabelStatisticsCache, cnrRows, printCNRResults, writeResults
+from AssortedLabLib.VolumeOps import hasImageData, imageDataFromArray, createVolumeFromArray
 
 #
 # ComputeCGCNR
@@ -143,6 +145,16 @@ class ComputeCGCNRWidget(ScriptedLoadableModuleWidget):
     self.inputSelectorCG.setToolTip( "Pick the input segmentation to the algorithm." )
     parametersFormLayout.addRow("Input CG: ", self.inputSelectorCG)
 
+    #
+    # results file
+    #
+    self.resultsPathEdit = ctk.ctkPathLineEdit()
+    self.resultsPathEdit.filters = ctk.ctkPathLineEdit.Files
+    self.resultsPathEdit.nameFilters = ["CSV files (*.csv)"]
+    self.resultsPathEdit.settingKey = 'ComputeCGCNRResultsPath'
+    self.resultsPathEdit.setToolTip( "CSV file the results are appended to. Leave empty to only print them." )
+    parametersFormLayout.addRow("Results File: ", self.resultsPathEdit)
+
     #
     # Apply Button
     #
@@ -159,20 +171,23 @@ class ComputeCGCNRWidget(ScriptedLoadableModuleWidget):
     # Add vertical spacer
     self.layout.addStretch(1)
 
+    # Keep one logic so resampled labels are reused between runs
+    self.logic = ComputeCGCNRLogic()
+
     # Refresh Apply button state
     self.onSelect()
 
   def cleanup(self):
-    pass
+    self.logic.ClearResampledLabelCache(removeResampledNodes=False)
 
   def onSelect(self):
     self.applyButton.enabled = self.inputSelector1.currentNode() and self.inputSelectorUrethra.currentNode()
 
   def onApplyButton(self):
-    logic = ComputeCGCNRLogic()
-    logic.run(self.inputSelectorUrethra.currentNode(), self.inputSelectorCG.currentNode(),
-              self.inputSelector1.currentNode(), self.inputSelector2.currentNode(), 
-              self.inputSelector3.currentNode(), self.inputSelector4.currentNode())
+    self.logic.run(self.inputSelectorUrethra.currentNode(), self.inputSelectorCG.currentNode(),
+                   self.inputSelector1.currentNode(), self.inputSelector2.currentNode(),
+                   self.inputSelector3.currentNode(), self.inputSelector4.currentNode(),
+                   resultsPath=self.resultsPathEdit.currentPath or None)
 
 #
 # ComputeCGCNRLogic
@@ -188,172 +203,84 @@ class ComputeCGCNRLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
-  def CloneVolumeNode(self,inputNode,newNodeName):
-    """ Clones the input volume node to give an output node with the same parameters but a new name
-    given by the newNodeName parameter """
-
-    # Print to Slicer CLI
-    print('Cloning input to get output volume...'),
-    start_time = time.time()
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
 
-    # Logic for cloning volume
-    volumesLogic = slicer.modules.volumes.logic()
-    clonedVolumeNode = volumesLogic.CloneVolume(slicer.mrmlScene, inputNode, newNodeName)
+    # Labels resampled to the grayscale voxel grids and their statistics pipelines, kept across runs
+    self.labelStatisticsCache = LabelStatisticsCache()
 
-    # Print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-    return clonedVolumeNode
-
-  def SymmetricTransform(self, *ModuleInputs):
-    """ Performs L/R symmetry transform with [-1 1 1 1] diagonal entries on inputs
+  def hasImageData(self,volumeNode):
+    """ Returns true if the passed in volume node has valid image data
     """
-    # Print to Slicer CLI
-    print('Applying L/R symmetry transform...'),
-    start_time = time.time()
-
-    # Create inverting transform matrix
-    symmetry_transform = vtk.vtkMatrix4x4()
-    symmetry_transform.SetElement(0,0,-1) # put a -1 in 1st entry of diagonal of matrix
-
-    # Apply transform to all input nodes
-    for ModuleInput in ModuleInputs:
-        ModuleInput.ApplyTransformMatrix(symmetry_transform)
-
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+    return hasImageData(volumeNode)
 
+  @timedStage('Computing Label Statistics...')
   def ComputeLabelStatistics(self, grayscaleNode, inputlabelNode):
-    """ Computes label statistics for input label node on grayscale volume (mean, std, volume, etc)
-    """  
-    # Print to Slicer CLI
-    print('Computing Label Statistics...'),
-    start_time = time.time()
-
-    # resample the label to the space of the grayscale if needed
-    volumesLogic = slicer.modules.volumes.logic()
-    warnings = volumesLogic.CheckForLabelVolumeValidity(grayscaleNode, inputlabelNode)
-    if warnings != "":
-      if 'mismatch' in warnings:
-        inputlabelNode = volumesLogic.ResampleVolumeToReferenceVolume(inputlabelNode, grayscaleNode)
-
-    # Set up Stat accumulator
-    stataccum = vtk.vtkImageAccumulate()
-    stataccum.SetInputConnection(inputlabelNode.GetImageDataConnection())
-    stataccum.Update()
-    InputLabelValue = int(stataccum.GetMax()[0])
-
-    # logic copied from slicer3 LabelStatistics
-    thresholder = {}
-    thresholder = vtk.vtkImageThreshold()
-    thresholder.SetInputConnection(inputlabelNode.GetImageDataConnection())
-    thresholder.SetInValue(1)
-    thresholder.SetOutValue(0)
-    thresholder.ReplaceOutOn()
-    thresholder.ThresholdBetween(InputLabelValue,InputLabelValue)
-    thresholder.SetOutputScalarType(grayscaleNode.GetImageData().GetScalarType())
-    thresholder.Update()
-
-    # use vtk's statistics class with the binary labelmap as a stencil
-    stencil = vtk.vtkImageToImageStencil()
-    stencil.SetInputConnection(thresholder.GetOutputPort())
-    stencil.ThresholdBetween(1, 1)
-    stencil.Update()
-
-    # this.InvokeEvent(vtkLabelStatisticsLogic::LabelStatsInnerLoop, (void*)"0.5")
-    stat1 = vtk.vtkImageAccumulate()
-    stat1.SetInputConnection(grayscaleNode.GetImageDataConnection())
-    stat1.SetStencilData(stencil.GetOutput())
-    stat1.Update()
-
-    ### List of possible label stats available ###
+    """ Computes label statistics for input label node on grayscale volume. Returns a dictionary
+    mapping every label value present to its statistics (Count, Min, Max, Mean, StdDev)
+    """
+    # The label is resampled to the space of the grayscale if needed, and its statistics pipelines
+    # are reused (both cached across calls until the label changes)
+    labelStats = self.labelStatisticsCache.ComputeAll(grayscaleNode, inputlabelNode)
+    recordVoxels(grayscaleNode.GetImageData().GetNumberOfPoints())
+
+    ### Other label stats available ###
     # cubicMMPerVoxel = reduce(lambda x,y: x*y, inputlabelNode.GetSpacing())
     # ccPerCubicMM = 0.001
-    # labelStats["Labels"].append(i)
-    # labelStats[i,"Index"] = i
-    # labelStats[i,"Count"] = stat1.GetVoxelCount()
-    # labelStats[i,"Volume mm^3"] = labelStats[i,"Count"] * cubicMMPerVoxel
-    # labelStats[i,"Volume cc"] = labelStats[i,"Volume mm^3"] * ccPerCubicMM
-    # labelStats[i,"Min"] = stat1.GetMin()[0]
-    # labelStats[i,"Max"] = stat1.GetMax()[0]
-    # labelStats[i,"Mean"] = stat1.GetMean()[0]
-    # labelStats[i,"StdDev"] = stat1.GetStandardDeviation()[0]
-
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-    # Return desired stats to variables
-    return stat1.GetMean()[0], stat1.GetStandardDeviation()[0]
-
-  def ThresholdScalarVolume(self, inputVolume, newLabelVal):
-    """ Thresholds nonzero values on an input labelmap volume to the newLabelVal number while leaving all 0 values untouched
-    """
-    # Print to Slicer CLI
-    print('Changing Label Value...'),
-    start_time = time.time()
-
-    # Run the slicer module in CLI
-    cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': 0.5, 'OutsideValue': newLabelVal} 
-    cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
-    
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-  def PrintCNRResults(self, inputVolume, *stats):
-    """ Prints CNR Results for all stats computed
+    # labelStats[i]["Volume mm^3"] = labelStats[i]["Count"] * cubicMMPerVoxel
+    # labelStats[i]["Volume cc"] = labelStats[i]["Volume mm^3"] * ccPerCubicMM
+
+    return labelStats
+
+  def SelectLabelStatistics(self, labelStats, labelValue=None):
+    """ Returns the statistics of one label value (the largest one by default) from ComputeLabelStatistics
+    results, or zero statistics if the label is empty
     """
-    print("Printing results for: "),
-    print inputVolume.GetName()
+    if not labelStats:
+      return {"Count": 0, "Min": 0.0, "Max": 0.0, "Mean": 0.0, "StdDev": 0.0}
+    return labelStats[max(labelStats) if labelValue is None else labelValue]
 
-    for stat in stats:
-      print stat
+  def ClearResampledLabelCache(self, removeResampledNodes=True):
+    """ Empties the resampled label cache and the statistics pipelines and stops observing the scene
+    """
+    self.labelStatisticsCache.Clear(removeResampledNodes)
 
-  def run(self, inputUrethraLabel, inputCGLabel, *inputVolumes):
+  @timedStage(summary='Overall Algorithm Time')
+  @batchedScene()
+  def run(self, inputUrethraLabel, inputCGLabel, *inputVolumes, **kwargs):
 
     """
-    Run the actual algorithm
+    Run the actual algorithm. Returns the results table, one row per region and volume with the
+    CNR of the urethra against the CG on the urethra row. With resultsPath the rows are appended
+    to that CSV file, labelled with patient
     """
+    patient = kwargs.get('patient', '')
+    resultsPath = kwargs.get('resultsPath')
 
     # Starting Print to Slicer CLI
     logging.info('\n\nProcessing started')
-    start_time = time.time() # start timer
-    print('Expected Algorithm Time: 5 seconds\n') # based on previous trials of the algorithm
 
+    rows = []
     for inputVolume in inputVolumes:
 
       # Logic Copied from LesionCNR module 
       #Compute Means and Std from LabelStatistics Module fir all input volumes
-      Lesion_mean, Lesion_std = self.ComputeLabelStatistics(inputVolume,inputUrethraLabel)
-      symmetricLesion_mean, symmetricLesion_std = self.ComputeLabelStatistics(inputVolume,inputCGLabel)
+      urethraStats = self.SelectLabelStatistics(self.ComputeLabelStatistics(inputVolume,inputUrethraLabel))
+      cgStats = self.SelectLabelStatistics(self.ComputeLabelStatistics(inputVolume,inputCGLabel))
+      volumeRows = cnrRows(patient, inputVolume.GetName(), 'urethra', urethraStats, 'cg', cgStats)
+      rows.extend(volumeRows)
 
       # Print Results
-      self.PrintCNRResults(inputVolume, Lesion_mean, Lesion_std, symmetricLesion_mean, symmetricLesion_std)
-
-
-    # Old printing
-    # # Print CNR
-    # #print "Lesion Mean: ",
-    # print Lesion_mean
-    # #print "Lesion STD: ",
-    # print Lesion_std
-    # #print "Symmetric Area Mean: ",
-    # print symmetricLesion_mean
-    # #print "Symmetric Area STD: ",
-    # print symmetricLesion_std
-    # #print "Computed CNR: ",
-    # #print abs(Lesion_mean-symmetricLesion_mean)/symmetricLesion_std
-    
+      printCNRResults(inputVolume.GetName(), urethraStats["Mean"], urethraStats["StdDev"], cgStats["Mean"], cgStats["StdDev"],
+                      volumeRows[0]['cnr'])
+
+    if resultsPath:
+      writeResults(rows, resultsPath)
 
     # Ending Print to Slicer CLI
-    end_time = time.time()
     logging.info('\nProcessing completed')
-    print('Overall Algorithm Time: % 0.1f seconds') % float(end_time-start_time)
 
-    return True
+    return rows
 
 
 class ComputeCGCNRTest(ScriptedLoadableModuleTest):
@@ -373,6 +300,7 @@ class ComputeCGCNRTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_ComputeCGCNR1()
+    self.test_ComputeCGCNRLabelValues()
 
   def test_ComputeCGCNR1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -409,3 +337,34 @@ class ComputeCGCNRTest(ScriptedLoadableModuleTest):
     logic = ComputeCGCNRLogic()
     self.assertTrue( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_ComputeCGCNRLabelValues(self):
+    """ Checks that every value of a multi-valued label map gets its own statistics,
+    and that they follow a change of the label map
+    """
+    self.delayDisplay("Starting the label values test")
+    ijkToRAS = vtk.vtkMatrix4x4()
+    grayscaleArray = np.array([10, 20, 30, 40, 50, 60, 70, 80], dtype=np.uint8).reshape(1, 2, 4)
+    grayscaleNode = createVolumeFromArray('grayscale', grayscaleArray, ijkToRAS)
+    labelArray = np.array([0, 1, 1, 0, 2, 2, 2, 0], dtype=np.uint8).reshape(1, 2, 4)
+    labelNode = slicer.vtkMRMLLabelMapVolumeNode()
+    labelNode.SetName('label')
+    labelNode.SetIJKToRASMatrix(ijkToRAS)
+    labelNode.SetAndObserveImageData(imageDataFromArray(labelArray))
+    slicer.mrmlScene.AddNode(labelNode)
+
+    logic = ComputeCGCNRLogic()
+    labelStats = logic.ComputeLabelStatistics(grayscaleNode, labelNode)
+    self.assertEqual( sorted(labelStats), [1, 2] )
+    self.assertEqual( labelStats[1]["Count"], 2 )
+    self.assertAlmostEqual( labelStats[1]["Mean"], 25 )
+    self.assertAlmostEqual( labelStats[2]["Mean"], 60 )
+    self.assertAlmostEqual( logic.SelectLabelStatistics(labelStats)["Mean"], 60 )
+
+    labelNode.GetImageData().GetPointData().GetScalars().SetTuple1(0, 3)
+    labelNode.GetImageData().Modified()
+    labelStats = logic.ComputeLabelStatistics(grayscaleNode, labelNode)
+    self.assertEqual( sorted(labelStats), [1, 2, 3] )
+    self.assertAlmostEqual( labelStats[3]["Mean"], 10 )
+    logic.ClearResampledLabelCache()
+    self.delayDisplay('Test passed!')
@@ -3,7 +3,56 @@ import unittest
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
-import time
+import multiprocessing
+import numpy as np
+from AssortedLabLib import StageTimer, timedStage, recordVoxels, geometryKey, batchedScene, LabelStatisticsCache, ResultsStore, cnrRows, printCNRResults, writeResults
+from AssortedLabLib.VolumeOps import (hasImageData, arrayFromVolume, arrayFromImageData, imageDataFromArray, createVolumeFromArray,
+                                     cloneVolumeNode, symmetricTransform, thresholdLabelVolume, readVolumeFile, matrixElements)
+from AssortedLabLib.TimestepFiles import TIMESTEP_DIRECTORY, findTimestepFiles
+from AssortedLabLib.Geometry import getIJKToRAS
+from AssortedLabLib.ArrayOps import CroppedMask, maxLabelIndices, symmetricLabelIndices, lesionAndSymmetricMasks, maskedStatistics
+
+# Definitions for array statistics (used without MRML nodes by the batch workers)
+def readVolumeArray(filePath):
+    """ Reads a NIfTI volume without creating MRML nodes. Returns the image data, a flat numpy view
+    of its scalars (only valid while the image data is alive) and its 4x4 IJK to RAS matrix
+    """
+    readVolume = readVolumeFile(filePath)
+    if readVolume is None:
+        raise IOError('Could not read volume %s' % filePath)
+    imageData, ijkToRAS = readVolume
+    return imageData, arrayFromImageData(imageData).reshape(-1), np.array(matrixElements(ijkToRAS))
+
+def ComputePatientCNR(task):
+    """ Batch worker: computes lesion and symmetric region statistics for every timestep of one patient.
+    The symmetric region is the lesion mirrored across RAS x=0, like in ComputeRegionCNRLogic.run.
+    task is (patientNumber, timestepFiles, lesionLabelFile). Returns (patientNumber, rows, error)
+    """
+    patientNumber, timestepFiles, lesionLabelFile = task
+    with StageTimer('ComputeRegionCNR.ComputePatientCNR'):
+        try:
+            labelImage, labelArray, labelIJKToRAS = readVolumeArray(lesionLabelFile)
+            dimensions = labelImage.GetDimensions()
+            lesionMask, symmetricMask = lesionAndSymmetricMasks(labelArray, dimensions, labelIJKToRAS)
+            recordVoxels(labelArray.size)
+            del labelImage, labelArray
+
+            rows = []
+            for timestepFile in timestepFiles:
+                grayscaleImage, grayscaleArray, ijkToRAS = readVolumeArray(timestepFile)
+                # Same voxel grid: dimensions, and spacing, origin and directions through the IJK to RAS matrix
+                if grayscaleImage.GetDimensions() != dimensions or not np.allclose(ijkToRAS, labelIJKToRAS, atol=1e-4):
+                    raise ValueError('%s does not match the lesion label geometry' % timestepFile)
+                lesionStats = maskedStatistics(grayscaleArray, lesionMask)
+                symmetricStats = maskedStatistics(grayscaleArray, symmetricMask)
+                recordVoxels(grayscaleArray.size)
+                del grayscaleImage, grayscaleArray
+
+                volumeName = os.path.basename(timestepFile).split('.')[0]
+                rows.extend(cnrRows(patientNumber, volumeName, 'lesion', lesionStats, 'symmetric', symmetricStats))
+            return patientNumber, rows, None
+        except Exception as error:
+            return patientNumber, [], str(error)
 
 #
 # ComputeRegionCNR
@@ -128,6 +177,16 @@ class ComputeRegionCNRWidget(ScriptedLoadableModuleWidget):
     self.inputSelectorLesion.setToolTip( "Pick the input segmentation to the algorithm." )
     parametersFormLayout.addRow("Input Lesion: ", self.inputSelectorLesion)
 
+    #
+    # results file
+    #
+    self.resultsPathEdit = ctk.ctkPathLineEdit()
+    self.resultsPathEdit.filters = ctk.ctkPathLineEdit.Files
+    self.resultsPathEdit.nameFilters = ["CSV files (*.csv)"]
+    self.resultsPathEdit.settingKey = 'ComputeRegionCNRResultsPath'
+    self.resultsPathEdit.setToolTip( "CSV file the results are appended to. Leave empty to only print them." )
+    parametersFormLayout.addRow("Results File: ", self.resultsPathEdit)
+
     #
     # Apply Button
     #
@@ -144,19 +203,22 @@ class ComputeRegionCNRWidget(ScriptedLoadableModuleWidget):
     # Add vertical spacer
     self.layout.addStretch(1)
 
+    # Keep one logic so resampled labels are reused between runs
+    self.logic = ComputeRegionCNRLogic()
+
     # Refresh Apply button state
     self.onSelect()
 
   def cleanup(self):
-    pass
+    self.logic.ClearResampledLabelCache(removeResampledNodes=False)
 
   def onSelect(self):
     self.applyButton.enabled = self.inputSelector1.currentNode() and self.inputSelectorLesion.currentNode()
 
   def onApplyButton(self):
-    logic = ComputeRegionCNRLogic()
-    logic.run(self.inputSelectorLesion.currentNode(),self.inputSelector1.currentNode(), self.inputSelector2.currentNode(), 
-                                                     self.inputSelector3.currentNode(), self.inputSelector4.currentNode())
+    self.logic.run(self.inputSelectorLesion.currentNode(),self.inputSelector1.currentNode(), self.inputSelector2.currentNode(),
+                                                          self.inputSelector3.currentNode(), self.inputSelector4.currentNode(),
+                   resultsPath=self.resultsPathEdit.currentPath or None)
 
 #
 # ComputeRegionCNRLogic
@@ -172,178 +234,190 @@ class ComputeRegionCNRLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+
+    # Labels resampled to the grayscale voxel grids and their statistics pipelines, kept across runs
+    self.labelStatisticsCache = LabelStatisticsCache()
+
+  def hasImageData(self,volumeNode):
+    """ Returns true if the passed in volume node has valid image data
+    """
+    return hasImageData(volumeNode)
+
+  @timedStage('Cloning input to get output volume...')
   def CloneVolumeNode(self,inputNode,newNodeName):
     """ Clones the input volume node to give an output node with the same parameters but a new name
     given by the newNodeName parameter """
+    return cloneVolumeNode(inputNode, newNodeName)
 
-    # Print to Slicer CLI
-    print('Cloning input to get output volume...'),
-    start_time = time.time()
+  @timedStage('Applying L/R symmetry transform...')
+  def SymmetricTransform(self, *ModuleInputs):
+    """ Performs L/R symmetry transform with [-1 1 1 1] diagonal entries on inputs
+    """
+    symmetricTransform(*ModuleInputs)
 
-    # Logic for cloning volume
-    volumesLogic = slicer.modules.volumes.logic()
-    clonedVolumeNode = volumesLogic.CloneVolume(slicer.mrmlScene, inputNode, newNodeName)
+  def ClearResampledLabelCache(self, removeResampledNodes=True):
+    """ Empties the resampled label cache and the statistics pipelines and stops observing the scene
+    """
+    self.labelStatisticsCache.Clear(removeResampledNodes)
 
-    # Print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+  @timedStage('Computing label masks...')
+  def ComputeLabelMasks(self, referenceNode, *labelNodes):
+    """ Computes a mask for each label node on the voxel grid of the reference volume. Each mask
+    is the flat index array of the voxels carrying the label value (the largest value in the label map)
+    """
+    labelMasks = []
+    for labelNode in labelNodes:
+      labelNode = self.labelStatisticsCache.LabelOnReferenceGrid(referenceNode, labelNode)
+      recordVoxels(labelNode.GetImageData().GetNumberOfPoints())
+      # The label index is cached with the label statistics pipeline until the label changes
+      labelIndex = self.labelStatisticsCache.Pipeline(labelNode).LabelIndex()
+      labelMasks.append(maxLabelIndices(labelIndex))
+
+    return labelMasks
+
+  @timedStage('Mirroring label mask...')
+  def MirrorLabelMask(self, referenceNode, labelMask):
+    """ Mirrors a label mask on the voxel grid of the reference volume across the RAS x=0 (L/R) plane,
+    the same mapping SymmetricTransform applies to a label node. Works on the flat indices directly, so
+    no node, transform or CLI run is needed. Returns None if no IJK axis of the volume is aligned with L/R
+    """
+    dimensions = referenceNode.GetImageData().GetDimensions()
+    return symmetricLabelIndices(labelMask, dimensions, matrixElements(getIJKToRAS(referenceNode)))
+
+  @timedStage('Computing Label Statistics...')
+  def ComputeMaskedStatistics(self, grayscaleNode, *labelMasks):
+    """ Computes count, mean, std, min and max of the grayscale volume for each label mask, reading only
+    the masked voxels (flat indices) or the bounding box of the mask (CroppedMask). Returns one dictionary
+    of statistics per mask, with the same keys and conventions (sample standard deviation) as the
+    LabelStatistics module
+    """
+    grayscaleArray = arrayFromVolume(grayscaleNode).reshape(-1)
+    recordVoxels(sum(len(labelMask) for labelMask in labelMasks))
 
-    return clonedVolumeNode
+    labelStats = [maskedStatistics(grayscaleArray, labelMask) for labelMask in labelMasks]
 
-  def SymmetricTransform(self, *ModuleInputs):
-    """ Performs L/R symmetry transform with [-1 1 1 1] diagonal entries on inputs
-    """
-    # Print to Slicer CLI
-    print('Applying L/R symmetry transform...'),
-    start_time = time.time()
-
-    # Create inverting transform matrix
-    symmetry_transform = vtk.vtkMatrix4x4()
-    symmetry_transform.SetElement(0,0,-1) # put a -1 in 1st entry of diagonal of matrix
-
-    # Apply transform to all input nodes
-    for ModuleInput in ModuleInputs:
-        ModuleInput.ApplyTransformMatrix(symmetry_transform)
-
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-  def ComputeLabelStatistics(self, grayscaleNode, inputlabelNode):
-    """ Computes label statistics for input label node on grayscale volume (mean, std, volume, etc)
-    """  
-    # Print to Slicer CLI
-    print('Computing Label Statistics...'),
-    start_time = time.time()
-
-    # resample the label to the space of the grayscale if needed
-    volumesLogic = slicer.modules.volumes.logic()
-    warnings = volumesLogic.CheckForLabelVolumeValidity(grayscaleNode, inputlabelNode)
-    if warnings != "":
-      if 'mismatch' in warnings:
-        inputlabelNode = volumesLogic.ResampleVolumeToReferenceVolume(inputlabelNode, grayscaleNode)
-
-    # Set up Stat accumulator
-    stataccum = vtk.vtkImageAccumulate()
-    stataccum.SetInputConnection(inputlabelNode.GetImageDataConnection())
-    stataccum.Update()
-    InputLabelValue = int(stataccum.GetMax()[0])
-
-    # logic copied from slicer3 LabelStatistics
-    thresholder = {}
-    thresholder = vtk.vtkImageThreshold()
-    thresholder.SetInputConnection(inputlabelNode.GetImageDataConnection())
-    thresholder.SetInValue(1)
-    thresholder.SetOutValue(0)
-    thresholder.ReplaceOutOn()
-    thresholder.ThresholdBetween(InputLabelValue,InputLabelValue)
-    thresholder.SetOutputScalarType(grayscaleNode.GetImageData().GetScalarType())
-    thresholder.Update()
-
-    # use vtk's statistics class with the binary labelmap as a stencil
-    stencil = vtk.vtkImageToImageStencil()
-    stencil.SetInputConnection(thresholder.GetOutputPort())
-    stencil.ThresholdBetween(1, 1)
-    stencil.Update()
-
-    # this.InvokeEvent(vtkLabelStatisticsLogic::LabelStatsInnerLoop, (void*)"0.5")
-    stat1 = vtk.vtkImageAccumulate()
-    stat1.SetInputConnection(grayscaleNode.GetImageDataConnection())
-    stat1.SetStencilData(stencil.GetOutput())
-    stat1.Update()
-
-    ### List of possible label stats available ###
-    # cubicMMPerVoxel = reduce(lambda x,y: x*y, inputlabelNode.GetSpacing())
-    # ccPerCubicMM = 0.001
-    # labelStats["Labels"].append(i)
-    # labelStats[i,"Index"] = i
-    # labelStats[i,"Count"] = stat1.GetVoxelCount()
-    # labelStats[i,"Volume mm^3"] = labelStats[i,"Count"] * cubicMMPerVoxel
-    # labelStats[i,"Volume cc"] = labelStats[i,"Volume mm^3"] * ccPerCubicMM
-    # labelStats[i,"Min"] = stat1.GetMin()[0]
-    # labelStats[i,"Max"] = stat1.GetMax()[0]
-    # labelStats[i,"Mean"] = stat1.GetMean()[0]
-    # labelStats[i,"StdDev"] = stat1.GetStandardDeviation()[0]
-
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-    # Return desired stats to variables
-    return stat1.GetMean()[0], stat1.GetStandardDeviation()[0]
+    return labelStats
 
+  @timedStage('Changing Label Value...')
   def ThresholdScalarVolume(self, inputVolume, newLabelVal):
     """ Thresholds nonzero values on an input labelmap volume to the newLabelVal number while leaving all 0 values untouched
     """
-    # Print to Slicer CLI
-    print('Changing Label Value...'),
-    start_time = time.time()
-
-    # Run the slicer module in CLI
-    cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': 0.5, 'OutsideValue': newLabelVal} 
-    cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
-    
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-  def PrintCNRResults(self, inputVolume, *stats):
-    """ Prints CNR Results for all stats computed
-    """
-    print("Printing results for: "),
-    print inputVolume.GetName()
-
-    for stat in stats:
-      print stat
+    thresholdLabelVolume(inputVolume, newLabelVal)
 
-  def run(self, inputLesionLabel, *inputVolumes):
+  @timedStage(summary='Overall Algorithm Time')
+  @batchedScene()
+  def run(self, inputLesionLabel, *inputVolumes, **kwargs):
 
     """
-    Run the actual algorithm
+    Run the actual algorithm. Returns the results table, one row per region and volume with the
+    CNR of the lesion against the symmetric region on the lesion row. With resultsPath the rows
+    are appended to that CSV file, labelled with patient
     """
+    patient = kwargs.get('patient', '')
+    resultsPath = kwargs.get('resultsPath')
 
     # Starting Print to Slicer CLI
     logging.info('\n\nProcessing started')
-    start_time = time.time() # start timer
-    print('Expected Algorithm Time: 7 seconds\n') # based on previous trials of the algorithm
 
-    # Create segmentation volume as clone of input label
-    symmetricLabel = self.CloneVolumeNode(inputLesionLabel,'symmetricLabel')
-
-    # Transform Symmetric Label using L/R symmetry and Change Label Value to 25
-    self.SymmetricTransform(symmetricLabel)
-    self.ThresholdScalarVolume(symmetricLabel,  25)
+    # Lesion and symmetric region masks are computed once per voxel grid and shared by all volumes on it
+    labelMasks = {}
+    symmetricLabel = None
+    rows = []
 
     for inputVolume in inputVolumes:
 
-      # Compute Means and Std from LabelStatistics Module fir all input volumes
-      Lesion_mean, Lesion_std = self.ComputeLabelStatistics(inputVolume,inputLesionLabel)
-      symmetricLesion_mean, symmetricLesion_std = self.ComputeLabelStatistics(inputVolume,symmetricLabel)
+      volumeGeometry = geometryKey(inputVolume)
+      if volumeGeometry not in labelMasks:
+        lesionMask, = self.ComputeLabelMasks(inputVolume, inputLesionLabel)
+
+        # Mirror the lesion mask across the L/R plane in memory
+        symmetricMask = self.MirrorLabelMask(inputVolume, lesionMask)
+        if symmetricMask is None:
+          # Oblique volume: fall back to a transformed label node, made once per run
+          if symmetricLabel is None:
+            symmetricLabel = self.CloneVolumeNode(inputLesionLabel,'symmetricLabel')
+            self.SymmetricTransform(symmetricLabel)
+            self.ThresholdScalarVolume(symmetricLabel,  25)
+          symmetricMask, = self.ComputeLabelMasks(inputVolume, symmetricLabel)
+
+        # Statistics only read the bounding boxes of the regions
+        dimensions = inputVolume.GetImageData().GetDimensions()
+        labelMasks[volumeGeometry] = (CroppedMask(lesionMask, dimensions), CroppedMask(symmetricMask, dimensions))
+      lesionMask, symmetricMask = labelMasks[volumeGeometry]
+
+      # Compute Means and Std for both regions, reading only their bounding boxes of the input volume
+      lesionStats, symmetricStats = self.ComputeMaskedStatistics(inputVolume, lesionMask, symmetricMask)
+
+      volumeRows = cnrRows(patient, inputVolume.GetName(), 'lesion', lesionStats, 'symmetric', symmetricStats)
+      rows.extend(volumeRows)
 
       # Print Results
-      self.PrintCNRResults(inputVolume, Lesion_mean, Lesion_std, symmetricLesion_mean, symmetricLesion_std)
-
-
-    # Old printing
-    # # Print CNR
-    # #print "Lesion Mean: ",
-    # print Lesion_mean
-    # #print "Lesion STD: ",
-    # print Lesion_std
-    # #print "Symmetric Area Mean: ",
-    # print symmetricLesion_mean
-    # #print "Symmetric Area STD: ",
-    # print symmetricLesion_std
-    # #print "Computed CNR: ",
-    # #print abs(Lesion_mean-symmetricLesion_mean)/symmetricLesion_std
-    
+      printCNRResults(inputVolume.GetName(), lesionStats["Mean"], lesionStats["StdDev"],
+                      symmetricStats["Mean"], symmetricStats["StdDev"], volumeRows[0]['cnr'])
+
+    if resultsPath:
+      writeResults(rows, resultsPath)
 
     # Ending Print to Slicer CLI
-    end_time = time.time()
     logging.info('\nProcessing completed')
-    print('Overall Algorithm Time: % 0.1f seconds') % float(end_time-start_time)
 
-    return True
+    return rows
+
+  @timedStage(summary='Overall Batch Time')
+  def runBatch(self, PatientNumbers, lesionLabelPattern, outputPath, timestepDirectory=TIMESTEP_DIRECTORY,
+               numberOfProcesses=None):
+    """
+    Run the CNR computation headless for a cohort of patients. Each patient's timesteps and lesion label
+    (lesionLabelPattern % PatientNumber) are read straight from disk in worker processes, without creating
+    MRML nodes, and all results are written to one CSV table at outputPath. The symmetric region is the
+    lesion mirrored across RAS x=0, as in run. Returns the list of patients that failed.
+
+    The workers are forked processes, and forking the Slicer application with its Qt and VTK state is
+    not safe, so batches only run headless (AssortedLabLib/CommandLine.py regioncnr --batch)
+    """
+    if slicer.util.mainWindow() is not None:
+      logging.error('runBatch forks worker processes and only runs without the main window, use '
+                    'Slicer --no-main-window --python-script AssortedLabLib/CommandLine.py regioncnr --batch')
+      return [str(PatientNumber) for PatientNumber in PatientNumbers]
+
+    # Starting Print to Slicer CLI
+    logging.info('\n\nBatch processing started')
+
+    # Gather the input files of every patient
+    tasks = []
+    failedPatients = []
+    for PatientNumber in PatientNumbers:
+      PatientNumber = str(PatientNumber)
+      timestepFiles = findTimestepFiles(PatientNumber, timestepDirectory)
+      lesionLabelFile = lesionLabelPattern % PatientNumber
+      if not timestepFiles or not os.path.exists(lesionLabelFile):
+        logging.warning("Skipping patient %s: missing timesteps or lesion label" % PatientNumber)
+        failedPatients.append(PatientNumber)
+        continue
+      tasks.append((PatientNumber, timestepFiles, lesionLabelFile))
+
+    # Process patients in parallel worker processes. Results arrive in the order the patients were
+    # given and are streamed to one consolidated results table through a write buffer
+    pool = multiprocessing.Pool(numberOfProcesses or min(len(tasks), multiprocessing.cpu_count()) or 1)
+    try:
+      with ResultsStore(outputPath, append=False) as resultsStore:
+        for PatientNumber, rows, error in pool.imap(ComputePatientCNR, tasks):
+          if error:
+            logging.error("Patient %s failed: %s" % (PatientNumber, error))
+            failedPatients.append(PatientNumber)
+          else:
+            logging.info("Patient %s done" % PatientNumber)
+            resultsStore.Append(rows)
+    finally:
+      pool.close()
+      pool.join()
+
+    # Ending Print to Slicer CLI
+    logging.info('\nBatch processing completed')
+
+    return failedPatients
 
 
 class ComputeRegionCNRTest(ScriptedLoadableModuleTest):
@@ -363,6 +437,8 @@ class ComputeRegionCNRTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_ComputeRegionCNR1()
+    self.test_ComputeRegionCNRMasks()
+    self.test_ComputeRegionCNRResults()
 
   def test_ComputeRegionCNR1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -399,3 +475,72 @@ class ComputeRegionCNRTest(ScriptedLoadableModuleTest):
     logic = ComputeRegionCNRLogic()
     self.assertTrue( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_ComputeRegionCNRMasks(self):
+    """ Lesion mask, mirrored region and masked statistics of a synthetic lesion. The volume is off center
+    in RAS, so the mirror about RAS x=0 differs from a flip about the volume center
+    """
+    self.delayDisplay("Starting the label mask test")
+    dimensions = (10, 6, 4)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    ijkToRAS.SetElement(0, 3, -3.5) # x = i - 3.5, so i mirrors to 7 - i
+
+    labelArray = np.zeros(dimensions[::-1], dtype=np.uint8)
+    labelArray[1, 2:4, 1:3] = 5 # lesion, the largest label value
+    labelArray[2, 0, 8] = 1
+    labelNode = slicer.vtkMRMLLabelMapVolumeNode()
+    labelNode.SetIJKToRASMatrix(ijkToRAS)
+    labelNode.SetAndObserveImageData(imageDataFromArray(labelArray))
+    slicer.mrmlScene.AddNode(labelNode)
+    grayscaleArray = np.random.randint(0, 256, dimensions[::-1]).astype(np.uint8)
+    grayscaleNode = createVolumeFromArray('grayscale', grayscaleArray, ijkToRAS)
+
+    logic = ComputeRegionCNRLogic()
+    lesionMask, = logic.ComputeLabelMasks(grayscaleNode, labelNode)
+    self.assertEqual( len(lesionMask), 4 )
+    self.assertTrue( np.array_equal(lesionMask, np.flatnonzero(labelArray == 5)) )
+
+    symmetricMask = logic.MirrorLabelMask(grayscaleNode, lesionMask)
+    self.assertEqual( len(symmetricMask), 4 )
+    lesionK, lesionJ, lesionI = np.unravel_index(lesionMask, labelArray.shape)
+    symmetricK, symmetricJ, symmetricI = np.unravel_index(symmetricMask, labelArray.shape)
+    self.assertEqual( sorted(symmetricI - 3.5), sorted(-(lesionI - 3.5)) )
+    self.assertEqual( sorted(zip(symmetricK, symmetricJ)), sorted(zip(lesionK, lesionJ)) )
+
+    croppedMasks = [CroppedMask(mask, dimensions) for mask in (lesionMask, symmetricMask)]
+    self.assertEqual( [len(mask) for mask in croppedMasks], [4, 4] )
+    flatGrayscale = grayscaleArray.reshape(-1).astype(np.float64)
+    for mask, stats in zip((lesionMask, symmetricMask), logic.ComputeMaskedStatistics(grayscaleNode, *croppedMasks)):
+      self.assertEqual( stats["Count"], len(mask) )
+      self.assertAlmostEqual( stats["Mean"], flatGrayscale[mask].mean() )
+      self.assertAlmostEqual( stats["StdDev"], flatGrayscale[mask].std(ddof=1) )
+      self.assertEqual( stats["Min"], flatGrayscale[mask].min() )
+      self.assertEqual( stats["Max"], flatGrayscale[mask].max() )
+    self.delayDisplay('Test passed!')
+
+  def test_ComputeRegionCNRResults(self):
+    """ Result rows written through ResultsStore read back with one header, in both flushes
+    """
+    self.delayDisplay("Starting the results test")
+    import csv
+    import shutil
+    import tempfile
+    lesionStats = {"Count": 4, "Min": 10, "Max": 40, "Mean": 25.0, "StdDev": 12.5}
+    backgroundStats = {"Count": 4, "Min": 0, "Max": 20, "Mean": 5.0, "StdDev": 10.0}
+    outputDirectory = tempfile.mkdtemp()
+    try:
+      outputPath = os.path.join(outputDirectory, 'cnr.csv')
+      with ResultsStore(outputPath, bufferSize=2) as resultsStore:
+        resultsStore.Append(cnrRows('1', 'ts2', 'lesion', lesionStats, 'symmetric', backgroundStats))
+        resultsStore.Append(cnrRows('1', 'ts3', 'lesion', lesionStats, 'symmetric', backgroundStats))
+      self.assertEqual( resultsStore.numberOfRows, 4 )
+      with open(outputPath) as resultsFile:
+        rows = list(csv.DictReader(resultsFile))
+      self.assertEqual( [row['volume'] for row in rows], ['ts2', 'ts2', 'ts3', 'ts3'] )
+      self.assertEqual( [row['region'] for row in rows], ['lesion', 'symmetric']*2 )
+      self.assertAlmostEqual( float(rows[0]['cnr']), 2.0 )
+      self.assertEqual( rows[1]['cnr'], '' )
+      self.assertAlmostEqual( float(rows[1]['std']), 10.0 )
+    finally:
+      shutil.rmtree(outputDirectory)
+    self.delayDisplay('Test passed!')
@@ -3,9 +3,10 @@ import unittest
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
-import time
-from vtk.util import numpy_support
 import numpy as np
+from AssortedLabLib import timedStage, recordVoxels, batchedScene, TimestepStack
+from AssortedLabLib.VolumeOps import hasImageData, arrayFromVolume, setVolumeArray, createOutputVolume, createVolumeFromArray
+from AssortedLabLib.ArrayOps import REDUCTION_TYPES, DEFAULT_CHUNK_SIZE, OUTPUT_TYPES, reducePixelArrays, outputScalarType, saturatingCast
 
 #
 # MultiVolCombine
@@ -115,6 +116,15 @@ class MultiVolCombineWidget(ScriptedLoadableModuleWidget):
     self.inputSelector4.setToolTip( "Pick the input to the algorithm." )
     parametersFormLayout.addRow("Input Volume 4: ", self.inputSelector4)
 
+    #
+    # output scalar type
+    #
+    self.outputTypeSelector = qt.QComboBox()
+    self.outputTypeSelector.addItems(list(OUTPUT_TYPES))
+    self.outputTypeSelector.setToolTip( "Scalar type of the output volumes. 'input' keeps the type of input volume 1. "
+                                        "Integer outputs saturate at the limits of the type." )
+    parametersFormLayout.addRow("Output Type: ", self.outputTypeSelector)
+
     #
     # Apply Button
     #
@@ -143,7 +153,8 @@ class MultiVolCombineWidget(ScriptedLoadableModuleWidget):
   def onApplyButton(self):
     logic = MultiVolCombineLogic()
     logic.run(self.inputSelector1.currentNode(), self.inputSelector2.currentNode(),
-              self.inputSelector3.currentNode(), self.inputSelector4.currentNode())
+              self.inputSelector3.currentNode(), self.inputSelector4.currentNode(),
+              outputType=self.outputTypeSelector.currentText)
 
 #
 # MultiVolCombineLogic
@@ -159,132 +170,124 @@ class MultiVolCombineLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  # Reductions supported by ReducePixelArrays
+  reductionTypes = REDUCTION_TYPES
+
+  # Number of voxels combined per chunk (about 1 MB per uint8 input)
+  defaultChunkSize = DEFAULT_CHUNK_SIZE
+
+  # Number of threads the chunks are combined on, None for one per core
+  defaultNumberOfThreads = None
+
+  # Stack indices of the timesteps combined into ts2345 and proj_2345 (ts2 to ts5)
+  defaultTimesteps = (1, 2, 3, 4)
+
   def hasImageData(self,volumeNode):
     """This is an example logic method that
     returns true if the passed in volume
     node has valid image data
     """
-    if not volumeNode:
-      logging.debug('hasImageData failed: no volume node')
-      return False
-    if volumeNode.GetImageData() == None:
-      logging.debug('hasImageData failed: no image data in volume node')
-      return False
-    return True
+    return hasImageData(volumeNode)
 
+  @timedStage('Setting output pixels...')
   def SetOutputPixelValues(self, outputVolumeNode, outputNumpyarray):
-    """This method sums the pixel values at all locations in the two input volume nodes 
-    and assigns the summed values to the outputVolumeNode. All inputs and output volumes
-    must be the same size"""
-
-    # Print to Slicer CLI
-    print('Setting output pixels...'),
-    start_time = time.time()
-
-    # Convert Numpy array to VTK (use double since will need double for SetTuple1() later)
-    VTK_data = numpy_support.numpy_to_vtk(num_array=outputNumpyarray, deep=True, array_type=vtk.VTK_UNSIGNED_INT)
-
-    # Get scalar data for output image
-    outputImageScalars = outputVolumeNode.GetImageData().GetPointData().GetScalars()
-
-    # List Comprehension to fill all values
-    [outputImageScalars.SetTuple1(Index,VTK_data.GetTuple1(Index)) for Index in xrange(outputImageScalars.GetNumberOfTuples())]
-
-    # Print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-  def NumpyCombinePixelValues(self, inputVolumeNode1, inputVolumeNode2, inputVolumeNode3, inputVolumeNode4):
-    """This method gets Numpy array information from the input volumes and combines 
-    the pixel information to give an output numpy array. All input volumes must 
-    be the same size"""
-
-    # Print to Slicer CLI
-    print('Combining input pixels...'),
-    start_time = time.time()
-
-    # Get Image Data for Input Volumes
-    imdata1 = inputVolumeNode1.GetImageData()
-    imdata2 = inputVolumeNode2.GetImageData()
-    imdata3 = inputVolumeNode3.GetImageData()
-    imdata4 = inputVolumeNode4.GetImageData()
-
-    # Get Dimensions of First Input (all inputs should match)
-    x,y,z   = imdata1.GetDimensions()
-
-    # Get scalar data for all inputs
-    scalars1 = imdata1.GetPointData().GetScalars()
-    scalars2 = imdata2.GetPointData().GetScalars()
-    scalars3 = imdata3.GetPointData().GetScalars()
-    scalars4 = imdata4.GetPointData().GetScalars()
-
-    ## Make Numpy Arrays from Scalar Data
-    array1 = numpy_support.vtk_to_numpy(scalars1)
-    array2 = numpy_support.vtk_to_numpy(scalars2)
-    array3 = numpy_support.vtk_to_numpy(scalars3)
-    array4 = numpy_support.vtk_to_numpy(scalars4)
-
-    # Combine Arrays (must divide before summing or will add to more than 256 and wrap around values)
-
-    # Averaging
-    outputNumpyarray1 = array1/4+array2/4+array2/4+array3/4
-
-    # Projection
-    max12 = np.maximum(array1,array2)
-    max34 = np.maximum(array3,array4)
-    outputNumpyarray2 = np.maximum(max12,max34)
-
-
-    # Print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-    return outputNumpyarray1, outputNumpyarray2
-
-  def CloneVolumeNode(self,inputNode,newNodeName):
-    """ Clones the input volume node to give an output node with the same parameters but a new name
-    given by the newNodeName parameter """
-
-    # Print to Slicer CLI
-    print('Cloning input to get output volume...'),
-    start_time = time.time()
-
-    # Logic for cloning volume
-    volumesLogic = slicer.modules.volumes.logic()
-    clonedVolumeNode = volumesLogic.CloneVolume(slicer.mrmlScene, inputNode, newNodeName)
-
-    # Print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-    return clonedVolumeNode
-
-  def run(self, inputVolume1, inputVolume2, inputVolume3, inputVolume4):
+    """This method writes the combined Numpy array into the scalars of the outputVolumeNode
+    in one bulk copy (see AssortedLabLib.VolumeOps.setVolumeArray), instead of one SetTuple1()
+    call per voxel. The array and output volume must have the same number of voxels"""
+    return setVolumeArray(outputVolumeNode, outputNumpyarray)
+
+  @timedStage('Combining input pixels...')
+  def NumpyCombinePixelValues(self, inputVolumeNodes, reductions=('mean', 'max'), weights=None, chunkSize=None,
+                              numberOfThreads=None):
+    """This method gets Numpy array information from any number of input volumes and combines
+    the pixel information with each of the requested reductions ('mean', 'max', 'min', 'median',
+    'weighted'). Returns one output numpy array per reduction, in the order requested. All input
+    volumes must be the same size"""
+
+    # Make Numpy Arrays from Scalar Data (views of the VTK buffers, no copies)
+    arrays = [arrayFromVolume(inputVolumeNode).reshape(-1) for inputVolumeNode in inputVolumeNodes]
+    recordVoxels(sum(array.size for array in arrays))
+
+    # Combine Arrays
+    outputNumpyarrays = self.ReducePixelArrays(arrays, reductions, weights, chunkSize, numberOfThreads)
+
+    return outputNumpyarrays
+
+  def ReducePixelArrays(self, arrays, reductions=('mean', 'max'), weights=None, chunkSize=None, numberOfThreads=None):
+    """ Reduces a list of equally sized flat arrays voxel by voxel in a single pass over chunks of
+    the volume, with the chunks spread over a thread pool (see AssortedLabLib.ArrayOps.reducePixelArrays) """
+    if chunkSize is None:
+      chunkSize = self.defaultChunkSize
+    if numberOfThreads is None:
+      numberOfThreads = self.defaultNumberOfThreads
+    return reducePixelArrays(arrays, reductions, weights, chunkSize, numberOfThreads)
+
+  def OutputScalarType(self, referenceNode, outputType):
+    """ Returns the numpy dtype of the outputs for one of OUTPUT_TYPES ('input' is the scalar type of
+    the reference node). Raises ValueError for unknown output types
     """
-    Run the actual algorithm
+    return outputScalarType(outputType, arrayFromVolume(referenceNode).dtype)
+
+  @timedStage('Combining input pixels...')
+  def CombineTimestepStack(self, stack, timesteps=None, reductions=('mean', 'max'), weights=None):
+    """ Combines timesteps of a TimestepStack (defaultTimesteps if none are given) with each of the requested
+    reductions over its time axis. Returns one flat output numpy array per reduction, in the order requested """
+    if timesteps is None:
+      timesteps = self.defaultTimesteps
+    outputNumpyarrays = stack.Project(reductions, timesteps, weights, self.defaultChunkSize, self.defaultNumberOfThreads)
+    recordVoxels(len(timesteps) * outputNumpyarrays[0].size)
+    return [outputNumpyarray.reshape(-1) for outputNumpyarray in outputNumpyarrays]
+
+  @timedStage('Creating output volume...')
+  def CreateOutputVolume(self, referenceNode, newNodeName, outputNumpyarray):
+    """ Creates an output volume with the geometry and display settings of the reference node and a new
+    name given by the newNodeName parameter, whose scalars are the combined Numpy array (no copy of
+    either the reference voxels or the array) """
+    return createOutputVolume(referenceNode, newNodeName, outputNumpyarray)
+
+  @timedStage(summary='Overall Algorithm Time')
+  @batchedScene()
+  def run(self, *inputVolumes, **kwargs):
     """
+    Run the actual algorithm on any number of input volumes. The outputs have the scalar type given by
+    the outputType keyword (one of OUTPUT_TYPES, 'input' by default). Returns the mean (ts2345) and
+    maximum (proj_2345) output volume nodes
+    """
+    outputType = kwargs.get('outputType', 'input')
 
     # Starting Print Statements
     logging.info('\n\nProcessing started')
-    print('Expected Algorithm Time: 33 seconds') # based on previous trials of the algorithm
-    start_time_overall = time.time() # start timer    
 
-    # Combine Pixel Values in input images into Numpy Array
-    outputNumpyarray1, outputNumpyarray2 = self.NumpyCombinePixelValues(inputVolume1, inputVolume2, inputVolume3, inputVolume4)
+    # Check the output type before combining
+    outputDtype = self.OutputScalarType(inputVolumes[0], outputType)
 
-    # Set output volume pixels using combined Numpy array
-    outputVolume1 = self.CloneVolumeNode(inputVolume1,'ts2345') # Create output volume as clone of input volume 1
-    self.SetOutputPixelValues(outputVolume1,outputNumpyarray1)
+    # Combine Pixel Values in input images into Numpy Array
+    outputNumpyarray1, outputNumpyarray2 = self.NumpyCombinePixelValues(inputVolumes, reductions=('mean', 'max'))
 
-    outputVolume2 = self.CloneVolumeNode(inputVolume1,'proj_2345') # Create output volume as clone of input volume 1
-    self.SetOutputPixelValues(outputVolume2,outputNumpyarray2)
+    # Output volumes take the geometry of input volume 1 and the combined arrays, cast with saturation
+    # to the output type (no copy when they already have it), as their scalars
+    outputVolume1 = self.CreateOutputVolume(inputVolumes[0], 'ts2345', saturatingCast(outputNumpyarray1, outputDtype))
+    outputVolume2 = self.CreateOutputVolume(inputVolumes[0], 'proj_2345', saturatingCast(outputNumpyarray2, outputDtype))
 
     # Ending Print Statements
-    end_time_overall = time.time()
     logging.info('Processing completed')
-    print('Overall Algorithm Time: % 0.1f seconds') % float(end_time_overall-start_time_overall)
 
-    return True
+    return outputVolume1, outputVolume2
+
+  @timedStage(summary='Overall Algorithm Time')
+  @batchedScene()
+  def runOnTimestepStack(self, stack, referenceNode, timesteps=None, outputType='input'):
+    """
+    Run the algorithm on timesteps of a TimestepStack, e.g. the one VisualizeTimesteps keeps in its
+    timestepStack, instead of volumes picked by hand (defaultTimesteps if none are given). The outputs
+    take the geometry of referenceNode. Returns the mean (ts2345) and maximum (proj_2345) output volume nodes
+    """
+    outputDtype = self.OutputScalarType(referenceNode, outputType)
+    outputNumpyarray1, outputNumpyarray2 = self.CombineTimestepStack(stack, timesteps, reductions=('mean', 'max'))
+    outputVolume1 = self.CreateOutputVolume(referenceNode, 'ts2345', saturatingCast(outputNumpyarray1, outputDtype))
+    outputVolume2 = self.CreateOutputVolume(referenceNode, 'proj_2345', saturatingCast(outputNumpyarray2, outputDtype))
+    logging.info('Processing completed')
+    return outputVolume1, outputVolume2
 
 
 class MultiVolCombineTest(ScriptedLoadableModuleTest):
@@ -304,6 +307,9 @@ class MultiVolCombineTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_MultiVolCombine1()
+    self.test_MultiVolCombineReductions()
+    self.test_MultiVolCombineOutputPixels()
+    self.test_MultiVolCombineTimestepStack()
 
   def test_MultiVolCombine1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -339,4 +345,67 @@ class MultiVolCombineTest(ScriptedLoadableModuleTest):
     volumeNode = slicer.util.getNode(pattern="FA")
     logic = MultiVolCombineLogic()
     self.assertTrue( logic.hasImageData(volumeNode) )
-    self.delayDisplay('Test passed!')
\ No newline at end of file
+    self.delayDisplay('Test passed!')
+
+  def test_MultiVolCombineReductions(self):
+    """ Checks the chunked reductions against plain numpy on a stack of small volumes,
+    using a chunk size that does not divide the volume evenly, with one and several threads
+    """
+    self.delayDisplay("Starting the reduction test")
+    arrays = [np.random.randint(0, 256, 1000).astype(np.uint8) for i in range(5)]
+    weights = [0.1, 0.2, 0.3, 0.2, 0.2]
+    stack = np.array(arrays, dtype=np.float64)
+
+    logic = MultiVolCombineLogic()
+    mean, maximum, minimum, median, weighted = logic.ReducePixelArrays(arrays, ('mean', 'max', 'min', 'median', 'weighted'),
+                                                                       weights=weights, chunkSize=300)
+
+    self.assertTrue( np.allclose(mean, stack.mean(axis=0)) )
+    self.assertTrue( np.array_equal(maximum, stack.max(axis=0)) )
+    self.assertTrue( np.array_equal(minimum, stack.min(axis=0)) )
+    self.assertTrue( np.allclose(median, np.median(stack, axis=0)) )
+    self.assertTrue( np.allclose(weighted, np.dot(weights, stack), atol=1e-3) )
+
+    # Chunks reduced on several threads give the same result as one thread
+    threaded = logic.ReducePixelArrays(arrays, ('mean', 'max', 'median'), chunkSize=64, numberOfThreads=4)
+    serial = logic.ReducePixelArrays(arrays, ('mean', 'max', 'median'), chunkSize=64, numberOfThreads=1)
+    for threadedArray, serialArray in zip(threaded, serial):
+      self.assertTrue( np.array_equal(threadedArray, serialArray) )
+
+    # A repeated reduction fills every one of its outputs
+    firstMean, secondMean, firstMedian, secondMedian = logic.ReducePixelArrays(arrays, ('mean', 'mean', 'median', 'median'), chunkSize=300)
+    self.assertTrue( np.allclose(secondMean, stack.mean(axis=0)) )
+    self.assertTrue( np.array_equal(firstMean, secondMean) )
+    self.assertTrue( np.array_equal(firstMedian, secondMedian) )
+    self.delayDisplay('Test passed!')
+
+  def test_MultiVolCombineOutputPixels(self):
+    """ Checks that the combined arrays are written into the output volume in its scalar type,
+    rounded and saturated
+    """
+    self.delayDisplay("Starting the output pixel test")
+    volumeNode = createVolumeFromArray('output', np.zeros((3, 4, 5), dtype=np.uint8), vtk.vtkMatrix4x4())
+
+    combined = np.arange(60, dtype=np.float32) + 0.75
+    logic = MultiVolCombineLogic()
+    self.assertTrue( logic.SetOutputPixelValues(volumeNode, combined) )
+    self.assertTrue( np.array_equal(arrayFromVolume(volumeNode).reshape(-1), np.around(combined).astype(np.uint8)) )
+    combined[:3] = [-20, 255.6, 1000]
+    self.assertTrue( logic.SetOutputPixelValues(volumeNode, combined) )
+    self.assertTrue( np.array_equal(arrayFromVolume(volumeNode).reshape(-1)[:3], [0, 255, 255]) )
+    self.assertFalse( logic.SetOutputPixelValues(volumeNode, combined[:10]) )
+    self.delayDisplay('Test passed!')
+
+  def test_MultiVolCombineTimestepStack(self):
+    """ Combining timesteps 2 to 5 of a stack gives the same arrays as combining them as separate arrays
+    """
+    self.delayDisplay("Starting the timestep stack test")
+    arrays = [np.random.randint(0, 256, (3, 4, 5)).astype(np.uint8) for i in range(8)]
+    stack = TimestepStack.FromArrays(arrays)
+
+    logic = MultiVolCombineLogic()
+    mean, maximum = logic.CombineTimestepStack(stack)
+    expectedMean, expectedMaximum = logic.ReducePixelArrays([array.reshape(-1) for array in arrays[1:5]])
+    self.assertTrue( np.array_equal(mean, expectedMean) )
+    self.assertTrue( np.array_equal(maximum, expectedMaximum) )
+    self.delayDisplay('Test passed!')
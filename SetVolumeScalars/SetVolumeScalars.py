@@ -3,9 +3,11 @@ import unittest
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
-import time
-from vtk.util import numpy_support
 import numpy as np
+from AssortedLabLib import timedStage, recordVoxels, batchedScene, diagonalMatrix
+from AssortedLabLib.VolumeOps import hasImageData, arrayFromVolume, setVolumeArray, createOutputVolume, createVolumeFromArray
+from AssortedLabLib.ArrayOps import COMBINE_RULES, COMBINE_FUNCTIONS, DEFAULT_SLAB_SIZE, OUTPUT_TYPES, compileCombineRule, combineArrays, outputScalarType, saturatingCast
+
 
 #
 # SetVolumeScalars
@@ -85,6 +87,44 @@ class SetVolumeScalarsWidget(ScriptedLoadableModuleWidget):
     self.inputSelector2.setToolTip( "Pick the input to the algorithm." )
     parametersFormLayout.addRow("Input Volume 2: ", self.inputSelector2)
 
+    #
+    # combine rule
+    #
+    self.ruleSelector = qt.QComboBox()
+    self.ruleSelector.addItems(sorted(COMBINE_RULES.keys()) + ['expression'])
+    self.ruleSelector.setCurrentIndex(self.ruleSelector.findText('ratio'))
+    self.ruleSelector.setToolTip( "Pick how the input pixel values are combined." )
+    parametersFormLayout.addRow("Combine Rule: ", self.ruleSelector)
+
+    #
+    # custom expression
+    #
+    self.expressionEdit = qt.QLineEdit()
+    self.expressionEdit.text = '(a + b)/2'
+    self.expressionEdit.enabled = False
+    self.expressionEdit.setToolTip( "Expression in a (input 1) and b (input 2), e.g. where(b != 0, a/b, 0). "
+                                    "Allowed functions: " + ', '.join(sorted(COMBINE_FUNCTIONS.keys())) )
+    parametersFormLayout.addRow("Expression: ", self.expressionEdit)
+
+    #
+    # slab size
+    #
+    self.slabSizeSpinBox = qt.QSpinBox()
+    self.slabSizeSpinBox.minimum = 1
+    self.slabSizeSpinBox.maximum = 1024
+    self.slabSizeSpinBox.value = SetVolumeScalarsLogic.defaultSlabSize
+    self.slabSizeSpinBox.setToolTip( "Number of z slices combined at a time. Smaller slabs use less memory." )
+    parametersFormLayout.addRow("Slab Size (slices): ", self.slabSizeSpinBox)
+
+    #
+    # output scalar type
+    #
+    self.outputTypeSelector = qt.QComboBox()
+    self.outputTypeSelector.addItems(list(OUTPUT_TYPES))
+    self.outputTypeSelector.setToolTip( "Scalar type of the output volume. 'input' keeps the type of input volume 1. "
+                                        "Integer outputs saturate at the limits of the type." )
+    parametersFormLayout.addRow("Output Type: ", self.outputTypeSelector)
+
     #
     # Apply Button
     #
@@ -97,6 +137,7 @@ class SetVolumeScalarsWidget(ScriptedLoadableModuleWidget):
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
     self.inputSelector1.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.inputSelector2.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
+    self.ruleSelector.connect("currentIndexChanged(int)", self.onRuleChanged)
 
     # Add vertical spacer
     self.layout.addStretch(1)
@@ -110,9 +151,19 @@ class SetVolumeScalarsWidget(ScriptedLoadableModuleWidget):
   def onSelect(self):
     self.applyButton.enabled = self.inputSelector1.currentNode() and self.inputSelector1.currentNode()
 
+  def onRuleChanged(self):
+    self.expressionEdit.enabled = self.ruleSelector.currentText == 'expression'
+
   def onApplyButton(self):
+    rule = self.ruleSelector.currentText
+    if rule == 'expression':
+      rule = self.expressionEdit.text
     logic = SetVolumeScalarsLogic()
-    logic.run(self.inputSelector1.currentNode(), self.inputSelector2.currentNode())
+    try:
+      logic.run(self.inputSelector1.currentNode(), self.inputSelector2.currentNode(), self.slabSizeSpinBox.value, rule,
+                outputType=self.outputTypeSelector.currentText)
+    except ValueError as error:
+      slicer.util.errorDisplay(str(error))
 
 #
 # SetVolumeScalarsLogic
@@ -128,49 +179,33 @@ class SetVolumeScalarsLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  # Number of z slices combined at a time by NumpyCombinePixelValues
+  defaultSlabSize = DEFAULT_SLAB_SIZE
+
   def hasImageData(self,volumeNode):
     """This is an example logic method that
     returns true if the passed in volume
     node has valid image data
     """
-    if not volumeNode:
-      logging.debug('hasImageData failed: no volume node')
-      return False
-    if volumeNode.GetImageData() == None:
-      logging.debug('hasImageData failed: no image data in volume node')
-      return False
-    return True
+    return hasImageData(volumeNode)
 
+  @timedStage('Setting output pixels...')
   def SetOutputPixelValues(self, outputVolumeNode, outputNumpyarray):
-    """This method sums the pixel values at all locations in the two input volume nodes 
-    and assigns the summed values to the outputVolumeNode. All inputs and output volumes
-    must be the same size"""
-
-    # Print to Slicer CLI
-    print('Setting output pixels...'),
-    start_time = time.time()
-
-    # Convert Numpy array to VTK (use double since will need double for SetTuple1() later)
-    VTK_data = numpy_support.numpy_to_vtk(num_array=outputNumpyarray, deep=True, array_type=vtk.VTK_UNSIGNED_INT)
-
-    # Get scalar data for output image
-    outputImageScalars = outputVolumeNode.GetImageData().GetPointData().GetScalars()
-
-    # List Comprehension to fill all values
-    [outputImageScalars.SetTuple1(Index,VTK_data.GetTuple1(Index)) for Index in xrange(outputImageScalars.GetNumberOfTuples())]
-
-    # Print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-  def NumpyCombinePixelValues(self,inputVolumeNode1, inputVolumeNode2):
-    """This method gets Numpy array information from the input volumes and combines 
-    the pixel information to give an output numpy array. All input volumes must 
-    be the same size"""
-
-    # Print to Slicer CLI
-    print('Combining input pixels...'),
-    start_time = time.time()
+    """This method writes the combined Numpy array into the scalars of the outputVolumeNode
+    in one bulk copy (see AssortedLabLib.VolumeOps.setVolumeArray). The array and output
+    volume must have the same number of voxels"""
+    return setVolumeArray(outputVolumeNode, outputNumpyarray)
+
+  @timedStage('Combining input pixels...')
+  def NumpyCombinePixelValues(self, inputVolumeNode1, inputVolumeNode2, outputNumpyarray=None, slabSize=None,
+                              rule='ratio', ruleParameters=None):
+    """This method gets Numpy array information from the input volumes and combines
+    the pixel information with the given rule (a name from COMBINE_RULES or an expression
+    in 'a' and 'b') to give an output numpy array. The volumes are streamed slab
+    by slab along z (slabSize slices at a time), so only one slab of floating point
+    temporaries exists at once. The result is written into outputNumpyarray if given
+    (e.g. the scalars of the output volume), otherwise into a new array with the scalar
+    type of input 1. All input volumes must be the same size"""
 
     # Get Image Data for Input Volumes
     imdata1 = inputVolumeNode1.GetImageData()
@@ -178,68 +213,62 @@ class SetVolumeScalarsLogic(ScriptedLoadableModuleLogic):
 
     # Get Dimensions of First Input (all inputs should match)
     x,y,z   = imdata1.GetDimensions()
+    if imdata2.GetDimensions() != (x,y,z):
+      logging.error('NumpyCombinePixelValues failed: input volumes are not the same size')
+      return None
 
-    # Get scalar data for all inputs
-    scalars1 = imdata1.GetPointData().GetScalars()
-    scalars2 = imdata2.GetPointData().GetScalars()
-
-    ## Make Numpy Arrays from Scalar Data
-    array1 = numpy_support.vtk_to_numpy(scalars1)
-    array2 = numpy_support.vtk_to_numpy(scalars2)
-
-    # Combine Arrays (must divide before summing or will add to more than 256 and wrap around values)
-    #outputNumpyarray = array1/2+array2/2
-    outputNumpyarray = np.around(27*np.true_divide(array1,array2)) # For Normalization
-
-    # Print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-    return outputNumpyarray
-
-  def CloneVolumeNode(self,inputNode,newNodeName):
-    """ Clones the input volume node to give an output node with the same parameters but a new name
-    given by the newNodeName parameter """
+    ## Make Numpy Arrays from Scalar Data (z,y,x views of the VTK buffers, no copies)
+    array1 = arrayFromVolume(inputVolumeNode1)
+    array2 = arrayFromVolume(inputVolumeNode2)
 
-    # Print to Slicer CLI
-    print('Cloning input to get output volume...'),
-    start_time = time.time()
+    recordVoxels(x*y*z)
 
-    # Logic for cloning volume
-    volumesLogic = slicer.modules.volumes.logic()
-    clonedVolumeNode = volumesLogic.CloneVolume(slicer.mrmlScene, inputNode, newNodeName)
+    # Combine Arrays one slab at a time, into the output in its final scalar type
+    if slabSize is None:
+      slabSize = self.defaultSlabSize
+    return combineArrays(array1, array2, outputNumpyarray, slabSize, rule, ruleParameters)
 
-    # Print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-    return clonedVolumeNode
-
-  def run(self, inputVolume1, inputVolume2):
+  def CompileCombineRule(self, rule, ruleParameters=None):
+    """ Compiles a named rule from COMBINE_RULES, or a user expression in 'a' and 'b', into a kernel that
+    combines one slab of each input (see AssortedLabLib.ArrayOps.compileCombineRule). Raises ValueError
+    for invalid expressions
+    """
+    return compileCombineRule(rule, ruleParameters)
+
+  @timedStage('Creating output volume...')
+  def CreateOutputVolume(self, referenceNode, newNodeName, outputNumpyarray):
+    """ Creates an output volume with the geometry and display settings of the reference node and a new
+    name given by the newNodeName parameter, whose scalars are the combined Numpy array (no copy of
+    either the reference voxels or the array) """
+    return createOutputVolume(referenceNode, newNodeName, outputNumpyarray)
+
+  @timedStage(summary='Overall Algorithm Time')
+  @batchedScene()
+  def run(self, inputVolume1, inputVolume2, slabSize=None, rule='ratio', ruleParameters=None, outputType='input'):
     """
-    Run the actual algorithm
+    Run the actual algorithm. The output volume has the scalar type outputType (one of OUTPUT_TYPES).
+    Returns the output volume node, or False if the inputs could not be combined
     """
 
     # Starting Print Statements
     logging.info('\n\nProcessing started')
-    print('Expected Algorithm Time: 33 seconds') # based on previous trials of the algorithm
-    start_time_overall = time.time() # start timer
 
-    # Create output volume as clone of input volume 1
-    outputVolume = self.CloneVolumeNode(inputVolume1,'CombinedVolume2')
+    # Check the combine rule and output type before creating any output
+    self.CompileCombineRule(rule, ruleParameters)
+    inputArray1 = arrayFromVolume(inputVolume1)
+    outputNumpyarray = np.empty(inputArray1.shape, outputScalarType(outputType, inputArray1.dtype))
 
-    # Sum Pixel Values in input images toi get output image
-    outputNumpyarray = self.NumpyCombinePixelValues(inputVolume1, inputVolume2)
+    # Combine Pixel Values in input images into the output array, saturating integer output types
+    if self.NumpyCombinePixelValues(inputVolume1, inputVolume2, outputNumpyarray, slabSize, rule, ruleParameters) is None:
+      return False
 
-    # Set output pixels using combined Numpy array
-    self.SetOutputPixelValues(outputVolume,outputNumpyarray)
+    # The output volume takes the geometry of input volume 1 and the combined array as its scalars
+    outputVolume = self.CreateOutputVolume(inputVolume1, 'CombinedVolume2', outputNumpyarray)
 
     # Ending Print Statements
-    end_time_overall = time.time()
     logging.info('Processing completed')
-    print('Overall Algorithm Time: % 0.1f seconds') % float(end_time_overall-start_time_overall)
 
-    return True
+    return outputVolume
 
 
 class SetVolumeScalarsTest(ScriptedLoadableModuleTest):
@@ -259,6 +288,9 @@ class SetVolumeScalarsTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_SetVolumeScalars1()
+    self.test_SetVolumeScalarsRules()
+    self.test_SetVolumeScalarsOutputVolume()
+    self.test_SetVolumeScalarsNaN()
 
   def test_SetVolumeScalars1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -295,3 +327,56 @@ class SetVolumeScalarsTest(ScriptedLoadableModuleTest):
     logic = SetVolumeScalarsLogic()
     self.assertTrue( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_SetVolumeScalarsRules(self):
+    """ Checks the named combine rules on small arrays, including division by zero
+    in the ratio rule, and that unknown names are rejected in user expressions
+    """
+    self.delayDisplay("Starting the combine rule test")
+    a = np.array([0, 10, 200, 255], dtype=np.uint8)
+    b = np.array([0, 5, 2, 255], dtype=np.uint8)
+
+    logic = SetVolumeScalarsLogic()
+    self.assertTrue( np.allclose(logic.CompileCombineRule('ratio')(a, b), [0, 54, 2700, 27]) )
+    self.assertTrue( np.allclose(logic.CompileCombineRule('clipped')(a, b), [0, 54, 255, 27]) )
+    self.assertTrue( np.allclose(logic.CompileCombineRule('mean')(a, b), [0, 7.5, 101, 255]) )
+    self.assertTrue( np.allclose(logic.CompileCombineRule('weighted', {'wa': 1, 'wb': 0})(a, b), a) )
+    self.assertTrue( np.allclose(logic.CompileCombineRule('a - b')(a, b), [0, 5, 198, 0]) )
+    self.assertRaises(ValueError, logic.CompileCombineRule, '__import__("os")')
+    self.delayDisplay('Test passed!')
+
+  def test_SetVolumeScalarsOutputVolume(self):
+    """ Checks that the output volume takes the geometry of input 1 and shares the combined array
+    instead of copying it
+    """
+    self.delayDisplay("Starting the output volume test")
+    ijkToRAS = diagonalMatrix(0.5, 1.0, 2.0)
+    for axis, origin in enumerate((10, 20, 30)):
+      ijkToRAS.SetElement(axis, 3, origin)
+    inputNode = createVolumeFromArray('input', np.zeros((3, 4, 5), dtype=np.uint8), ijkToRAS)
+
+    combined = np.arange(60, dtype=np.uint8).reshape(3, 4, 5)
+    logic = SetVolumeScalarsLogic()
+    outputNode = logic.CreateOutputVolume(inputNode, 'output', combined)
+    self.assertEqual( outputNode.GetImageData().GetDimensions(), (5, 4, 3) )
+    self.assertEqual( outputNode.GetSpacing(), (0.5, 1.0, 2.0) )
+    self.assertEqual( outputNode.GetOrigin(), (10, 20, 30) )
+    self.assertTrue( np.array_equal(arrayFromVolume(outputNode), combined) )
+    combined[0, 0, 0] = 255
+    self.assertEqual( arrayFromVolume(outputNode)[0, 0, 0], 255 )
+    self.delayDisplay('Test passed!')
+
+  def test_SetVolumeScalarsNaN(self):
+    """ NaN from 0/0 in a rule becomes 0 in integer outputs, without a cast warning, while out of
+    range values saturate
+    """
+    self.delayDisplay("Starting the NaN test")
+    import warnings
+    values = np.array([np.nan, 300.0, -5.0, 2.4, np.inf])
+    with warnings.catch_warnings(record=True) as caught:
+      warnings.simplefilter('always')
+      self.assertTrue( np.array_equal(saturatingCast(values, np.uint8), [0, 255, 0, 2, 255]) )
+      self.assertTrue( np.array_equal(saturatingCast(values, np.int16, nanValue=-1), [-1, 300, -5, 2, 32767]) )
+    self.assertEqual( [str(warning.message) for warning in caught], [] )
+    self.assertTrue( np.isnan(saturatingCast(values, np.float32)[0]) )
+    self.delayDisplay('Test passed!')
@@ -0,0 +1,266 @@
+"""Offline benchmark for the volume-combine and label-statistics hot paths.
+
+Builds synthetic ARFI-sized volumes (no network or file server access), times each
+stage separately and records throughput (voxels/s) and peak memory growth. Results are
+compared against a stored baseline and regressions are flagged.
+
+Run inside Slicer:
+
+  Slicer --no-main-window --python-script AssortedLabModulesBenchmark.py [--sizes 737x370x366 ...]
+         [--repeat 3] [--baseline baseline.json] [--update-baseline] [--tolerance 0.2]
+
+Exits with status 1 if any stage regressed.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import threading
+import resource
+from __main__ import vtk, slicer
+from vtk.util import numpy_support
+import numpy as np
+
+from SetVolumeScalars import SetVolumeScalarsLogic
+from MultiVolCombine import MultiVolCombineLogic
+from ComputeRegionCNR import ComputeRegionCNRLogic
+from VisualizeTimesteps import VisualizeTimestepsLogic
+from AssortedLabLib.VolumeOps import arrayFromVolume, setVolumeArray, cloneVolumeNode, createOutputVolume
+from AssortedLabLib.TimestepStack import TimestepStack
+
+# Full ARFI acquisition size and smaller sizes for quick runs
+DEFAULT_SIZES = ['737x370x366', '368x185x183', '184x92x91']
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+class MemorySampler(threading.Thread):
+  """ Samples the resident set size in the background and keeps the peak. Uses /proc when
+  available and falls back to the process high-water mark from getrusage
+  """
+
+  def __init__(self, interval=0.005):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.interval = interval
+    self.stopEvent = threading.Event()
+    self.startRSS = self.currentRSS()
+    self.peakRSS = self.startRSS
+
+  def currentRSS(self):
+    try:
+      with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+      return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+  def run(self):
+    while not self.stopEvent.is_set():
+      self.peakRSS = max(self.peakRSS, self.currentRSS())
+      time.sleep(self.interval)
+
+  def stop(self):
+    self.stopEvent.set()
+    self.join()
+    self.peakRSS = max(self.peakRSS, self.currentRSS())
+    return self.peakRSS - self.startRSS
+
+
+def parseSize(size):
+  return tuple(int(x) for x in size.lower().split('x'))
+
+
+def createVolumeNode(name, dimensions, array, nodeClass=None):
+  """ Creates a volume node holding a copy of the flat uint8 array """
+  imageData = vtk.vtkImageData()
+  imageData.SetDimensions(dimensions)
+  imageData.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+  numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())[:] = array
+  volumeNode = (nodeClass or slicer.vtkMRMLScalarVolumeNode)()
+  volumeNode.SetName(name)
+  volumeNode.SetAndObserveImageData(imageData)
+  slicer.mrmlScene.AddNode(volumeNode)
+  return volumeNode
+
+
+def createLesionArray(dimensions):
+  """ Spherical lesion covering about 0.1% of the volume, off center so its mirror does not overlap """
+  x, y, z = dimensions
+  radius = max(2, int(round((0.001 * x * y * z * 3 / (4 * np.pi)) ** (1.0 / 3))))
+  k, j, i = np.ogrid[:z, :y, :x]
+  inside = (i - x // 4) ** 2 + (j - y // 2) ** 2 + (k - z // 2) ** 2 <= radius ** 2
+  return (inside * 1).astype(np.uint8).ravel()
+
+
+def writeTimestepFiles(directory, dimensions, arrays):
+  """ Writes the arrays as gzip-compressed NIfTI timesteps named like the file server ones """
+  for index, array in enumerate(arrays):
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(dimensions)
+    imageData.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+    numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())[:] = array
+    writer = vtk.vtkNIFTIImageWriter()
+    writer.SetInputData(imageData)
+    writer.SetFileName(os.path.join(directory, 'avolume_ts%d_%d_%d_%d.nii.gz' % ((index + 1,) + tuple(dimensions))))
+    writer.Write()
+
+
+def timeStage(function, numberOfVoxels, repeat):
+  """ Runs the stage repeat times and returns the best time with the peak memory growth of that run """
+  best = None
+  for iteration in range(repeat):
+    sampler = MemorySampler()
+    sampler.start()
+    start = time.time()
+    function()
+    seconds = time.time() - start
+    peakBytes = sampler.stop()
+    if best is None or seconds < best['seconds']:
+      best = {'seconds': seconds, 'peakMemoryMB': peakBytes / 1024.0 ** 2}
+  best['voxelsPerSecond'] = numberOfVoxels / best['seconds'] if best['seconds'] > 0 else float('inf')
+  return best
+
+
+def benchmarkSize(size, repeat):
+  """ Times every hot path on synthetic volumes of one size """
+  dimensions = parseSize(size)
+  numberOfVoxels = dimensions[0] * dimensions[1] * dimensions[2]
+  random = np.random.RandomState(0)
+  arrays = [random.randint(1, 256, numberOfVoxels).astype(np.uint8) for i in range(4)]
+  lesionArray = createLesionArray(dimensions)
+
+  slicer.mrmlScene.Clear(0)
+  volumes = [createVolumeNode('ts%d' % (index + 2), dimensions, array) for index, array in enumerate(arrays)]
+  lesionLabel = createVolumeNode('lesion', dimensions, lesionArray, slicer.vtkMRMLLabelMapVolumeNode)
+  output = createVolumeNode('output', dimensions, arrays[0])
+
+  setVolumeScalars = SetVolumeScalarsLogic()
+  multiVolCombine = MultiVolCombineLogic()
+  regionCNR = ComputeRegionCNRLogic()
+  combined = setVolumeScalars.NumpyCombinePixelValues(volumes[0], volumes[1])
+  lesionMask, = regionCNR.ComputeLabelMasks(volumes[0], lesionLabel)
+  stack = TimestepStack.FromArrays([array.reshape(dimensions[::-1]) for array in arrays])
+
+  def cloneVolume():
+    slicer.mrmlScene.RemoveNode(cloneVolumeNode(volumes[0], 'clone'))
+
+  def computeLabelStatistics():
+    # The statistics pipeline of the label is kept between repeats, so the grayscale is marked modified
+    # to time the stencilled accumulate instead of a no-op Update
+    volumes[0].GetImageData().Modified()
+    regionCNR.labelStatisticsCache.ComputeAll(volumes[0], lesionLabel)
+
+  def createOutput():
+    slicer.mrmlScene.RemoveNode(createOutputVolume(volumes[0], 'output', np.empty(numberOfVoxels, np.uint8)))
+
+  results = {}
+  stages = [
+    # Volume primitives shared by all modules
+    ('VolumeOps.arrayFromVolume', lambda: arrayFromVolume(volumes[0]).sum()),
+    ('VolumeOps.setVolumeArray', lambda: setVolumeArray(output, combined)),
+    ('VolumeOps.cloneVolumeNode', cloneVolume),
+    ('VolumeOps.createOutputVolume', createOutput),
+    ('SetVolumeScalars.NumpyCombinePixelValues', lambda: setVolumeScalars.NumpyCombinePixelValues(volumes[0], volumes[1])),
+    ('SetVolumeScalars.SetOutputPixelValues', lambda: setVolumeScalars.SetOutputPixelValues(output, combined)),
+    ('MultiVolCombine.NumpyCombinePixelValues', lambda: multiVolCombine.NumpyCombinePixelValues(volumes, ('mean', 'max'))),
+    ('MultiVolCombine.NumpyCombinePixelValues(1 thread)', lambda: multiVolCombine.NumpyCombinePixelValues(volumes, ('mean', 'max'), numberOfThreads=1)),
+    ('MultiVolCombine.CombineTimestepStack', lambda: multiVolCombine.CombineTimestepStack(stack, range(len(stack)))),
+    ('TimestepStack.TimeToPeak', lambda: stack.TimeToPeak()),
+    ('LabelStatisticsCache.ComputeAll', computeLabelStatistics),
+    ('ComputeRegionCNR.ComputeMaskedStatistics', lambda: regionCNR.ComputeMaskedStatistics(volumes[0], lesionMask)),
+    ]
+  for name, function in stages:
+    results[name] = timeStage(function, numberOfVoxels, repeat)
+
+  # Loading goes through gzip-compressed NIfTI files in a scratch patient directory
+  dataDirectory = tempfile.mkdtemp(prefix='AssortedLabBenchmark')
+  try:
+    patientDirectory = os.path.join(dataDirectory, 'Patient1', 'loupas')
+    os.makedirs(patientDirectory)
+    writeTimestepFiles(patientDirectory, dimensions, arrays)
+    timestepDirectory = os.path.join(dataDirectory, 'Patient%s', 'loupas')
+    visualizeTimesteps = VisualizeTimestepsLogic()
+
+    # Every repeat reads and decompresses the files, the local cache is not used
+    def loadTimesteps():
+      slicer.mrmlScene.Clear(0)
+      visualizeTimesteps.loadTimesteps('1', timestepDirectory, useCache=False)
+    results['VisualizeTimesteps.loadTimesteps'] = timeStage(loadTimesteps, numberOfVoxels * len(arrays), repeat)
+
+    # Cache hits, from a scratch cache filled once before timing (the user's cache is never touched)
+    visualizeTimesteps.cacheDirectory = os.path.join(dataDirectory, 'cache')
+    slicer.mrmlScene.Clear(0)
+    visualizeTimesteps.loadTimesteps('1', timestepDirectory)
+    def loadCachedTimesteps():
+      slicer.mrmlScene.Clear(0)
+      visualizeTimesteps.loadTimesteps('1', timestepDirectory)
+    results['VisualizeTimesteps.loadTimesteps(cached)'] = timeStage(loadCachedTimesteps, numberOfVoxels * len(arrays), repeat)
+  finally:
+    # Release the memory-mapped cache entries before deleting them
+    slicer.mrmlScene.Clear(0)
+    shutil.rmtree(dataDirectory, ignore_errors=True)
+
+  return results
+
+
+def findRegressions(results, baseline, tolerance):
+  """ Returns a message for every stage that is slower or uses more memory than the baseline allows """
+  regressions = []
+  for key, result in sorted(results.items()):
+    if key not in baseline:
+      continue
+    reference = baseline[key]
+    if result['voxelsPerSecond'] < reference['voxelsPerSecond'] * (1 - tolerance):
+      regressions.append('%s: %.3g voxels/s, baseline %.3g voxels/s' % (key, result['voxelsPerSecond'], reference['voxelsPerSecond']))
+    # Small absolute growth is noise from the sampler and the allocator
+    if result['peakMemoryMB'] > max(reference['peakMemoryMB'] * (1 + tolerance), reference['peakMemoryMB'] + 16):
+      regressions.append('%s: peak memory %.1f MB, baseline %.1f MB' % (key, result['peakMemoryMB'], reference['peakMemoryMB']))
+  return regressions
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Benchmark the AssortedLabModules hot paths on synthetic volumes.')
+  parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES, help='volume sizes as XxYxZ')
+  parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the best one is kept')
+  parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline JSON file')
+  parser.add_argument('--update-baseline', action='store_true', help='store these results as the new baseline')
+  parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown or memory growth')
+  args = parser.parse_args(argv)
+
+  results = {}
+  for size in args.sizes:
+    for stage, result in benchmarkSize(size, args.repeat).items():
+      results['%s|%s' % (stage, size)] = result
+
+  print('\n%-60s %10s %14s %12s' % ('Stage|Size', 'Time (s)', 'Voxels/s', 'Peak (MB)'))
+  for key, result in sorted(results.items()):
+    print('%-60s %10.3f %14.4g %12.1f' % (key, result['seconds'], result['voxelsPerSecond'], result['peakMemoryMB']))
+
+  if args.update_baseline:
+    with open(args.baseline, 'w') as baselineFile:
+      json.dump(results, baselineFile, indent=2, sort_keys=True)
+    print('\nBaseline written to %s' % args.baseline)
+    return 0
+
+  if not os.path.exists(args.baseline):
+    print('\nNo baseline at %s, run with --update-baseline to create one' % args.baseline)
+    return 0
+
+  with open(args.baseline) as baselineFile:
+    baseline = json.load(baselineFile)
+  regressions = findRegressions(results, baseline, args.tolerance)
+  if regressions:
+    print('\nRegressions against %s:' % args.baseline)
+    for regression in regressions:
+      print('  ' + regression)
+    return 1
+  print('\nNo regressions against %s' % args.baseline)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -3,7 +3,14 @@ import unittest
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
-import time
+import numpy as np
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+from AssortedLabLib import StageTimer, timedStage, workerTimed, recordVoxels, VolumeCache, applyGeometry, centeredOrigin, diagonalMatrix, SceneBatch, batchedScene
+from AssortedLabLib.TimestepFiles import TIMESTEP_DIRECTORY, timestepName, findTimestepFiles
+from AssortedLabLib.VolumeOps import (hasImageData, arrayFromVolume, arrayFromImageData, readVolumeFile, createVolumeFromArray, createVolumeFromImageData,
+                                      createOutputVolume, stackVolumes, createSequenceNode, imageDataFromArray, matrixElements)
 
 # Definitions for GUI
 def numericInputFrame(parent, label, tooltip, minimum, maximum, step, decimals):
@@ -74,6 +81,24 @@ class VisualizeTimestepsWidget(ScriptedLoadableModuleWidget):
     PatientNumberIterationsFrame, self.PatientNumberIterationsSpinBox = numericInputFrame(self.parent,"Patient Number:","Tooltip",56,110,1,0)
     PatientNumberMethodFormLayout.addWidget(PatientNumberIterationsFrame)
 
+    # Lazy loading check box
+    self.lazyLoadingCheckBox = qt.QCheckBox("Show first timestep while loading the others")
+    self.lazyLoadingCheckBox.checked = True
+    self.lazyLoadingCheckBox.setToolTip("Load and display the first timestep right away and load the other timesteps in the background.")
+    parametersFormLayout.addRow(self.lazyLoadingCheckBox)
+
+    # Temporal volumes check box
+    self.temporalVolumesCheckBox = qt.QCheckBox("Compute temporal maximum, mean and time to peak")
+    self.temporalVolumesCheckBox.checked = False
+    self.temporalVolumesCheckBox.setToolTip("Reduce the stacked timesteps over time into temporal_max, temporal_mean and time_to_peak volumes. When loading lazily this is done once the last timestep is loaded.")
+    parametersFormLayout.addRow(self.temporalVolumesCheckBox)
+
+    # Sequence check box
+    self.sequenceCheckBox = qt.QCheckBox("Create a timestep sequence")
+    self.sequenceCheckBox.checked = False
+    self.sequenceCheckBox.setToolTip("Add the timesteps to a sequence node for browsing them with the Sequences module (needs the Sequences extension, the sequence holds a copy of every timestep).")
+    parametersFormLayout.addRow(self.sequenceCheckBox)
+
     # Apply Button
     #
     self.applyButton = qt.QPushButton("Apply")
@@ -87,18 +112,21 @@ class VisualizeTimestepsWidget(ScriptedLoadableModuleWidget):
     # Add vertical spacer
     self.layout.addStretch(1)
 
+    # Logic is kept so background loading can continue after Apply returns
+    self.logic = VisualizeTimestepsLogic()
+
     # Refresh Apply button state
     self.onSelect()
 
   def cleanup(self):
-    pass
+    self.logic.CancelLazyLoading()
 
   def onSelect(self):
     self.applyButton.enabled = True
 
   def onApplyButton(self):
-    logic = VisualizeTimestepsLogic()
-    logic.run(str(int(self.PatientNumberIterationsSpinBox.value)))
+    self.logic.run(str(int(self.PatientNumberIterationsSpinBox.value)), lazy=self.lazyLoadingCheckBox.checked,
+                   temporal=self.temporalVolumesCheckBox.checked, sequence=self.sequenceCheckBox.checked)
 
 
 #
@@ -115,60 +143,249 @@ class VisualizeTimestepsLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
-  def loadTimesteps(self,PatientNumber):
-    """ Loads ARFI timestep volumes from file server. If inputs are not present, saves node variable as a string with missing filepath for error output
+  # Interval at which background loads are checked for finished timesteps
+  lazyLoadingInterval = 100 # ms
+
+  # Directory of the local timestep cache, None for VisualizeTimesteps in the Slicer cache directory
+  cacheDirectory = None
+
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    self.lazyTimer = None
+    self.lazyPool = None
+    self.lazyPending = []
+    self.lazyState = {}
+    self.timesteps = []
+    self._timestepStack = None
+
+  @property
+  def timestepStack(self):
+    """ TimestepStack of the timesteps of the last run, stacked on first use (see StackTimesteps). Until then
+    the timestep nodes keep their own scalars, memory-mapped ones from the local cache included
     """
-    # Print to Slicer CLI
-    print('Loading Ultrasound Inputs...'),
-    start_time = time.time()
-    fileextension = '.nii.gz'
-
-    # Load all timesteps
-    if slicer.util.loadVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/loupas/avolume_ts1_737_370_366'+fileextension):
-        ts1 = slicer.util.getNode('avolume_ts1_737_370_366')
-    else:
-        ts1 = 'invivo/Patient'+PatientNumber+'/loupas/avolume_ts1_737_370_366.nii.gz'
-
-    if slicer.util.loadVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/loupas/avolume_ts2_737_370_366'+fileextension):
-        ts2 = slicer.util.getNode('avolume_ts2_737_370_366')
-    else:
-        ts2 = 'invivo/Patient'+PatientNumber+'/loupas/avolume_ts2_737_370_366.nii.gz'
+    if self._timestepStack is None and self.timesteps:
+      self.StackTimesteps(*self.timesteps)
+    return self._timestepStack
 
-    if slicer.util.loadVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/loupas/avolume_ts3_737_370_366'+fileextension):
-        ts3 = slicer.util.getNode('avolume_ts3_737_370_366')
-    else:
-        ts3 = 'invivo/Patient'+PatientNumber+'/loupas/avolume_ts3_737_370_366.nii.gz'
-
-    if slicer.util.loadVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/loupas/avolume_ts4_737_370_366'+fileextension):
-        ts4 = slicer.util.getNode('avolume_ts4_737_370_366')
-    else:
-        ts4 = 'invivo/Patient'+PatientNumber+'/loupas/avolume_ts4_737_370_366.nii.gz'
+  def hasImageData(self,volumeNode):
+    """ Returns true if the passed in volume node has valid image data
+    """
+    return hasImageData(volumeNode)
 
-    if slicer.util.loadVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/loupas/avolume_ts5_737_370_366'+fileextension):
-        ts5 = slicer.util.getNode('avolume_ts5_737_370_366')
-    else:
-        ts5 = 'invivo/Patient'+PatientNumber+'/loupas/avolume_ts5_737_370_366.nii.gz'
+  def FindTimestepFiles(self, PatientNumber, timestepDirectory=TIMESTEP_DIRECTORY):
+    """ Returns the paths of all ARFI timestep volumes for a patient, sorted by timestep number
+    """
+    return findTimestepFiles(PatientNumber, timestepDirectory)
+
+  def ReadTimestepFile(self, filePath, cache=None):
+    """ Reads the header and voxels of a (compressed) NIfTI timestep into image data and its IJK to RAS
+    matrix (see AssortedLabLib.VolumeOps.readVolumeFile), or returns None if the file could not be read.
+    With a cache, the timestep is also written to it. Runs on worker threads (each with its own reader,
+    decompression, parsing and cache write), so it must not touch the MRML scene, and its time is reported
+    into the loading stage (workerTimed) instead of a stage of its own
+    """
+    readVolume = readVolumeFile(filePath)
+    if readVolume is None:
+      logging.error('Could not read %s' % filePath)
+    elif cache is not None:
+      self.CacheTimestep(cache, filePath, *readVolume)
+    return readVolume
+
+  def TimestepCache(self):
+    """ Returns the local cache of uncompressed timesteps, kept in the Slicer cache directory unless
+    cacheDirectory is set
+    """
+    return VolumeCache(self.cacheDirectory or os.path.join(slicer.app.cachePath, 'VisualizeTimesteps'))
 
-    if slicer.util.loadVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/loupas/avolume_ts6_737_370_366'+fileextension):
-        ts6 = slicer.util.getNode('avolume_ts6_737_370_366')
-    else:
-        ts6 = 'invivo/Patient'+PatientNumber+'/loupas/avolume_ts6_737_370_366.nii.gz'
+  def CacheTimestep(self, cache, filePath, imageData, ijkToRAS):
+    """ Stores the voxels and IJK to RAS matrix of a freshly read timestep in the local cache. Touches no
+    MRML state, so it runs on the worker threads
+    """
+    dimensions = imageData.GetDimensions()
+    array = arrayFromImageData(imageData).reshape(dimensions[2], dimensions[1], dimensions[0], -1)
+    return cache.Store(filePath, array, [element for row in matrixElements(ijkToRAS) for element in row])
 
-    if slicer.util.loadVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/loupas/avolume_ts7_737_370_366'+fileextension):
-        ts7 = slicer.util.getNode('avolume_ts7_737_370_366')
+  def CreateVolumeFromCache(self, name, array, header):
+    """ Creates a scalar volume node whose scalars are the memory-mapped cached array (no copy)
+    """
+    ijkToRAS = vtk.vtkMatrix4x4()
+    for index, value in enumerate(header['ijkToRAS']):
+      ijkToRAS.SetElement(index // 4, index % 4, value)
+    return createVolumeFromArray(name, array, ijkToRAS)
+
+  @timedStage('Loading Ultrasound Inputs...')
+  def loadTimesteps(self, PatientNumber, timestepDirectory=TIMESTEP_DIRECTORY, numberOfThreads=None, useCache=True):
+    """ Loads all ARFI timestep volumes found for a patient on the file server. Timesteps found in the local
+    cache are memory-mapped without reading the file server. The others are read, parsed and added to the cache
+    concurrently on a thread pool, then added to the scene on the main thread. If an input cannot be
+    loaded, its node variable is saved as a string with the missing filepath for error output
+    """
+    filePaths = self.FindTimestepFiles(PatientNumber, timestepDirectory)
+    if not filePaths:
+      return []
+
+    cache = self.TimestepCache() if useCache else None
+    cached = dict((filePath, cache.Load(filePath)) for filePath in filePaths) if cache else {}
+    missingPaths = [filePath for filePath in filePaths if not cached.get(filePath)]
+
+    # Read and parse the timesteps that are not cached concurrently
+    readTimesteps = {}
+    if missingPaths:
+      pool = ThreadPool(numberOfThreads or len(missingPaths))
+      try:
+        readTimestepFile = workerTimed(lambda filePath: self.ReadTimestepFile(filePath, cache))
+        readTimesteps = dict(zip(missingPaths, pool.map(readTimestepFile, missingPaths)))
+      finally:
+        pool.close()
+        pool.join()
+
+    # Scene changes have to happen on the main thread
+    timesteps = [self.LoadTimestep(filePath, cached.get(filePath), readTimesteps.get(filePath)) for filePath in filePaths]
+
+    # Show the last timestep like slicer.util.loadVolume does for files
+    self.ShowTimestep(timesteps[-1])
+
+    return timesteps
+
+  def LoadTimestep(self, filePath, cachedEntry, readTimestep):
+    """ Adds one timestep to the scene, from its cache entry or from the image data and IJK to RAS matrix
+    read by ReadTimestepFile (no copy). The node gets a storage node for its file, so it
+    can be saved and reloaded like a volume loaded by Slicer. Must run on the main thread. Returns the
+    node, or filePath if the timestep could not be loaded
+    """
+    if cachedEntry:
+      volumeNode = self.CreateVolumeFromCache(timestepName(filePath), *cachedEntry)
+    elif readTimestep:
+      volumeNode = createVolumeFromImageData(timestepName(filePath), *readTimestep)
     else:
-        ts7 = 'invivo/Patient'+PatientNumber+'/loupas/avolume_ts7_737_370_366.nii.gz'
+      return filePath
+    volumeNode.AddDefaultStorageNode(filePath)
+    recordVoxels(volumeNode.GetImageData().GetNumberOfPoints())
+    return volumeNode
 
-    if slicer.util.loadVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/loupas/avolume_ts8_737_370_366'+fileextension):
-        ts8 = slicer.util.getNode('avolume_ts8_737_370_366')
+  def ShowTimestep(self, volumeNode):
+    """ Shows a timestep in the slice views
+    """
+    if not isinstance(volumeNode, slicer.vtkMRMLScalarVolumeNode):
+      return
+    selectionNode = slicer.app.applicationLogic().GetSelectionNode()
+    selectionNode.SetReferenceActiveVolumeID(volumeNode.GetID())
+    slicer.app.applicationLogic().PropagateVolumeSelection(0)
+
+  def PrepareTimestep(self, volumeNode):
+    """ Centers, transforms and window/levels one loaded timestep, like run does for all of them
+    """
+    self.CenterAndTransform(volumeNode)
+    self.SetWindowLevel(volumeNode)
+
+  @timedStage(summary='Time to first timestep')
+  def loadTimestepsLazily(self, PatientNumber, timestepDirectory=TIMESTEP_DIRECTORY, numberOfThreads=None,
+                          useCache=True, onTimestepLoaded=None, onFinished=None):
+    """ Loads and shows the first timestep of a patient right away and loads the others in the background
+    in timestep (scroll) order. The files are read and parsed on a thread pool, and a timer on the main thread
+    adds each timestep to the scene and prepares it as soon as it is ready. onTimestepLoaded(node) is called
+    for every prepared timestep (or with the file path if it could not be loaded), and onFinished(timesteps)
+    with all timesteps, in file order, once the last one is loaded. Returns the first timestep, or None if no
+    timestep files were found
+    """
+    self.CancelLazyLoading()
+    filePaths = self.FindTimestepFiles(PatientNumber, timestepDirectory)
+    if not filePaths:
+      return None
+
+    # The whole load spans many timer callbacks, so it is timed by a detached stage ended in FinishLazyLoading
+    loadStage = StageTimer('%s.lazyLoad' % self.__class__.__name__, summary='Overall Load Time', detached=True)
+    cache = self.TimestepCache() if useCache else None
+    self.lazyState = {'onTimestepLoaded': onTimestepLoaded, 'onFinished': onFinished,
+                      'stage': loadStage.Start(), 'filePaths': filePaths, 'timesteps': {}, 'error': None}
+
+    # Queue the other timesteps before loading the first one so reading them overlaps with it
+    self.lazyPool = ThreadPool(numberOfThreads or max(1, len(filePaths)-1))
+    readTimestepFile = workerTimed(self.ReadTimestepFile, stage=loadStage)
+    for filePath in filePaths[1:]:
+      cachedEntry = cache.Load(filePath) if cache else None
+      read = None if cachedEntry else self.lazyPool.apply_async(readTimestepFile, (filePath, cache))
+      self.lazyPending.append((filePath, cachedEntry, read))
+
+    cachedEntry = cache.Load(filePaths[0]) if cache else None
+    readTimestep = None if cachedEntry else self.ReadTimestepFile(filePaths[0])
+    if readTimestep and cache:
+      # Shown first, cached in the background
+      self.lazyPool.apply_async(workerTimed(self.CacheTimestep, stage=loadStage), (cache, filePaths[0]) + readTimestep)
+    firstTimestep = self.LoadTimestepLazily(filePaths[0], cachedEntry, readTimestep)
+    self.ShowTimestep(firstTimestep)
+
+    self.lazyTimer = qt.QTimer()
+    self.lazyTimer.setInterval(self.lazyLoadingInterval)
+    self.lazyTimer.connect('timeout()', self.onLazyLoadingTimer)
+    self.lazyTimer.start()
+    return firstTimestep
+
+  def LoadTimestepLazily(self, filePath, cachedEntry, readTimestep):
+    """ Loads and prepares one timestep of a lazy load and reports it
+    """
+    volumeNode = self.LoadTimestep(filePath, cachedEntry, readTimestep)
+    if isinstance(volumeNode, str):
+      self.CheckAllInputsPresent(volumeNode)
     else:
-        ts8 = 'invivo/Patient'+PatientNumber+'/loupas/avolume_ts8_737_370_366.nii.gz'
-
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+      self.PrepareTimestep(volumeNode)
+      self.lazyState['stage'].voxels += volumeNode.GetImageData().GetNumberOfPoints()
+    self.lazyState['timesteps'][filePath] = volumeNode
+    if self.lazyState['onTimestepLoaded']:
+      self.lazyState['onTimestepLoaded'](volumeNode)
+    return volumeNode
+
+  def onLazyLoadingTimer(self):
+    """ Adds at most one finished timestep to the scene per tick so the application stays responsive
+    """
+    for index, (filePath, cachedEntry, read) in enumerate(self.lazyPending):
+      if read is None or read.ready():
+        del self.lazyPending[index]
+        try:
+          readTimestep = read.get() if read is not None else None
+          with SceneBatch(pauseRender=True):
+            self.LoadTimestepLazily(filePath, cachedEntry, readTimestep)
+        except Exception as error:
+          # A failed timestep is reported as missing, the load goes on and its stage records the error
+          logging.error('Could not load %s: %s' % (filePath, error))
+          self.lazyState['error'] = error
+          self.LoadTimestepLazily(filePath, None, None)
+        break
+    if not self.lazyPending:
+      self.FinishLazyLoading()
+
+  def FinishLazyLoading(self):
+    """ Ends a lazy load once its last timestep is in the scene, hands all timesteps to onFinished if they
+    all loaded and reports the total load time
+    """
+    state = self.lazyState
+    self.lazyState = {}
+    self.CancelLazyLoading()
+    timesteps = [state['timesteps'][filePath] for filePath in state['filePaths']]
+    try:
+      if state['onFinished'] and self.CheckAllInputsPresent(*timesteps):
+        with SceneBatch(pauseRender=True):
+          state['onFinished'](timesteps)
+    except Exception as error:
+      state['stage'].Stop(error)
+      raise
+    state['stage'].Stop(state['error'])
+    logging.info('Processing completed')
 
-    return ts1, ts2, ts3, ts4, ts5, ts6, ts7, ts8
+  def CancelLazyLoading(self):
+    """ Stops a running lazy load. Timesteps already in the scene are kept
+    """
+    if self.lazyState.get('stage') is not None:
+      self.lazyState['stage'].Stop(RuntimeError('Lazy loading cancelled'))
+    if self.lazyTimer is not None:
+      self.lazyTimer.stop()
+      self.lazyTimer = None
+    if self.lazyPool is not None:
+      self.lazyPool.terminate() # drops queued timesteps, running reads finish
+      self.lazyPool.join()
+      self.lazyPool = None
+    self.lazyPending = []
+    self.lazyState = {}
 
   def CheckAllInputsPresent(self, *inputNodes):
     """ Checks if input nodes present and if not returns false
@@ -185,80 +402,131 @@ class VisualizeTimestepsLogic(ScriptedLoadableModuleLogic):
     else:
         return False
   
+  @timedStage('Centering volumes...')
   def CenterVolume(self, *inputVolumes):
     """ Centers an inputted volume using the image spacing, size, and origin of the volume
     """
-    # Print to Slicer CLI
-    print('Centering volumes...'),
-    start_time = time.time()
-
-    for inputVolume in inputVolumes: # cycle through all input volumes
-
-        # Use image size and spacing to find origin coordinates
-        extent = [x-1 for x in inputVolume.GetImageData().GetDimensions()] # subtract 1 from dimensions to get extent
-        spacing = [x for x in inputVolume.GetSpacing()]
-        new_origin = [a*b/2 for a,b in zip(extent,spacing)]
-        new_origin[2] = -new_origin[2] # need to make this value negative to center the volume
-
-        # Set input volume origin to the new origin
-        inputVolume.SetOrigin(new_origin)
-
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+    applyGeometry(inputVolumes, origin=centeredOrigin)
 
+  @timedStage('Transforming Ultrasound input...')
   def US_transform(self, *ARFIinputs):
     """ Performs inversion transform with [1 1 -1 1] diagonal entries on Ultrasound inputs
     """
-    # Print to Slicer CLI
-    print('Transforming Ultrasound input...'),
-    start_time = time.time()
+    applyGeometry(ARFIinputs, transformMatrix=diagonalMatrix(1, 1, -1))
 
-    # Create inverting transform matrix
-    invert_transform = vtk.vtkMatrix4x4()
-    invert_transform.SetElement(2,2,-1) # put a -1 in 3rd entry of diagonal of matrix
+  @timedStage('Centering and transforming volumes...')
+  def CenterAndTransform(self, *ARFIinputs):
+    """ Centers the Ultrasound inputs and applies the [1 1 -1 1] inversion transform in one geometry
+    update, computed once for all inputs that share a geometry (same result as CenterVolume and then
+    US_transform)
+    """
+    applyGeometry(ARFIinputs, origin=centeredOrigin, transformMatrix=diagonalMatrix(1, 1, -1))
+
+  def SetWindowLevel(self, *volumeNodes):
+    """ Sets the window level used for viewing the loaded timesteps
+    """
+    for volumeNode in volumeNodes:
+      displayNode = volumeNode.GetDisplayNode()
+      wasModifying = displayNode.StartModify() # one modified event for both changes
+      displayNode.SetAutoWindowLevel(0)
+      displayNode.SetWindowLevel(110,50) # sets window level for viewing for loaded volumes
+      displayNode.EndModify(wasModifying)
+
+  @timedStage('Stacking timesteps...')
+  def StackTimesteps(self, *timesteps):
+    """ Moves the scalars of the loaded timesteps into one contiguous (t, z, y, x) TimestepStack that the
+    timestep nodes keep using as their scalars (see AssortedLabLib.VolumeOps.stackVolumes). The stack is kept
+    in timestepStack for temporal operations and MultiVolCombine
+    """
+    self._timestepStack = stackVolumes(timesteps)
+    return self._timestepStack
 
-    # Apply transform to all input nodes
-    for ARFIinput in ARFIinputs:
-        ARFIinput.ApplyTransformMatrix(invert_transform)
+  def FinishTimesteps(self, timesteps, temporal=False, sequence=False):
+    """ Keeps the loaded and prepared timesteps for timestepStack and creates the temporal volumes and the
+    timestep sequence if requested
+    """
+    self.timesteps = list(timesteps)
+    self._timestepStack = None
+
+    # Temporal operations are reductions over the time axis of the stack, which is only built for them
+    if temporal:
+      self.ComputeTemporalVolumes(timesteps[0])
+    if sequence:
+      self.CreateTimestepSequence(*timesteps)
+
+  @timedStage('Computing temporal volumes...')
+  def ComputeTemporalVolumes(self, referenceNode, stack=None, timesteps=None):
+    """ Reduces the timestep stack over time into temporal_max, temporal_mean and time_to_peak volumes
+    (time to peak is the stack index of the brightest timestep of every voxel) with the geometry and display
+    settings of referenceNode. Returns the three volume nodes
+    """
+    if stack is None:
+      stack = self.timestepStack
+    maximumArray, meanArray = stack.Project(('max', 'mean'), timesteps)
+    timeToPeakArray = stack.TimeToPeak(timesteps)
+    maximumVolume = createOutputVolume(referenceNode, 'temporal_max', maximumArray)
+    meanVolume = createOutputVolume(referenceNode, 'temporal_mean', meanArray)
+    timeToPeakVolume = createOutputVolume(referenceNode, 'time_to_peak', timeToPeakArray)
+    displayNode = timeToPeakVolume.GetDisplayNode()
+    if displayNode:
+      displayNode.SetAutoWindowLevel(0)
+      displayNode.SetWindowLevel(len(stack), (len(stack)-1)/2.0)
+    return maximumVolume, meanVolume, timeToPeakVolume
 
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+  def CreateTimestepSequence(self, *timesteps):
+    """ Adds the timesteps to a sequence node for the Sequences module. Returns None if the Sequences
+    extension is not installed
+    """
+    return createSequenceNode('timesteps', timesteps)
 
-  def run(self, PatientNumber):
+  @batchedScene()
+  def run(self, PatientNumber, lazy=False, timestepDirectory=TIMESTEP_DIRECTORY, useCache=True, temporal=False,
+          sequence=False):
     """
-    Run the actual algorithm
+    Run the actual algorithm. Returns the centered and transformed timestep nodes, which timestepStack moves
+    into one TimestepStack when it is first used. With temporal, the temporal maximum, mean and time to peak
+    volumes are created as well, and with sequence a timestep sequence node. With lazy, the first timestep
+    is shown as soon as it is loaded and the others are loaded and prepared in the background. True is
+    returned then, and the temporal volumes and sequence are created once the last timestep is loaded
     """
+    self.timesteps = []
+    self._timestepStack = None
 
     # Print to Slicer CLI
     logging.info('\n\n')
-    start_time_overall = time.time() # start timer
-    print('Expected Module Run Time: 30 seconds') # based on previous trials of the algorithm
-
-    # Load Timesteps
-    ts1, ts2, ts3, ts4, ts5, ts6, ts7, ts8 = self.loadTimesteps(PatientNumber)
 
-    # Check if all expected timesteps present
-    if not self.CheckAllInputsPresent(ts1, ts2, ts3, ts4, ts5, ts6, ts7, ts8):
-        print "Exiting process. Not all timestep files supplied.\n"
+    # A lazy run returns once the first timestep is shown, its total is reported when the last one is loaded
+    if lazy:
+      onFinished = lambda timesteps: self.FinishTimesteps(timesteps, temporal, sequence)
+      if self.loadTimestepsLazily(PatientNumber, timestepDirectory, useCache=useCache, onFinished=onFinished) is None:
+        print("Exiting process. No timestep files found in %s\n" % (timestepDirectory % PatientNumber))
         return
+      return True
 
-    # Center all Volumes
-    self.CenterVolume(ts1, ts2, ts3, ts4, ts5, ts6, ts7, ts8)
+    with StageTimer('%s.run' % self.__class__.__name__, summary='Overall Algorithm Time'):
+      # Load Timesteps
+      timesteps = self.loadTimesteps(PatientNumber, timestepDirectory, useCache=useCache)
 
-    # Transform all volumes to match segmentation labels
-    self.US_transform(ts1, ts2, ts3, ts4, ts5, ts6, ts7, ts8)
+      # Check if all expected timesteps present
+      if not timesteps:
+          print("Exiting process. No timestep files found in %s\n" % (timestepDirectory % PatientNumber))
+          return
+      if not self.CheckAllInputsPresent(*timesteps):
+          print("Exiting process. Not all timestep files supplied.\n")
+          return
 
-    # Set Window Level for all Volumes
-    for volumeNode in [ts1, ts2, ts3, ts4, ts5, ts6, ts7, ts8]:
-      displayNode = volumeNode.GetDisplayNode()
-      displayNode.SetAutoWindowLevel(0)
-      displayNode.SetWindowLevel(110,50) # sets window level for viewing for loaded volumes
+      # Center all Volumes and transform them to match segmentation labels
+      self.CenterAndTransform(*timesteps)
 
-    logging.info('Processing completed')
+      # Set Window Level for all Volumes
+      self.SetWindowLevel(*timesteps)
+
+      # Keep the timesteps for the 4D stack and reduce them over time if requested
+      self.FinishTimesteps(timesteps, temporal, sequence)
 
-    return True
+      logging.info('Processing completed')
+
+      return timesteps
 
 
 class VisualizeTimestepsTest(ScriptedLoadableModuleTest):
@@ -278,6 +546,10 @@ class VisualizeTimestepsTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_VisualizeTimesteps1()
+    self.test_VisualizeTimestepsCache()
+    self.test_VisualizeTimestepsGeometry()
+    self.test_VisualizeTimestepsStack()
+    self.test_VisualizeTimestepsReader()
 
   def test_VisualizeTimesteps1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -314,3 +586,140 @@ class VisualizeTimestepsTest(ScriptedLoadableModuleTest):
     logic = VisualizeTimestepsLogic()
     self.assertTrue( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_VisualizeTimestepsCache(self):
+    """ Cached timesteps come back memory-mapped with their geometry, and the
+    least recently used entries are evicted when the cache is full
+    """
+    directory = tempfile.mkdtemp(prefix='VisualizeTimestepsTest', dir=slicer.app.temporaryPath)
+    try:
+      sourcePaths = []
+      for index in range(3):
+        sourcePaths.append(os.path.join(directory, 'avolume_ts%d.nii.gz' % (index+1)))
+        open(sourcePaths[-1], 'w').close()
+      array = np.arange(4*5*6, dtype=np.uint8).reshape(4, 5, 6, 1)
+      ijkToRAS = [float(x) for x in range(16)]
+
+      # Room for two entries only
+      cache = VolumeCache(os.path.join(directory, 'cache'), maximumSizeMB=2.5*array.nbytes/1024.0**2)
+      self.assertTrue( cache.Store(sourcePaths[0], array, ijkToRAS) )
+      cachedArray, header = cache.Load(sourcePaths[0])
+      self.assertTrue( isinstance(cachedArray, np.memmap) )
+      self.assertTrue( np.array_equal(cachedArray, array) )
+      self.assertEqual( header['ijkToRAS'], ijkToRAS )
+
+      cache.Store(sourcePaths[1], array, ijkToRAS)
+      os.utime(cache.Paths(cache.Key(sourcePaths[1]))[1], (0, 0)) # make entry 2 the oldest
+      cache.Store(sourcePaths[2], array, ijkToRAS)
+      self.assertIsNone( cache.Load(sourcePaths[1]) )
+      self.assertIsNotNone( cache.Load(sourcePaths[0]) )
+      self.assertIsNotNone( cache.Load(sourcePaths[2]) )
+      del cachedArray
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
+
+  def test_VisualizeTimestepsGeometry(self):
+    """ The batched centering and inversion gives the same IJK to RAS matrix as setting the
+    origin and applying the transform node by node
+    """
+    ijkToRAS = diagonalMatrix(0.2, 0.3, 0.5)
+    for axis, origin in enumerate((4, -2, 1)):
+      ijkToRAS.SetElement(axis, 3, origin)
+    volumeNodes = [createVolumeFromArray('ts%d' % (index+1), np.zeros((3, 5, 7), dtype=np.uint8), ijkToRAS) for index in range(3)]
+
+    logic = VisualizeTimestepsLogic()
+    logic.CenterAndTransform(*volumeNodes[:2])
+
+    # Reference: per node origin change and transform
+    reference = volumeNodes[2]
+    reference.SetOrigin(6*0.2/2, 4*0.3/2, -2*0.5/2)
+    invert_transform = vtk.vtkMatrix4x4()
+    invert_transform.SetElement(2,2,-1)
+    reference.ApplyTransformMatrix(invert_transform)
+
+    expected = vtk.vtkMatrix4x4()
+    reference.GetIJKToRASMatrix(expected)
+    for volumeNode in volumeNodes[:2]:
+      actual = vtk.vtkMatrix4x4()
+      volumeNode.GetIJKToRASMatrix(actual)
+      for row in range(4):
+        for column in range(4):
+          self.assertAlmostEqual( actual.GetElement(row, column), expected.GetElement(row, column) )
+    self.delayDisplay('Test passed!')
+
+  def test_VisualizeTimestepsStack(self):
+    """ Stacked timesteps share one buffer with their nodes, and the temporal volumes match
+    reductions over the time axis
+    """
+    arrays = [np.random.randint(0, 256, (3, 4, 5)).astype(np.uint8) for index in range(4)]
+    volumeNodes = []
+    for index, array in enumerate(arrays):
+      ijkToRAS = vtk.vtkMatrix4x4()
+      volumeNodes.append(createVolumeFromArray('ts%d' % (index+1), array.copy(), ijkToRAS))
+
+    logic = VisualizeTimestepsLogic()
+    imageData = volumeNodes[0].GetImageData()
+    logic.FinishTimesteps(volumeNodes)
+    # Without temporal volumes the nodes keep their own scalars until the stack is used
+    self.assertTrue( volumeNodes[0].GetImageData() is imageData )
+    stack = logic.timestepStack
+    self.assertEqual( stack.array.shape, (4, 3, 4, 5) )
+    self.assertEqual( stack.names, ['ts1', 'ts2', 'ts3', 'ts4'] )
+    self.assertTrue( np.array_equal(stack.array, np.array(arrays)) )
+
+    # The nodes show the stack itself
+    stack.array[2, 0, 0, 0] = 7
+    self.assertEqual( arrayFromVolume(volumeNodes[2])[0, 0, 0], 7 )
+    arrays[2][0, 0, 0] = 7
+
+    maximumVolume, meanVolume, timeToPeakVolume = logic.ComputeTemporalVolumes(volumeNodes[0], timesteps=[1, 2, 3])
+    selected = np.array(arrays[1:], dtype=np.float64)
+    self.assertTrue( np.array_equal(arrayFromVolume(maximumVolume), selected.max(axis=0)) )
+    self.assertTrue( np.allclose(arrayFromVolume(meanVolume), selected.mean(axis=0)) )
+    self.assertTrue( np.array_equal(arrayFromVolume(timeToPeakVolume), selected.argmax(axis=0)+1) )
+    self.delayDisplay('Test passed!')
+
+  def test_VisualizeTimestepsReader(self):
+    """ Timesteps read on the worker threads get the voxels and IJK to RAS matrix slicer.util.loadVolume
+    gives, for a qfac -1 file with a rescale slope and intercept and for an sform only file
+    """
+    self.delayDisplay("Starting the reader test")
+    array = np.arange(60, dtype=np.int16).reshape(3, 4, 5)
+    imageData = imageDataFromArray(array)
+    imageData.SetSpacing(0.5, 0.75, 2.0)
+    orientation = vtk.vtkMatrix4x4()
+    orientation.DeepCopy((0, -1, 0, 10,  1, 0, 0, -5,  0, 0, 1, 3,  0, 0, 0, 1))
+
+    def qfacRescaled(writer):
+      writer.SetQFac(-1)
+      writer.SetQFormMatrix(orientation)
+      writer.SetRescaleSlope(2.0)
+      writer.SetRescaleIntercept(-1.0)
+    def sformOnly(writer):
+      writer.SetSFormMatrix(orientation)
+
+    logic = VisualizeTimestepsLogic()
+    directory = tempfile.mkdtemp()
+    try:
+      for name, configureWriter in (('avolume_ts1', qfacRescaled), ('avolume_ts2', sformOnly)):
+        filePath = os.path.join(directory, name + '.nii.gz')
+        writer = vtk.vtkNIFTIImageWriter()
+        writer.SetInputData(imageData)
+        writer.SetFileName(filePath)
+        configureWriter(writer)
+        writer.Write()
+
+        loaded, expected = slicer.util.loadVolume(filePath, {}, returnNode=True)
+        self.assertTrue( loaded )
+        actual = logic.LoadTimestep(filePath, None, logic.ReadTimestepFile(filePath))
+        self.assertEqual( actual.GetStorageNode().GetFileName(), filePath )
+        self.assertEqual( arrayFromVolume(actual).dtype, arrayFromVolume(expected).dtype )
+        self.assertTrue( np.allclose(arrayFromVolume(actual), arrayFromVolume(expected)) )
+        actualMatrix, expectedMatrix = vtk.vtkMatrix4x4(), vtk.vtkMatrix4x4()
+        actual.GetIJKToRASMatrix(actualMatrix)
+        expected.GetIJKToRASMatrix(expectedMatrix)
+        self.assertTrue( np.allclose(matrixElements(actualMatrix), matrixElements(expectedMatrix), atol=1e-4) )
+    finally:
+      shutil.rmtree(directory)
+    self.delayDisplay('Test passed!')